@@ -0,0 +1,223 @@
+"""
+Benchmark the departure transform path (get_departures, format_platforms, colour_codes, alerts and the JSON output) offline, using
+made-up departure_mon responses from synthetic_data.py scaled up to thousands of stopEvents.
+
+    python benchmark.py                                  - run the default sizes and print the results
+    python benchmark.py --events 100 10000 --repeat 10   - choose the sizes and how many times to run each phase
+    python benchmark.py --save baseline.json             - save the results to compare against later
+    python benchmark.py --compare baseline.json          - flag any phase that got slower than the saved results
+    python benchmark.py --trip-updates 1000 5000         - also time decoding made-up GTFS-Realtime feeds with that many trips
+
+Each size reports stopEvents parsed per second, the time for each phase, and the peak memory used decoding and transforming the response.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+import dep_mon12
+import gtfs_realtime
+import replay
+import request_governor
+import synthetic_data
+
+
+class StaticAdapter(BaseAdapter):
+    """
+    A requests transport adapter that answers every request with the same body - used to record a synthetic response.
+    """
+
+    def __init__(self, body):
+        super().__init__()
+        self.body = body.encode("utf-8")
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.status_code = 200
+        response.encoding = "utf-8"
+        response.headers = CaseInsensitiveDict({"Content-Type": "application/json"})
+        response._content = self.body
+        return response
+
+    def close(self):
+        pass
+
+
+def best_time(function, repeat):
+    """
+    Run function repeat times and return the fastest run in seconds (the fastest is the least affected by anything else running).
+    """
+    fastest = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        fastest = min(fastest, time.perf_counter() - start)
+    return fastest
+
+
+def benchmark_size(event_count, repeat):
+    """
+    Benchmark every phase for a response with event_count stopEvents.
+
+    Returns:
+        dict: Seconds per phase, stopEvents parsed per second and peak memory in bytes.
+    """
+    response = synthetic_data.make_departure_mon_response(event_count, seed=event_count)
+    body = json.dumps(response)
+    stop_events = response["stopEvents"]
+    results = {"events": event_count, "response_bytes": len(body)}
+
+    # JSON decode
+    results["json_decode"] = best_time(lambda: json.loads(body), repeat)
+
+    # Datetime parsing - the same parsing parse_departures does for every service
+    def parse_times():
+        for service in stop_events:
+            dep_mon12.parse_api_time(service.get("departureTimeEstimated", service["departureTimePlanned"]))
+            if "departureTimeEstimated" in service:
+                dep_mon12.parse_api_time(service["departureTimeEstimated"])
+                dep_mon12.parse_api_time(service["departureTimePlanned"])
+    results["datetime_parsing"] = best_time(parse_times, repeat)
+
+    # Alert handling
+    def parse_alerts():
+        for service in stop_events:
+            dep_mon12.parse_alerts(service.get("infos", []))
+    results["alert_handling"] = best_time(parse_alerts, repeat)
+
+    # The whole transform, including platforms and colours
+    departures = dep_mon12.parse_departures(stop_events, "Central", "10101100", [])
+    results["transform"] = best_time(lambda: dep_mon12.parse_departures(stop_events, "Central", "10101100", []), repeat)
+
+    # Output serialisation - writing output.json
+    with tempfile.TemporaryDirectory() as directory:
+        output_path = os.path.join(directory, "output.json")
+
+        def write_output():
+            with contextlib.redirect_stdout(io.StringIO()):  # In case anything prints rather than logs
+                dep_mon12.generate_json_output(departures, output_path)
+        results["output_serialisation"] = best_time(write_output, repeat)
+
+    # End to end - get_departures through a replayed HTTP response, so the requests overhead is included too
+    # Every mode is asked for so all of the synthetic events come back in the one response
+    modes = [{"mode_name": mode_name} for mode_name in dep_mon12.type_lookup_table.values()]
+    original_session, original_governor, original_reuse = dep_mon12.http_session, dep_mon12.api_governor, dep_mon12.reuse_unchanged_responses
+    try:
+        with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+            # Record the response once (so it's saved under exactly the request get_departures_for_stop makes), then replay it
+            recording_session = requests.Session()
+            recording_session.mount("https://", StaticAdapter(body))
+            replay.record_responses(recording_session, directory)
+            dep_mon12.http_session = recording_session
+            # API calls go through api_governor, so it needs the swapped session too (and no rate limit, which would be timed as well)
+            dep_mon12.api_governor = request_governor.RequestGovernor(recording_session, requests_per_second=None)
+            dep_mon12.get_departures_for_stop("Central", "10101100", modes)
+
+            replay_session = requests.Session()
+            replay_session.mount("https://", replay.ReplayAdapter(directory, shift_times=False))
+            dep_mon12.http_session = replay_session
+            dep_mon12.api_governor = request_governor.RequestGovernor(replay_session, requests_per_second=None)
+            # The same response every time, so turn off reusing unchanged responses for end_to_end, then time what reusing saves
+            dep_mon12.reuse_unchanged_responses = False
+            results["end_to_end"] = best_time(lambda: dep_mon12.get_departures_for_stop("Central", "10101100", modes), repeat)
+            dep_mon12.reuse_unchanged_responses = True
+            results["end_to_end_unchanged"] = best_time(lambda: dep_mon12.get_departures_for_stop("Central", "10101100", modes), repeat)
+    finally:
+        dep_mon12.http_session, dep_mon12.api_governor = original_session, original_governor
+        dep_mon12.reuse_unchanged_responses = original_reuse
+
+    # Peak memory while decoding and transforming
+    tracemalloc.start()
+    dep_mon12.parse_departures(json.loads(body)["stopEvents"], "Central", "10101100", [])
+    results["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    results["events_per_second"] = event_count / results["transform"] if results["transform"] else float("inf")
+    return results
+
+
+phases = ["json_decode", "datetime_parsing", "alert_handling", "transform", "output_serialisation", "end_to_end", "end_to_end_unchanged"]
+
+
+def print_results(all_results):
+    print(f"{'events':>8} {'KB':>8} {'events/s':>12} " + " ".join(f"{phase:>20}" for phase in phases) + f" {'peak MB':>9}")
+    for results in all_results:
+        phase_times = " ".join(f"{results[phase] * 1000:>17.2f} ms" for phase in phases)
+        print(f"{results['events']:>8} {results['response_bytes'] / 1024:>8.0f} {results['events_per_second']:>12.0f} {phase_times} {results['peak_memory_bytes'] / 1024 / 1024:>9.2f}")
+
+
+def benchmark_trip_updates(trip_count, repeat):
+    """
+    Time decoding a made-up TripUpdates feed with trip_count trips into departures by stop (see gtfs_realtime.py). The whole feed is
+    decoded every time it's fetched, so this needs to stay well under min_poll_interval_seconds for the biggest feed (buses).
+    """
+    feed = synthetic_data.make_trip_updates_feed(trip_count, stops_per_trip=30)
+    index = gtfs_realtime.build_trip_update_index(feed)
+    decode_seconds = best_time(lambda: gtfs_realtime.build_trip_update_index(feed), repeat)
+    print(f"{trip_count:>8} {len(feed) / 1024:>10.0f} {len(index):>12} {decode_seconds * 1000:>14.2f} ms")
+
+
+def compare_results(all_results, baseline_path, tolerance):
+    """
+    Compare against saved results and list every phase that got more than tolerance (e.g., 0.2 = 20%) slower.
+
+    Returns:
+        list: A description of each regression. Empty if nothing got slower.
+    """
+    with open(baseline_path, "r") as file:
+        baseline = {results["events"]: results for results in json.load(file)}
+
+    regressions = []
+    for results in all_results:
+        previous = baseline.get(results["events"])
+        if previous is None:
+            continue
+        for phase in phases:
+            if phase in previous and results[phase] > previous[phase] * (1 + tolerance):
+                regressions.append(f"{results['events']} events, {phase}: {previous[phase] * 1000:.2f} ms -> {results[phase] * 1000:.2f} ms")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the departure transform path on synthetic data")
+    parser.add_argument("--events", type=int, nargs="+", default=[10, 100, 1000, 5000], help="Number of stopEvents per response to benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="How many times to run each phase (the fastest is reported)")
+    parser.add_argument("--save", help="Save the results to this JSON file")
+    parser.add_argument("--compare", help="Compare the results to this saved JSON file and exit with an error if anything got slower")
+    parser.add_argument("--trip-updates", type=int, nargs="+", default=[], help="Also time decoding TripUpdates feeds with these numbers of trips")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="How much slower a phase can get before --compare fails (default 0.2 = 20%%)")
+    args = parser.parse_args()
+
+    all_results = [benchmark_size(event_count, args.repeat) for event_count in args.events]
+    print_results(all_results)
+
+    if args.trip_updates:
+        print(f"\n{'trips':>8} {'KB':>10} {'departures':>12} {'decode':>17}")
+        for trip_count in args.trip_updates:
+            benchmark_trip_updates(trip_count, args.repeat)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(all_results, file, indent=4)
+        print(f"Results saved to {args.save}")
+
+    if args.compare:
+        regressions = compare_results(all_results, args.compare, args.tolerance)
+        if regressions:
+            print("Slower than the saved results:")
+            for regression in regressions:
+                print(f"    {regression}")
+            sys.exit(1)
+        print("No regressions")
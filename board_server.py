@@ -0,0 +1,249 @@
+"""
+A small web server that serves the departure board straight from memory, instead of every screen re-downloading output.json from disk.
+
+    /               index.html (from the same folder as this file)
+    /output.json    the latest departures, with a strong ETag so unchanged polls get a 304, gzip/brotli compressed if the browser supports it
+    /events         Server-Sent Events - pushes the latest departures, then a new copy only when they actually change
+    /metrics        timings for each part of a refresh, in Prometheus format (only when metrics are turned on - see metrics.py)
+
+With several boards (see boards in dep_mon12.py), each one is also served under its own name:
+
+    /boards/{name}/              index.html, which loads the two below (they're relative urls)
+    /boards/{name}/output.json
+    /boards/{name}/events
+
+The poller calls publish_departures() after every refresh (once per board), and start_server() once at startup.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+import metrics
+
+# brotli is optional - if it's installed, browsers that ask for it get brotli, otherwise everyone gets gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+# How often to send a comment down idle /events connections so proxies don't close them
+sse_heartbeat_seconds = 15
+
+
+
+def empty_snapshot():
+    return {
+        "version": 0,
+        "etag": None,
+        "body": b"[]",
+        "gzip": gzip.compress(b"[]"),
+        "br": brotli.compress(b"[]") if brotli else None,
+    }
+
+
+# The latest departures, already serialised and compressed so each request is just a memory copy
+snapshot = empty_snapshot()
+# Each named board's latest departures, the same as snapshot (the unnamed board, served at /)
+board_snapshots = {None: snapshot}
+# Notified whenever any board's departures change
+snapshot_changed = threading.Condition()
+
+# Parts of the output that change without the departures changing, so don't count as a change (no new ETag, nothing pushed)
+unhashed_keys = {"generated_at", "delay_stats"}
+
+index_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "index.html")
+
+
+def publish_departures(output, board=None):
+    """
+    Make output the departures served by /output.json and /events (or /boards/{board}/output.json and /boards/{board}/events).
+
+    Args:
+        output (list or dict): The same JSON that would go in output.json (see build_output() in dep_mon12.py).
+        board (str): Which board these departures are for. None for the unnamed board served at /.
+
+    Returns:
+        bool: True if the departures changed since the last call, False if they were the same (nothing is pushed to /events).
+    """
+    body = json.dumps(output, separators=(",", ":")).encode("utf-8")
+
+    # generated_at changes every time the output is rebuilt, and delay_stats slowly fades with time (see delay_stats.py), even if
+    # nothing else has changed, so leave them out when deciding if anything changed - they go out with the next real change
+    if isinstance(output, dict) and unhashed_keys.intersection(output):
+        content = json.dumps({key: value for key, value in output.items() if key not in unhashed_keys}, separators=(",", ":")).encode("utf-8")
+    else:
+        content = body
+    etag = f'"{hashlib.sha1(content).hexdigest()}"'
+
+    with snapshot_changed:
+        board_snapshot = board_snapshots.setdefault(board, empty_snapshot())
+    if etag == board_snapshot["etag"]:
+        return False
+
+    # Compress once here, rather than once per request
+    compressed_gzip = gzip.compress(body)
+    compressed_br = brotli.compress(body) if brotli else None
+
+    with snapshot_changed:
+        board_snapshot.update({
+            "version": board_snapshot["version"] + 1,
+            "etag": etag,
+            "body": body,
+            "gzip": compressed_gzip,
+            "br": compressed_br,
+        })
+        snapshot_changed.notify_all()
+
+    return True
+
+
+class BoardRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive so screens polling /output.json reuse their connection
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        board = None
+        if path.startswith("/boards/"):
+            # /boards/{name}/... - the same as below, for that board
+            board, _, path = path[len("/boards/"):].partition("/")
+            board = unquote(board)
+            with snapshot_changed:
+                known_board = board in board_snapshots
+            if not known_board:
+                self.send_error(404)
+                return
+            if not path and not self.path.split("?", 1)[0].endswith("/"):
+                # Without the slash, index.html's relative urls would point at /boards/output.json
+                self.send_redirect(f"/boards/{self.path.split('?', 1)[0][len('/boards/'):]}/")
+                return
+            path = "/" + path
+
+        if path in ("/", "/index.html"):
+            self.send_index()
+        elif path == "/output.json":
+            self.send_departures(board)
+        elif path == "/events":
+            self.send_events(board)
+        elif path == "/metrics" and board is None and metrics.metrics_enabled:
+            self.send_metrics()
+        else:
+            self.send_error(404)
+
+    def send_redirect(self, location):
+        self.send_response(301)
+        self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_index(self):
+        try:
+            with open(index_path, "rb") as file:
+                body = file.read()
+        except OSError:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_departures(self, board=None):
+        # Read everything together so we don't send one version's ETag with another version's body
+        with snapshot_changed:
+            board_snapshot = board_snapshots[board]
+            etag, body, compressed_gzip, compressed_br = board_snapshot["etag"], board_snapshot["body"], board_snapshot["gzip"], board_snapshot["br"]
+
+        # Nothing has changed since the browser's copy
+        if etag is not None and etag in self.headers.get("If-None-Match", ""):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        accept_encoding = self.headers.get("Accept-Encoding", "")
+        encoding = None
+        if compressed_br is not None and "br" in accept_encoding:
+            encoding, body = "br", compressed_br
+        elif "gzip" in accept_encoding:
+            encoding, body = "gzip", compressed_gzip
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Cache-Control", "no-cache")  # Browsers can keep it, but must check the ETag before using it
+        self.send_header("Vary", "Accept-Encoding")
+        if etag is not None:
+            self.send_header("ETag", etag)
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_metrics(self):
+        body = metrics.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self, board=None):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")  # An event stream never ends, so it can't be reused for anything else
+        self.end_headers()
+        self.close_connection = True
+
+        last_version = None
+        try:
+            while True:
+                with snapshot_changed:
+                    # Wait until there's something new for this board, sending a heartbeat every now and again so the connection stays open
+                    board_snapshot = board_snapshots[board]
+                    snapshot_changed.wait_for(lambda: board_snapshot["version"] != last_version, timeout=sse_heartbeat_seconds)
+                    version, etag, body = board_snapshot["version"], board_snapshot["etag"], board_snapshot["body"]
+
+                if version == last_version:
+                    self.wfile.write(b": heartbeat\n\n")
+                else:
+                    last_version = version
+                    self.wfile.write(b"id: " + (etag or '""').strip('"').encode("ascii") + b"\ndata: " + body + b"\n\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The screen has gone away
+
+    def log_message(self, format, *args):
+        # Don't print a line for every request - there will be a lot of them with dozens of screens
+        pass
+
+
+def start_server(host="0.0.0.0", port=8080):
+    """
+    Start serving the board in a background thread.
+
+    Args:
+        host (str): The address to listen on. "0.0.0.0" for every network interface.
+        port (int): The port to listen on.
+
+    Returns:
+        ThreadingHTTPServer: The running server (call shutdown() on it to stop it).
+    """
+    server = ThreadingHTTPServer((host, port), BoardRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info(f"Serving the departure board on http://{host}:{port}/")
+    return server
@@ -0,0 +1,221 @@
+"""
+Rolling delay statistics for each line and stop - the average delay, the median, 90th and 99th percentile, and how many services
+are running late - so a board can say "T1 running ~6 min late".
+
+    tracker = DelayTracker(half_life_seconds=1800, late_seconds=300)
+    tracker.update(departures, time.time())    - every time a stop is polled, with the departures that came back
+    tracker.stats(time.time(), lines=["train|T1"], stop_ids=["10101229"])
+
+Lines are kept by mode as well as name (as "mode|line", the same as gtfs_static.route_key), since different modes can use the same
+line name (e.g., the T1 train and a T1 bus).
+
+Each service counts once, with the last delay it had before it left (the departures are kept until then, which is only as many as
+are on the boards). Nothing else is stored: each line and stop has a sketch of its delays - counts in buckets that get about 2%
+wider each time, like DDSketch - so the memory used doesn't grow however long it runs, and the percentiles are within about 2%.
+
+Older services count for less, halving every half_life_seconds, so the stats follow what's happening now. Rather than shrinking
+every count as time goes on, each new service is counted as worth more (forward decay), so updating is only ever the new departures.
+"""
+
+import heapq
+import logging
+import math
+
+import gtfs_static
+
+log = logging.getLogger(__name__)
+
+# Delays closer to on time than this all go in one bucket, and count as exactly on time
+on_time_seconds = 30
+# Delays further out than this are counted as this (6 hours)
+max_delay_seconds = 6 * 60 * 60
+
+
+class DelaySketch:
+    """
+    The delays for one line or stop, as decayed counts in buckets that are relative_accuracy wide either side of their middle.
+    Bucket 0 is on time, bucket n > 0 is late by about gamma ** n seconds, and bucket -n early by the same.
+    """
+
+    def __init__(self, gamma):
+        self.gamma = gamma
+        self.log_gamma = math.log(gamma)
+        self.buckets = {}  # bucket -> weight
+        self.weight = 0.0
+        self.weighted_sum = 0.0
+        self.late_weight = 0.0
+        self.max_bucket = math.ceil(math.log(max_delay_seconds) / self.log_gamma)
+
+    def bucket(self, delay_seconds):
+        if abs(delay_seconds) < on_time_seconds:
+            return 0
+        bucket = min(math.ceil(math.log(abs(delay_seconds)) / self.log_gamma), self.max_bucket)
+        return bucket if delay_seconds > 0 else -bucket
+
+    def bucket_value(self, bucket):
+        if bucket == 0:
+            return 0
+        # The middle of the bucket (in relative terms), so anything in it is within relative_accuracy
+        value = 2 * self.gamma ** abs(bucket) / (self.gamma + 1)
+        return value if bucket > 0 else -value
+
+    def add(self, delay_seconds, weight, late):
+        bucket = self.bucket(delay_seconds)
+        self.buckets[bucket] = self.buckets.get(bucket, 0.0) + weight
+        self.weight += weight
+        self.weighted_sum += weight * max(-max_delay_seconds, min(delay_seconds, max_delay_seconds))
+        if late:
+            self.late_weight += weight
+
+    def quantile(self, q):
+        target = q * self.weight
+        running = 0.0
+        for bucket in sorted(self.buckets):
+            running += self.buckets[bucket]
+            if running >= target:
+                return self.bucket_value(bucket)
+        return self.bucket_value(max(self.buckets))
+
+    def scale(self, factor):
+        for bucket in self.buckets:
+            self.buckets[bucket] *= factor
+        self.weight *= factor
+        self.weighted_sum *= factor
+        self.late_weight *= factor
+
+
+class DelayTracker:
+    """
+    Delay statistics for every line and stop that's been polled.
+
+    Args:
+        half_life_seconds (float): How long until a service counts for half as much.
+        late_seconds (float): A service leaving more than this much later than planned counts as late (for late_percent).
+        relative_accuracy (float): How close the percentiles are to the real ones (0.02 is within 2%).
+    """
+
+    def __init__(self, half_life_seconds=1800, late_seconds=300, relative_accuracy=0.02):
+        self.half_life_seconds = half_life_seconds
+        self.late_seconds = late_seconds
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.line_sketches = {}  # "mode|line" (e.g., "train|T1") -> DelaySketch
+        self.stop_sketches = {}  # stop ID -> DelaySketch
+        # Services that haven't left yet: key -> (departure_time, stop_id, "mode|line", delay_seconds), with a heap of when they leave
+        # (entries for a departure time that has since changed are skipped when they come off the heap)
+        self.upcoming = {}
+        self.leaving = []
+        # Services already counted: key -> when they left, so one still coming back from the API after it was counted (e.g., its
+        # estimate slipped again after it was due) isn't counted twice. Forgotten an hour after they left
+        self.counted = {}
+        # Weights are 2 ** ((when - landmark) / half life), and every sketch is scaled down and the landmark moved on before they
+        # get too big for a float to hold exactly
+        self.landmark = None
+
+    def update(self, departures, now):
+        """
+        Take the departures from one poll of a stop. Only realtime departures (that have an estimated time) are counted.
+        """
+        for departure in departures:
+            estimated_time = departure.get("departure_time_estimated")
+            planned_time = departure.get("departure_time_planned")
+            if not departure.get("isRealtimeControlled") or estimated_time is None or planned_time is None:
+                continue
+            key = (departure["stop_id"], departure.get("realtime_trip_id") or departure["line"], planned_time)
+            if key in self.counted:
+                continue
+            previous = self.upcoming.get(key)
+            if previous is None or previous[0] != estimated_time:
+                heapq.heappush(self.leaving, (estimated_time, key))
+            line = gtfs_static.route_key(departure["line"], departure["type_of_transport"])
+            self.upcoming[key] = (estimated_time, departure["stop_id"], line, estimated_time - planned_time)
+        self.count_departed(now)
+
+        cutoff = now - 3600
+        for key in [key for key, departure_time in self.counted.items() if departure_time < cutoff]:
+            del self.counted[key]
+
+    def count_departed(self, now):
+        """
+        Add every service that has left by now to its line's and stop's sketches.
+        """
+        while self.leaving and self.leaving[0][0] <= now:
+            departure_time, key = heapq.heappop(self.leaving)
+            service = self.upcoming.get(key)
+            if service is None or service[0] != departure_time:
+                continue  # Its estimate changed since this was added
+            del self.upcoming[key]
+            self.counted[key] = departure_time
+            _, stop_id, line, delay_seconds = service
+
+            weight = self.weight(departure_time)
+            late = delay_seconds > self.late_seconds
+            for sketches, name in ((self.line_sketches, line), (self.stop_sketches, stop_id)):
+                sketch = sketches.get(name)
+                if sketch is None:
+                    sketch = sketches[name] = DelaySketch(self.gamma)
+                sketch.add(delay_seconds, weight, late)
+
+    def weight(self, when):
+        if self.landmark is None:
+            self.landmark = when
+        self.move_landmark(when)
+        return 2.0 ** ((when - self.landmark) / self.half_life_seconds)
+
+    def move_landmark(self, when):
+        """
+        Move the landmark up to when, if it's far enough behind that weights relative to it could get too big for a float - everything
+        so far is scaled down to match, and anything that has decayed to next to nothing is forgotten.
+        """
+        half_lives = (when - self.landmark) / self.half_life_seconds
+        if half_lives <= 60:
+            return
+        factor = 2.0 ** -half_lives  # Underflows to 0 after a long enough gap, which just forgets everything
+        for sketches in (self.line_sketches, self.stop_sketches):
+            for name in list(sketches):
+                sketches[name].scale(factor)
+                if sketches[name].weight < 1e-6:
+                    del sketches[name]
+        self.landmark = when
+
+    def sketch_stats(self, sketch, now):
+        # Every weight is relative to the landmark, so this is how much one service leaving now counts
+        now_weight = 2.0 ** ((now - self.landmark) / self.half_life_seconds)
+        services = sketch.weight / now_weight
+        if services < 0.5:
+            return None  # Hardly anything recently, so the numbers wouldn't mean much
+        return {
+            "services": round(services),
+            "mean_delay_seconds": round(sketch.weighted_sum / sketch.weight),
+            "p50_delay_seconds": round(sketch.quantile(0.5)),
+            "p90_delay_seconds": round(sketch.quantile(0.9)),
+            "p99_delay_seconds": round(sketch.quantile(0.99)),
+            "late_percent": round(100 * sketch.late_weight / sketch.weight, 1),
+        }
+
+    def stats(self, now, lines=None, stop_ids=None):
+        """
+        The delay statistics for some lines and stops.
+
+        Args:
+            now (float): The current unix timestamp.
+            lines (list): The lines to include, as "mode|line" (see gtfs_static.route_key), or None for every line.
+            stop_ids (list): The stops to include, or None for every stop.
+
+        Returns:
+            dict: {"lines": {"mode|line": stats}, "stops": {stop_id: stats}}, where stats is {"services", "mean_delay_seconds",
+            "p50_delay_seconds", "p90_delay_seconds", "p99_delay_seconds", "late_percent"}. services is roughly how many services
+            the stats are from (older ones counting for less). Lines and stops without any recent services are left out.
+        """
+        self.count_departed(now)
+        result = {"lines": {}, "stops": {}}
+        if self.landmark is None:
+            return result
+        # Nothing may have left for a long time (e.g., overnight), so the landmark could be a long way behind now
+        self.move_landmark(now)
+        for sketches, names, output in ((self.line_sketches, lines, result["lines"]), (self.stop_sketches, stop_ids, result["stops"])):
+            for name in (sketches if names is None else names):
+                sketch = sketches.get(name)
+                summary = self.sketch_stats(sketch, now) if sketch is not None else None
+                if summary is not None:
+                    output[name] = summary
+        return result
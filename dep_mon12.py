@@ -1,12 +1,185 @@
+import argparse
+import logging
 import requests
+from requests.adapters import HTTPAdapter
 import time
-from datetime import datetime, timezone
+from datetime import datetime
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from collections import deque
+import hashlib
+import heapq
 import json
+import multiprocessing
 import pprint
+import threading
+import zlib
+
+import board_server
+import delay_stats
+import departure_history
+import gtfs_realtime
+import gtfs_static
+import gtfs_timetable
+import metrics
+import replay
+import request_governor
+import service_alerts
+import station_search
+import stop_locations
 
 # Variables to be set by the user
 API_KEY = "put your API key here"
 
+# Where the Transport for NSW trip planner API is. Only needs changing to point at something else, like the mock API in mock_api.py
+api_base_url = "https://api.transport.nsw.gov.au/v1/tp"
+
+# How many API requests are allowed to be in flight at the same time when fetching departures.
+# Every (stop, mode) pair is fetched in parallel, so a refresh only takes as long as the slowest single request.
+max_concurrent_requests = 8
+
+# Split the stops between this many worker processes, each fetching and parsing its own share (with up to max_concurrent_requests
+# requests at a time each), so parsing hundreds of stops can use more than one CPU core. Each worker gets an equal share of
+# api_requests_per_second and api_daily_quota, and if one crashes only its own stops miss out (it's restarted for the next refresh).
+# --replay and --record work in the workers too, but metrics don't, so it's all done in this process while metrics are turned on.
+# Not used with departure_source "gtfs_realtime" either - every stop reads the same few feeds, so each worker would download and
+# decode all of them for itself.
+# 0 to do everything in this process.
+poll_worker_processes = 0
+# A worker that hasn't sent its stops back after this many output refreshes (output_refresh_in_seconds) is given up on - its stops
+# fall back to their stale or timetabled departures, and the worker is stopped and started again for the next refresh
+poll_worker_timeout_refreshes = 2
+
+# Get every mode at a stop with one API call and split them up afterwards, instead of one API call per mode at each stop.
+# Uses less of the API quota, set to False to go back to one call per (stop, mode).
+batch_modes_per_stop = True
+
+# Stop IDs found using the stop_finder API are saved here, so they don't need to be looked up again every time the script starts.
+# Stop IDs hardly ever change, so only look them up again once they're older than stop_id_cache_ttl_days.
+# Run with --refresh-stop-cache to ignore the cache and look every station up again.
+stop_id_cache_path = "stop_id_cache.json"
+stop_id_cache_ttl_days = 30
+
+# The Transport for NSW API quota (the free plan allows 5 requests a second and 60,000 a day). Every API call waits its turn to stay
+# within these, however high max_concurrent_requests is. None for no limit.
+api_requests_per_second = 5
+api_daily_quota = 60000
+# Failed requests (timeouts, 429s and 5xx errors) are retried on their own this many times, waiting a random and increasing amount of
+# time in between (or as long as the API's Retry-After header asks). If an endpoint fails api_circuit_failure_threshold times in a row,
+# it's left alone for api_circuit_reset_seconds before being tried again. See request_governor.py
+max_request_retries = 3
+api_circuit_failure_threshold = 5
+api_circuit_reset_seconds = 60
+
+# If a stop's departure_mon response is exactly the same as last time (common for quiet stops), reuse the departures parsed from it last
+# time instead of decoding and parsing it all again. Set to False to always parse every response.
+reuse_unchanged_responses = True
+
+# Where departures come from:
+#   "departure_mon" - one trip planner API call per stop (or per stop and mode), the original way
+#   "gtfs_realtime" - the GTFS-Realtime TripUpdates feeds, which cover a whole mode each. One call per mode however many stops there
+#                     are, so better for lots of stops. Needs the GTFS index (gtfs_index_path) for line names, destinations and platforms,
+#                     and each stop's GTFS stop ID (see gtfs_stop_id below). There's no occupancy this way, and no alerts unless
+#                     service_alerts_source is "add_info".
+# See gtfs_realtime.py
+departure_source = "departure_mon"
+gtfs_realtime_base_url = "https://api.transport.nsw.gov.au"
+# The feeds to read for each mode (a mode with more than one feed has all of them read)
+gtfs_realtime_feeds = {
+    "train": ["v2/gtfs/realtime/sydneytrains"],
+    "metro": ["v2/gtfs/realtime/metro"],
+    "light_rail": ["v1/gtfs/realtime/lightrail/cbdandsoutheast", "v1/gtfs/realtime/lightrail/innerwest", "v1/gtfs/realtime/lightrail/parramatta"],
+    "bus": ["v1/gtfs/realtime/buses"],
+    "ferry": ["v1/gtfs/realtime/ferries/sydneyferries"],
+}
+# Each feed is fetched again once it's older than this (the feeds themselves update about every 15-30 seconds)
+gtfs_realtime_refresh_seconds = 30
+# With the GTFS timetable (gtfs_timetable_path), the gtfs_realtime departures start from the scheduled ones, so trips the feeds only
+# give a delay for (or don't mention at all) are still shown. Trips scheduled up to this long ago are looked up too, in case they're
+# running late and haven't left yet
+gtfs_realtime_max_delay_minutes = 60
+
+# Where the alerts shown with each departure come from:
+#   "departure_mon" - the alerts sent with each departure, the original way. Each different alert is only classified once, however
+#                     many departures it's sent with
+#   "add_info"      - every current alert on the network, from one add_info call per refresh (at most every
+#                     service_alerts_refresh_seconds), matched to departures by their mode, line and stop. Departures from the TripUpdates
+#                     feeds and the timetable get alerts this way too. If a call fails, the alerts from the last one that worked are kept
+# See service_alerts.py
+service_alerts_source = "departure_mon"
+service_alerts_refresh_seconds = 60
+
+# Each stop is refreshed on its own schedule, somewhere between these two (busy stops more often, quiet stops less often)
+min_poll_interval_seconds = 20
+max_poll_interval_seconds = 300
+# The most API calls to make in any one minute, across all stops
+max_requests_per_minute = 30
+# If a stop's requests keep failing, keep showing its last good departures (marked as stale) for up to this long
+max_stale_seconds = 15 * 60
+# The terminal and JSON output are updated at least this often, even if no stops needed polling
+output_refresh_in_seconds = 30
+
+# Where to write output.json (when not serving the board)
+output_path = r"C:\Users\Matth\OneDrive\Personal\Projects\Programming\TFNSW\output.json"
+
+# Serve the board (index.html, output.json and live updates) from this script instead of writing output.json to disk.
+# Can also be turned on with --serve. See board_server.py
+serve_board = False
+server_port = 8080
+
+# Limits on what's shown on the board - None means no limit
+max_departures = None  # e.g., 20 - the most departures to show in total
+max_minutes_until_departure = None  # e.g., 60 - don't show anything leaving later than this
+max_departures_per_stop = None  # e.g., 8 - so one busy stop doesn't fill the whole board
+max_departures_per_mode = None  # e.g., {"bus": 10, "train": 8}
+
+# Exact line colours and platform names from the GTFS timetable, if you've built the index (python gtfs_static.py build <GTFS zip> gtfs_index.bin)
+# If the file doesn't exist, the colours and platforms are worked out from the line names and platform codes instead.
+gtfs_index_path = "gtfs_index.bin"
+
+# Scheduled departures from the GTFS timetable, shown for a stop whose departures can't be fetched (the API is down, or the daily quota
+# has run out) instead of it going blank once its last good departures are too old. Build it with
+# python gtfs_timetable.py build <GTFS zip> gtfs_timetable.bin (see gtfs_timetable.py). They're shown as timetabled, not realtime.
+# With departure_source "gtfs_realtime", it's also what the feeds' delays are added to (see gtfs_realtime_max_delay_minutes).
+# The timetable uses GTFS stop IDs, which are the same as the trip planner's for most stops but not for stations (e.g., Central is
+# 10101100 in the trip planner and 200060 in GTFS) - give a station its GTFS one with "gtfs_stop_id" in preconfigured_stops
+gtfs_timetable_path = "gtfs_timetable.bin"
+timetable_departures_per_stop = 20
+
+# Set up the board from every stop near a location, instead of typing in station names - no API calls needed. Build the list of stops
+# with python stop_locations.py build <GTFS zip> stop_locations.json (see stop_locations.py), then run with e.g.
+# --near -33.8832,151.2070 --radius 400 --modes train,bus, or give a board {"near": [-33.8832, 151.2070], "radius_metres": 400,
+# "modes": ["train", "bus"]} as its stops. The stops found use their GTFS stop IDs, which departure_mon accepts too.
+# Station names typed in are looked up in the same file first (see station_search.py), picking the best match that every mode asked
+# for actually stops at - names it can't find (or with no one stop for all their modes) are looked up with the stop_finder API
+stop_locations_path = "stop_locations.json"
+
+# How much to print - "DEBUG" also shows every step of looking up, fetching and parsing each stop, "WARNING" only shows problems.
+# Can also be set with --log-level
+log_level = "INFO"
+
+# Time each part of every refresh (API requests, response sizes, JSON decoding, parsing each stop, building the output) - see metrics.py.
+# The timings are served in Prometheus format at /metrics when serving the board, and saved as JSON to metrics_stats_path (if it's
+# set) after every refresh. Off by default, and then the timers do nothing. Can also be turned on with --metrics or --stats-file
+collect_metrics = False
+metrics_stats_path = None  # e.g., "stats.json"
+
+# Keep every departure fetched (trip, stop, line, planned and estimated times, delay, occupancy) in this SQLite database, to look at
+# punctuality over weeks or months with python departure_history.py summary history.sqlite. Written in the background, so it doesn't
+# slow down refreshing. None to not keep any history. Can also be set with --history
+history_path = None  # e.g., "history.sqlite"
+
+# Rolling delay statistics for each line and stop (average delay, median, 90th and 99th percentile, and how many are more than
+# delay_stats_late_minutes late), added to output.json as "delay_stats" so the board can show e.g. "T1 running ~6 min late".
+# Each realtime service counts once, when it leaves, and older services count for less - half as much every
+# delay_stats_half_life_minutes. Only added with output_format_version 2
+collect_delay_stats = True
+delay_stats_half_life_minutes = 30
+delay_stats_late_minutes = 5
+
+# output.json format - 2 stores each stop, line and alert once and refers to them from each departure (much smaller),
+# 1 is the original plain list of departures. index.html can read either.
+output_format_version = 2
+
 # You can hardcode stops instead of using the user input
 # 1 = Train, 2 = Metro, 4 = Light Rail, 5 = Bus, 7 = Coach, 9 = Ferry, 11 = School Bus
 preconfigured_stops = None # comment out if you wan't to hard code in stops
@@ -14,6 +187,7 @@ preconfigured_stops = None # comment out if you wan't to hard code in stops
 #     {
 #         "station_name": "Parramatta",
 #         "stop_id": "10101229",
+#         "gtfs_stop_id": "215020",  # optional - only needed for departure_source = "gtfs_realtime" and the timetable fallback
 #         "modes": [
 #             {
 #                 "mode_name": "train",
@@ -53,8 +227,96 @@ preconfigured_stops = None # comment out if you wan't to hard code in stops
 # ]
 
 
+# Several boards (e.g., different screens) from one copy of this script. Each board has its own stops - either in the same format as
+# preconfigured_stops, a string in the same format as the input() prompt, or every stop near a location (see stop_locations_path) - and its own output file (or /boards/{name}/ with --serve).
+# Stops that are on more than one board are only fetched once, with the modes and routes_to_exclude applied separately for each board,
+# so the API calls only go up with the number of different stops, not the number of boards.
+# Can also be loaded from a JSON file with --boards. None for the one board from preconfigured_stops or the input() prompt.
+boards = None
+# boards = {
+#     "concourse": {
+#         "stops": "Parramatta (train, bus); Parramatta Square (light_rail)",
+#         "output_path": "output_concourse.json",
+#     },
+#     "wharf": {
+#         "stops": [
+#             {"station_name": "Parramatta Wharf", "stop_id": "10102032", "modes": [{"mode_name": "ferry", "mode_number": 9}]},
+#             {"station_name": "Parramatta", "stop_id": "10101229", "modes": [{"mode_name": "bus", "mode_number": 5, "routes_to_exclude": ["600", "601"]}]},
+#         ],
+#         "output_path": "output_wharf.json",
+#     },
+#     "street": {
+#         "stops": {"near": [-33.8150, 151.0011], "radius_metres": 300, "modes": ["bus"]},
+#         "output_path": "output_street.json",
+#     },
+# }
+
+
 #######################################################################################################################################
 
+log = logging.getLogger("dep_mon12")
+
+# One shared session for every API call, so connections to api.transport.nsw.gov.au are kept alive and reused between requests and refreshes.
+# The pool is sized to match max_concurrent_requests so parallel requests don't have to wait for (or throw away) a connection.
+http_session = requests.Session()
+# Ask for compressed responses - departure_mon responses are mostly repeated JSON keys and alert text, so they shrink a lot
+http_session.headers["Accept-Encoding"] = "gzip, deflate"
+
+
+def mount_connection_pool():
+    """
+    Size http_session's connection pool to max_concurrent_requests. Call again if max_concurrent_requests is changed after starting.
+    """
+    # http too, in case api_base_url points at a local server
+    for prefix in ("https://", "http://"):
+        http_session.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrent_requests))
+
+
+mount_connection_pool()
+
+# Set by --replay and --record (see replay.py)
+replay_path = None
+record_path = None
+
+
+def mount_replay_and_record():
+    """
+    Answer http_session's requests from the recordings in replay_path, and save every response to record_path, if they're set.
+    """
+    if replay_path:
+        http_session.mount("https://", replay.ReplayAdapter(replay_path))
+    if record_path:
+        replay.record_responses(http_session, record_path)
+
+
+# Every stop_finder and departure_mon call goes through this, so they share the same rate limit, quota and retries
+api_governor = None
+
+
+def configure_request_governor():
+    """
+    Set up api_governor from the settings above. Call again if any of them are changed after starting.
+    """
+    global api_governor
+    api_governor = request_governor.RequestGovernor(
+        http_session,
+        requests_per_second=api_requests_per_second,
+        daily_quota=api_daily_quota,
+        max_retries=max_request_retries,
+        breaker_failure_threshold=api_circuit_failure_threshold,
+        breaker_reset_seconds=api_circuit_reset_seconds,
+        on_request=request_sent,
+    )
+
+
+def request_sent():
+    # Every request the governor sends (retries, add_info and stop_finder calls included) counts towards max_requests_per_minute
+    recent_request_times.append(time.time())
+
+
+configure_request_governor()
+
+
 def get_station_ids_from_station_names_and_modes(user_input):
     """
     
@@ -79,10 +341,10 @@ def get_station_ids_from_station_names_and_modes(user_input):
         }
     ]
     
-    stop_id will be None for now, as we will get it from the API later.
+    stop_id will be None for now, as we will get it from the station index (or the API) later.
     We will use a lookup table to map the mode numbers to the mode names so the user doesn't have to remember them.
     
-    We'll need to take into account the confidence of the API response - e.g., might just use the best match.
+    Each station gets the best match that serves the modes asked for, and any of its modes that don't stop there are left out.
     """
     
     # Step 0 - set up
@@ -104,7 +366,7 @@ def get_station_ids_from_station_names_and_modes(user_input):
     list_of_stations_with_modes = user_input.split(";")
     # remove leading and trailing whitespace from each station
     list_of_stations_with_modes = [station.strip() for station in list_of_stations_with_modes]
-    # print(f"List of provided stations with modes: {list_of_stations_with_modes}")
+    log.debug("List of provided stations with modes: %s", list_of_stations_with_modes)
     
     # for each station inside list_of_stations_with_modes, get the modes of transport inside the brackets
     for i, station in enumerate(list_of_stations_with_modes):
@@ -126,119 +388,257 @@ def get_station_ids_from_station_names_and_modes(user_input):
                 } for mode in modes
             ]
         }
-        # print(f"Station: {station_name.strip()}, Modes: {modes}")
+        log.debug("Station: %s, Modes: %s", station_name.strip(), modes)
+    
+    # Step 2 - get the stop IDs for each station from the station index if there is one (no API calls), otherwise from the cache if
+    # we've looked them up before, otherwise from the API
+
+    station_index = station_search.load_station_index(stop_locations_path)
+    stop_id_cache = load_stop_id_cache()
+    now = time.time()
+    stations_to_look_up = []
+    
+    for station in list_of_stations_with_modes:
+        mode_names = [mode["mode_name"] for mode in station["modes"]]
+        match = station_index.resolve(station["station_name"], mode_names) if station_index is not None else None
+        if match is not None:
+            log.info(f"Found '{station['station_name']}' in the station index: {match['station_name']} ({match['stop_id']})")
+            # The index is from the GTFS stops, so its stop IDs are the GTFS ones (which departure_mon accepts too). It only matches
+            # a stop that serves every mode asked for, so none of them need dropping
+            station["stop_id"] = match["stop_id"]
+            station["gtfs_stop_id"] = match["stop_id"]
+            continue
+        
+        cache_key = stop_id_cache_key(station["station_name"], mode_names)
+        cached = stop_id_cache.get(cache_key)
+        # Use the cached stop_id if it hasn't expired (and we haven't been asked to refresh everything)
+        if not refresh_stop_id_cache and cached is not None and now - cached["resolved_at"] < stop_id_cache_ttl_days * 24 * 60 * 60:
+            log.debug("Using cached stop ID %s for '%s'", cached["stop_id"], station["station_name"])
+            station["stop_id"] = cached["stop_id"]
+            drop_unavailable_modes(station, [type_lookup_table.get(mode_number) for mode_number in cached.get("available_modes") or []])
+        else:
+            stations_to_look_up.append((cache_key, station))
+
+    # Step 3 - call the API for any stations that weren't in the index or the cache, all at the same time
+
+    if stations_to_look_up:
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrent_requests)) as pool:
+            results = list(pool.map(
+                find_stop_id,
+                [station["station_name"] for _, station in stations_to_look_up],
+                [[mode["mode_number"] for mode in station["modes"]] for _, station in stations_to_look_up],
+            ))
+        
+        for (cache_key, station), result in zip(stations_to_look_up, results):
+            if result is None:
+                continue  # Couldn't find it - stop_id stays as None and it won't be cached
+            station["stop_id"] = result["stop_id"]
+            drop_unavailable_modes(station, [type_lookup_table.get(mode_number) for mode_number in result["available_modes"] or []])
+            result["station_name"] = station["station_name"]
+            result["resolved_at"] = now
+            stop_id_cache[cache_key] = result
+        
+        save_stop_id_cache(stop_id_cache)
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("List of stations with modes after API call:\n%s", pprint.pformat(list_of_stations_with_modes))
+    return list_of_stations_with_modes
+
+
+def drop_unavailable_modes(station, available_mode_names):
+    """
+    Take any modes that don't stop at the station out of station["modes"], e.g., "Parramatta (train, ferry)" only gets the trains
+    at Parramatta Station. If none of them stop there (or we don't know which do), they're all left in.
+    """
+    available = [mode for mode in station["modes"] if mode["mode_name"] in available_mode_names]
+    if not available:
+        return
+    for mode in station["modes"]:
+        if mode not in available:
+            log.warning(f"No {mode['mode_name']} services stop at '{station['station_name']}' ({station['stop_id']}), leaving them out")
+    station["modes"] = available
+
+
+def get_stations_near(latitude, longitude, radius_metres, mode_names=None):
+    """
+    Every stop within radius_metres of a location, from the stop locations file (see stop_locations_path) rather than the API.
+    
+    Args:
+        latitude (float): e.g., -33.8832
+        longitude (float): e.g., 151.2070
+        radius_metres (float): How far away to look.
+        mode_names (list): Only these modes (e.g., ["train", "bus"]). None or empty for every mode.
+    
+    Returns:
+        list: The stops, nearest first, in the same format as get_station_ids_from_station_names_and_modes() - each with only the
+        wanted modes that actually use it.
+    """
+    locations = stop_locations.load_stop_locations(stop_locations_path)
+    if locations is None:
+        log.error(f"No stop locations at {stop_locations_path} - build them with: python stop_locations.py build <GTFS zip> {stop_locations_path}")
+        return []
+    
+    mode_numbers = {type_of_transport: mode_number for mode_number, type_of_transport in type_lookup_table.items()}
+    stations = [
+        {
+            "station_name": stop["station_name"],
+            "stop_id": stop["stop_id"],
+            "gtfs_stop_id": stop["stop_id"],
+            "modes": [{"mode_name": mode, "mode_number": mode_numbers.get(mode)} for mode in stop["modes"]],
+        }
+        for stop in locations.stops_within(latitude, longitude, radius_metres, set(mode_names) if mode_names else None)
+    ]
+    log.info(f"Found {len(stations)} stops within {radius_metres:g}m of {latitude}, {longitude}")
+    for station in stations:
+        log.debug("%s (%s): %s", station["station_name"], station["stop_id"], [mode["mode_name"] for mode in station["modes"]])
+    return stations
+
+
+def find_stop_id(station_name, mode_numbers=None):
+    """
+    Global args:
+        API_KEY (str): API key for the Transport for NSW API.
     
-    # Step 2 - call the API to get the stop IDs for each station
+    Args:
+        station_name (str): The station name to search for using the stop_finder API.
+        mode_numbers (list): The modes wanted (e.g., [1, 5]) - the location that serves the most of them is picked, then the
+            API's best match, then the highest match quality.
     
+    Returns:
+        dict: {"stop_id": ..., "match_quality": ..., "available_modes": [...]}, or None if the station couldn't be found.
+    """
     # Define the API endpoint and headers
-    endpoint = "https://api.transport.nsw.gov.au/v1/tp/stop_finder"
+    endpoint = f"{api_base_url}/stop_finder"
     headers = {
         "Authorization": f"apikey {API_KEY}",
         "Content-Type": "application/json"
     }
     
-    # pprint the list_of_stations_with_modes to check structure
-    # print(f"List of stations with modes:")
-    # pprint.pprint(list_of_stations_with_modes)
-
-    # Step 3 - transform the data
+    # Define the query parameters
+    params = {
+        "outputFormat": "rapidJSON",
+        "type_sf": "stop",
+        "name_sf": station_name,
+        "coordOutputFormat": "EPSG:4326",
+        "TfNSWSF": "true",
+        "version": "10.2.1.42"
+    }
 
-    # for each station in the list, get the stop_id using the API
-    for station in list_of_stations_with_modes:
-        # Define the query parameters
-        params = {
-            "outputFormat": "rapidJSON",
-            "type_sf": "stop",
-            "name_sf": station["station_name"],
-            "coordOutputFormat": "EPSG:4326",
-            "TfNSWSF": "true",
-            "version": "10.2.1.42"
+    result = None
+    best_rank = None
+    wanted_modes = {mode_number for mode_number in mode_numbers or [] if mode_number is not None}
+    try:
+        # Make the API request
+        log.debug("Fetching the stop ID for '%s'...", station_name)
+        response = api_governor.get("stop_finder", endpoint, headers=headers, params=params)
+
+        # Check if the response is successful
+        if response.status_code != 200:
+            log.error(f"Error: {response.status_code} for station '{station_name}'")
+            log.error(response.text)
+            return None
+
+        # Parse the JSON response
+        stop_finder_data = response.json()
+        
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Stop finder data for '%s':\n%s", station_name, pprint.pformat(stop_finder_data))
+        
+        '''
+        {
+            'locations': [
+                {
+                    'isBest': True,
+                    'matchQuality': 100000,
+                    'modes': [1, 5, 7, 11],
+                    'parent': {'id': '95346013|1',
+                        'name': 'Parramatta',
+                        'type': 'locality'},
+                'properties': {'stopId': '10101229'},
+                'type': 'stop'},
+                "assignedStops: [{
+                    "id": "10101708",
+                    "type": "stop",
+                    "modes": [
+                        4
+                    ],
+            ]
         }
-
-        try:
-            # print(f"****************************************")
+        '''
+        
+        for location in stop_finder_data["locations"]:
             
-            # Make the API request
-            # print(f"Fetching information for  IDs for '{station['station_name']}'...")
-            response = requests.get(endpoint, headers=headers, params=params)
-
-            # Check if the response is successful
-            if response.status_code != 200:
-                print(f"Error: {response.status_code} for station '{station['station_name']}'")
-                print(response.text)
+            log.debug("Location: %s", location.get("name"))
+        
+            # modes_in_this_stop
+            modes_in_this_stop = location.get("modes", [])
+            log.debug("Modes in this stop: %s", modes_in_this_stop)
+            
+            # Keep the location that serves the most of the modes I want, then the one the API thinks is best
+            rank = (len(wanted_modes.intersection(modes_in_this_stop)), bool(location.get("isBest")), location.get("matchQuality") or 0)
+            if best_rank is not None and rank <= best_rank:
                 continue
 
-            # Parse the JSON response
-            stop_finder_data = response.json()
+            # troubleshooting info - match quality, whether it's the best match, and the stop name
+            log.debug("Match quality: %s, is best match? %s, stop name: %s", location.get("matchQuality"), location.get("isBest"), location.get("parent", {}).get("name"))
             
-            # print(f"Stop finder data for '{station['station_name']}'")
-            # pprint.pprint(stop_finder_data)
+            # try to get the stop_id from the properties
+            try:
+                stop_id = location["properties"]["stopId"]
+                log.debug("Stop ID: %s from properties", stop_id)
+            except KeyError:
+                # otherwise get the stop_id from the 1st result in assignedStops
+                stop_id = location["assignedStops"][0]["id"]
+                log.debug("Stop ID: %s from assignedStops", stop_id)
             
-            '''
-            {
-                'locations': [
-                    {
-                        'isBest': True,
-                        'matchQuality': 100000,
-                        'modes': [1, 5, 7, 11],
-                        'parent': {'id': '95346013|1',
-                            'name': 'Parramatta',
-                            'type': 'locality'},
-                    'properties': {'stopId': '10101229'},
-                    'type': 'stop'},
-                    "assignedStops: [{
-                        "id": "10101708",
-                        "type": "stop",
-                        "modes": [
-                            4
-                        ],
-                ]
+            # for this current station, update it's stop_id with the stop_id from the API
+            log.debug("Updating stop ID for '%s' to '%s'", station_name, stop_id)
+            best_rank = rank
+            result = {
+                "stop_id": stop_id,
+                "match_quality": location.get("matchQuality"),
+                "available_modes": modes_in_this_stop,
             }
-            '''
-            
-            for location in stop_finder_data["locations"]:
-                
-                # print(f"Location: {location['name']}")
-            
-                # modes_in_this_stop
-                modes_in_this_stop = location["modes"]
-                # print(f"Modes in this stop: {modes_in_this_stop}")
-                
-                # TODO - only skip the modes which aren't available, not all modes if one of them isn't available
-                # # if the modes of transport I want aren't available at this stop, then skip it and move to the next
-                # if station["modes"][0]["mode_number"] not in modes_in_this_stop:
-                #     print(f"Skipping '{station['station_name']}' as mode {station['modes'][0]['mode_number']} is not available at this stop")
-                #     continue
-
-                # troubleshooting info
-                # print match quality
-                # print(f"Match quality: {stop_finder_data['locations'][0]['matchQuality']}")
-                # isBest? Print that value for now
-                # print(f"Is best match? {location['isBest']}")
-                # get stop name for printing
-                # print(f"Stop name: {location['parent']['name']}")
-                
-                # try to get the stop_id from the properties
-                try:
-                    stop_id = location["properties"]["stopId"]
-                    # print(f"Stop ID: {stop_id} from properties")
-                except KeyError:
-                    # otherwise get the stop_id from the 1st result in assignedStops
-                    stop_id = location["assignedStops"][0]["id"]
-                    # print(f"Stop ID: {stop_id} from assignedStops")
-                
-                # for this current station, update it's stop_id with the stop_id from the API
-                # print(f"Updating stop ID for '{station['station_name']}' to '{stop_id}'")
-                station["stop_id"] = stop_id
 
 
-        except Exception as e:
-            print(f"Error fetching station IDs for '{station['station_name']}': {e}")
+    except Exception as e:
+        log.error(f"Error fetching station IDs for '{station_name}': {e}")
 
-    # print(f"\n\n\n\n\n\n****************************************")
-    # print(f"List of stations with modes after API call:")
-    # pprint.pprint(list_of_stations_with_modes)
-    return list_of_stations_with_modes
+    return result
+
+
+def stop_id_cache_key(station_name, mode_names):
+    """
+    Stations are cached by their name and the modes that were asked for, e.g., "parramatta|bus,train".
+    The name is lower case with extra whitespace removed, so "Parramatta " and "parramatta" share the same entry.
+    """
+    normalised_name = " ".join(station_name.lower().split())
+    return f"{normalised_name}|{','.join(sorted(mode_names))}"
+
+
+def load_stop_id_cache():
+    """
+    Load the stop ID cache from stop_id_cache_path. Returns an empty cache if the file doesn't exist or can't be read.
+    """
+    try:
+        with open(stop_id_cache_path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        log.warning(f"Error reading stop ID cache, ignoring it: {e}")
+        return {}
+
+
+def save_stop_id_cache(stop_id_cache):
+    """
+    Save the stop ID cache to stop_id_cache_path.
+    """
+    try:
+        with open(stop_id_cache_path, "w") as file:
+            json.dump(stop_id_cache, file, indent=4)
+    except Exception as e:
+        log.warning(f"Error saving stop ID cache: {e}")
 
 
 # Supplementary functions
@@ -256,16 +656,21 @@ def format_platforms(platform, type_of_transport, service, platform_return_raw,
         str: The formatted platform string. E.g., "Platform 1", "Stand J", "Wharf 5 Side A", etc.
     
     
-    This function could be replaced if you were to lookup the platform code using the GTFS data - but this way also works. I don't know why the departure monitor API doesn't just give the Platform in plain text; why make you look up the code ina  lookup table?
+    If there's a GTFS index (see gtfs_static.py), the platform name is looked up from the GTFS stops using the platform's stop ID.
+    Otherwise (or if it isn't in the GTFS data) it's worked out from the platform code - I don't know why the departure monitor API doesn't just give the Platform in plain text; why make you look up the code ina  lookup table?
     
     '''
     
     if platform_return_raw:
-        # print(f"Using raw platform name: {platform_raw}")
         return platform_raw
     
+    # Use the exact platform name from the GTFS data if we have it
+    if gtfs_index is not None:
+        platform_name = gtfs_index.platform_name(service["location"].get("id"))
+        if platform_name:
+            return platform_name
+    
     if type_of_transport == "train" or type_of_transport == "metro":
-        # print(f"Train Platform before formatting: {platform}")
         # Train & metro platforms are in the format CE18 or PTA, so we need to remove the first 2-3 letters and keep the rest. Keep just the digits.
         platform_display = ''.join(filter(str.isdigit, platform))
         
@@ -275,11 +680,8 @@ def format_platforms(platform, type_of_transport, service, platform_return_raw,
             platform_display = platform_display[1:]
             
         platform_display = f"Platform {platform_display}" if platform_display else platform_display
-        # print(f"Train Platform after formatting: {platform_display}")
     
     elif type_of_transport == "ferry":
-        # print(f"Ferry Wharf before formatting: {platform}")
-        
         # If the platform is in the format F5A (letter, number, letter), 
         if len(platform) > 1 and platform[0] == "F" and platform[1].isdigit():
             # Ferry wharfs are in the format F5A, so we need to remove the first letter and keep the rest
@@ -293,17 +695,13 @@ def format_platforms(platform, type_of_transport, service, platform_return_raw,
         # If the platform is in any other form, don't return it
         else:
             platform_display = ""
-            # print(f"Ferry Wharf: {platform} - not in the correct format")
+            log.debug("Ferry Wharf: %s - not in the correct format", platform)
             
         # If at this point the Ferry Wharf/platform is just 1, then don't return it (most Ferry stops are just a single wharf with a single side)
         if platform_display == "1":
             platform_display = ""
-            
-        # print(f"Ferry Wharf after formatting: {platform_display}")
                 
     elif type_of_transport == "light_rail":
-        # print(f"Light Rail Platform before formatting: {platform}")
-
         # Extract the numeric part of the platform string
         platform_display = ''.join(filter(str.isdigit, platform))
         
@@ -313,56 +711,48 @@ def format_platforms(platform, type_of_transport, service, platform_return_raw,
         # Out of preference, we might not want to show a light rail platform
         # platform_display = ""
         
-        # print(f"Light Rail Platform after formatting: {platform_display}")
-        
     elif type_of_transport == "bus":
-        # print(f"Bus Stand before formatting: {platform}")
-        
         # Bus platforms are in the format J, so we need to keep the first letter and remove the rest
         # Format should be "Stand {platform_display}"
         platform_display = platform[0] if len(platform) > 0 else platform
         platform_display = f"Stand {platform_display}" if platform_display else platform_display
         
-        # print(f"Bus Stand after formatting: {platform_display}")
-        
-        # print(f"Bus Stand after formatting: {platform_display}")
-        
     elif type_of_transport == "coach":
-        # print(f"Coach Stand before formatting: {platform}")
-        
         # Coach locations are a bit different, we'll need to dig into location > parent > name
         # Format should just be returned unchanged
         platform_display = service["location"]["parent"].get("name", "")
         
-        # print(f"Coach Stand after formatting: {platform_display}")
-        
     else:
         # For any other mode, just keep the platform as is
         platform_display = platform
-        # print(f"Unknown platform format: {platform}")
-    
-    # print(f"Platform after formatting: {platform_display}")
+        log.debug("Unknown platform format: %s", platform)
     return platform_display
 
+# Define the base color codes - used for any line that isn't in the GTFS index (or if there is no GTFS index)
+base_colour_codes = {
+    "M1": "#168388", "T1": "#F99D1C", "T2": "#0098CD", "T3": "#F37021", "T4": "#005AA3", "T5": "#C4258F", "T6": "#7D3F21", "T7": "#6F818E", "T8": "#00954C", "T9": "#D11F2F",
+    "BMT": "#F99D1C", "CCN": "#D11F2F", "HUN": "#833134", "SHL": "#00954C", "SCO": "#005AA3", "Regional": "#F6891F",
+    "L1": "#BE1622", "L2": "#DD1E25", "L3": "#781140", "L4": "#CD0D4D", "NLR": "#EE343F",
+    "F1": "#00884B", "F2": "#144734", "F3": "#648C3C", "F4": "#BFD730", "F5": "#286142", "F6": "#00AB51", "F7": "#00B189", "F8": "#55622B", "F9": "#65B32E", "F10": "#5AB031",
+    "STKN": "#5AB031", "MFF": "#0693E3", "CCWB": "#2349E5", "CCWM": "#2349E5",
+    "Bus": "#83D0F5",
+    "B1": "#FFB81C", "Night_Bus": "#001b3d", "Train_replacement_bus": "#808080",
+    "coach": "#732A82",
+    "Default": "#000000"
+}
+
 def colour_codes(line, type_of_transport):
     """
     Determine the color codes for a given line and type of transport, with dynamic transparency.
     
-    You can use the GTFS data to get the colour codes for each line, but that requires extra files to do a lookup.
-    """
-    # Define the base color codes
-    base_colour_codes = {
-        "M1": "#168388", "T1": "#F99D1C", "T2": "#0098CD", "T3": "#F37021", "T4": "#005AA3", "T5": "#C4258F", "T6": "#7D3F21", "T7": "#6F818E", "T8": "#00954C", "T9": "#D11F2F",
-        "BMT": "#F99D1C", "CCN": "#D11F2F", "HUN": "#833134", "SHL": "#00954C", "SCO": "#005AA3", "Regional": "#F6891F",
-        "L1": "#BE1622", "L2": "#DD1E25", "L3": "#781140", "L4": "#CD0D4D", "NLR": "#EE343F",
-        "F1": "#00884B", "F2": "#144734", "F3": "#648C3C", "F4": "#BFD730", "F5": "#286142", "F6": "#00AB51", "F7": "#00B189", "F8": "#55622B", "F9": "#65B32E", "F10": "#5AB031",
-        "STKN": "#5AB031", "MFF": "#0693E3", "CCWB": "#2349E5", "CCWM": "#2349E5",
-        "Bus": "#83D0F5",
-        "B1": "#FFB81C", "Night_Bus": "#001b3d", "Train_replacement_bus": "#808080",
-        "coach": "#732A82",
-        "Default": "#000000"
-    }
-
+    The colour comes from the GTFS data if there's a GTFS index (see gtfs_static.py), otherwise it's worked out from the line name.
+    """
+    # Use the exact colour from the GTFS data if we have it
+    if gtfs_index is not None:
+        colour = gtfs_index.line_colour(line, type_of_transport)
+        if colour:
+            return colour
+    
     # Determine the line type
     if type_of_transport == "coach":
         line = "Coach" # Coach 'lines' are always different, but they all just get the same colour codes. S make line == type; don't bother doing anything fancy with the line variable.
@@ -385,36 +775,63 @@ def colour_codes(line, type_of_transport):
 
     # Get the base colors for the line
     colors = base_colour_codes.get(line, base_colour_codes["Default"])
-    
-    # print(f"Line: {line}, Colors: {colors}")
 
     return colors
 
 
-# Function that gets the departures for a specific transport type
+class APIError(Exception):
+    """
+    The Transport for NSW API responded with an error.
+    """
 
-def get_departures(stop_name, stop_id, modes_of_transport, routes_to_exclude):
+
+# Will be used later to map the type of transport to a more readable format for the JSON output and defining the accent colours
+# These are the stopEvents > transportation > product > class numbers, which are also the numbers used in the exclMOT_ parameters
+type_lookup_table = {
+    1: "train",
+    2: "metro",
+    4: "light_rail",
+    5: "bus",
+    7: "coach",
+    9: "ferry",
+    11: "school_bus"
+}
+
+
+def fetch_departure_data(stop_id, mode_names):
     """
     Global args:
         API_KEY (str): API key for the Transport for NSW API.
     
     Args:
-        stop_name (str): used to remove 'via' from the destination name if it is the same as the stop name.
         stop_id (str): The ID of the stop to get departures from.
-        modes_of_transport (list): List of transport modes to include (e.g., ["train", "bus", "ferry"]).
-        routes_to_exclude (list): List of routes to exclude from the results. Just really used for busses.
+        mode_names (list): List of mode names to include in the response (e.g., ["train", "bus"]). Every other mode is excluded.
         
     Returns:
-        list: List of departures with relevant details.
+        dict: The decoded departure_mon response, or None if it didn't have any stopEvents.
     
-    Get departures for a specific transport type.
+    Raises:
+        APIError: If the API didn't respond with a 200.
+    """
+    return decode_departure_data(fetch_departure_response(stop_id, mode_names), stop_id, mode_names)
+
+
+def fetch_departure_response(stop_id, mode_names):
+    """
+    Same as fetch_departure_data, but returns the response body without decoding it.
+    
+    Returns:
+        bytes: The raw departure_mon response body.
+    
+    Raises:
+        APIError: If the API didn't respond with a 200.
     """
     # Get the current date and time at the time of the API call
     current_date = datetime.now().strftime("%Y%m%d")
     current_time = datetime.now().strftime("%H%M")
 
     # Base endpoint URL without query parameters
-    endpoint = "https://api.transport.nsw.gov.au/v1/tp/departure_mon"
+    endpoint = f"{api_base_url}/departure_mon"
 
     # Set up headers
     headers = {
@@ -437,114 +854,245 @@ def get_departures(stop_name, stop_id, modes_of_transport, routes_to_exclude):
         "excludedMeans": "checkbox",
         "includeNonPassengerTrips": "false",
     }
-
-    # Will be used later to map the type of transport to a more readable format for the JSON output and defining the accent colours
-    type_lookup_table = {
-        1: "train",
-        2: "metro",
-        4: "light_rail",
-        5: "bus",
-        7: "coach",
-        9: "ferry",
-        11: "school_bus"
-    }
     
     # The API specifies which modes to EXCLUDE, not include, so assume we wan't to exclude all then remove the ones from exluded_modes we want to keep.
     
-    # Start by assuming we'll exclude all modes of transport
-    excluded_modes = [
-        "exclMOT_1",  # Exclude trains
-        "exclMOT_2",  # Exclude metro
-        "exclMOT_4",  # Exclude light rail
-        "exclMOT_5",  # Exclude bus
-        "exclMOT_7",  # Exclude coach
-        "exclMOT_9",  # Exclude ferry
-        "exclMOT_11"  # Exclude school bus
-    ]
+    # Start by assuming we'll exclude all modes of transport (exclMOT_1 = trains, exclMOT_5 = buses, etc. - see type_lookup_table)
+    # then actually don't exclude modes we want to keep
+    excluded_modes = [f"exclMOT_{mode_number}" for mode_number, type_of_transport in type_lookup_table.items() if type_of_transport not in mode_names]
 
-    # print(f"Modes I want to keep: {modes_of_transport}")
-    # print(f"Excluded modes before un-excluding: {excluded_modes}")
-
-    # Actually don't exclude modes we want to keep
-    mode_name = modes_of_transport["mode_name"]
-    if mode_name == "train":
-        excluded_modes.remove("exclMOT_1")  # Keep trains
-    elif mode_name == "metro":
-        excluded_modes.remove("exclMOT_2")  # Keep metros
-    elif mode_name == "light_rail":
-        excluded_modes.remove("exclMOT_4")  # Keep light rails
-    elif mode_name == "bus":
-        excluded_modes.remove("exclMOT_5")  # Keep buses
-    elif mode_name == "coach":
-        excluded_modes.remove("exclMOT_7")  # Keep coaches
-    elif mode_name == "ferry":
-        excluded_modes.remove("exclMOT_9")  # Keep ferries
-    elif mode_name == "school_bus":
-        excluded_modes.remove("exclMOT_11")  # Keep school buses
-
-    # print(f"Excluded modes after un-excluding: {excluded_modes}")
+    log.debug("Modes I want to keep: %s", mode_names)
+    log.debug("Excluded modes: %s", excluded_modes)
 
     # Add exclusion parameters
     for mode in excluded_modes:
         params[mode] = "true"
 
-    response = requests.get(endpoint, headers=headers, params=params)
-    departures = []
+    response = api_governor.get("departure_mon", endpoint, headers=headers, params=params)
 
     if response.status_code != 200:
-        print(f"Error: {response.status_code}")
-        print(response.text)
-        return departures  # Early return if the response is not successful
+        # Raise rather than return nothing, so the stop's last good departures are kept rather than it vanishing from the board
+        raise APIError(f"HTTP {response.status_code}: {response.text[:200]}")
+
+    return response.content
 
-    data = response.json()
+
+def decode_departure_data(body, stop_id, mode_names):
+    """
+    Decode a departure_mon response body.
+    
+    Returns:
+        dict: The decoded response, or None if it didn't have any stopEvents.
+    """
+    with metrics.timed("json_decode_seconds"):
+        data = json.loads(body)
     if "stopEvents" not in data:
-        print(f"'stopEvents' not found in response for stop ID {stop_id} for mode {mode_name}")
-        return departures  # Early return if no stop events are found
+        log.warning(f"'stopEvents' not found in response for stop ID {stop_id} for mode(s) {', '.join(mode_names)}")
+        return None  # Early return if no stop events are found
 
     # else the response is successful, so we can proceed to process the data
-    # print(f"Successfully fetched departures for stop ID {stop_id} for mode {mode_name}")
+    metrics.observe("stop_events", len(data["stopEvents"]))
+    log.debug("Successfully fetched departures for stop ID %s for mode(s) %s", stop_id, mode_names)
+    return data
+
+
+def response_fingerprint(body):
+    """
+    A hash of the stopEvents in a departure_mon response body, to tell if anything has changed since last time without decoding it.
+    """
+    # Everything before the stopEvents (version, systemMessages, the stop's own details) doesn't affect the departures
+    start = body.find(b'"stopEvents"')
+    return hashlib.sha1(body[start:] if start != -1 else body).digest()
+
+
+# (stop_id, mode names) -> {"fingerprint", "departures"} - each stop's last response's fingerprint and the departures parsed from it
+parsed_response_cache = {}
+
+
+def fetch_and_parse_departures(stop_id, mode_names, parse):
+    """
+    Fetch a stop's departures and parse them with parse(stop_events) - unless the response is exactly the same as last time, in which
+    case the departures parsed last time are reused, with only minutes_until_departure worked out again.
+    
+    Returns:
+        list: The departures.
+    """
+    body = fetch_departure_response(stop_id, mode_names)
+    
+    cache_key = (stop_id, tuple(mode_names))
+    fingerprint = response_fingerprint(body) if reuse_unchanged_responses else None
+    cached = parsed_response_cache.get(cache_key)
+    if fingerprint is not None and cached is not None and cached["fingerprint"] == fingerprint:
+        metrics.increment("parse_cache_total", result="unchanged")
+        return list(reage_departures(cached["departures"], time.time()))
+    metrics.increment("parse_cache_total", result="changed")
+    
+    data = decode_departure_data(body, stop_id, mode_names)
+    if data is None:
+        departures = []
+    else:
+        with metrics.timed("parse_seconds", stop_id=stop_id):
+            departures = parse(data["stopEvents"])
+    
+    if fingerprint is not None:
+        parsed_response_cache[cache_key] = {"fingerprint": fingerprint, "departures": departures}
+    return departures
+
+
+def parse_api_time(timestamp):
+    """
+    Turn an API timestamp like "2025-01-31T09:15:00Z" into a timezone aware datetime.
+    """
+    return datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+
+def minutes_until(departure_time, now):
+    """
+    Whole minutes from now until departure_time (both unix timestamps), rounded down - negative once it has left.
+    """
+    return int((departure_time - now) // 60)
+
+
+# Every alert seen in a stopEvent, classified once (see service_alerts.py)
+alert_index = service_alerts.AlertIndex()
+
+
+def parse_alerts(infos):
+    """
+    Args:
+        infos (list): The infos from a stopEvent - the alerts for that service.
+    
+    Returns:
+        list: The alerts to show, e.g., [{"subtitle": "Alert subtitle", "content": "Alert content", "alert_type": "alert" or "info"}]
+    
+    The same alert comes with every departure it affects (and again every refresh), so each one is only classified the first time
+    it's seen - after that it's a lookup by its ID. Leaves out very low priority alerts and anything that isn't a lineInfo.
+    """
+    return alert_index.classify_infos(infos)
+
+
+network_alerts = None  # The AlertIndex from the last add_info call that worked
+network_alerts_fetched_at = None
+
+
+def fetch_network_alerts():
+    """
+    Get every current alert on the network with one add_info call.
+    
+    Returns:
+        AlertIndex: The alerts, indexed by line and stop.
+    
+    Raises:
+        APIError: If the API didn't respond with a 200.
+    """
+    endpoint = f"{api_base_url}/add_info"
+    headers = {
+        "Authorization": f"apikey {API_KEY}",
+        "Content-Type": "application/json"
+    }
+    params = {
+        "outputFormat": "rapidJSON",
+        "filterPublicationStatus": "current",
+        "version": "10.2.1.42",
+    }
+    
+    response = api_governor.get("add_info", endpoint, headers=headers, params=params)
+    if response.status_code != 200:
+        raise APIError(f"HTTP {response.status_code}: {response.text[:200]}")
+    return service_alerts.build_alert_index(response.json())
+
+
+def refresh_network_alerts(now):
+    """
+    Fetch the alerts again if service_alerts_source is "add_info" and they're older than service_alerts_refresh_seconds. If it
+    fails, the alerts from last time are kept, and it's tried again next refresh.
+    """
+    global network_alerts, network_alerts_fetched_at
+    if service_alerts_source != "add_info":
+        return
+    if network_alerts_fetched_at is not None and now - network_alerts_fetched_at < service_alerts_refresh_seconds:
+        return
+    try:
+        network_alerts = fetch_network_alerts()
+        network_alerts_fetched_at = now
+        log.debug("Fetched %s current alerts", len(network_alerts))
+    except Exception as e:
+        log.error(f"Error fetching alerts, keeping the last ones: {e}")
+
+
+def attach_network_alerts(every_departure):
+    """
+    Give each departure the alerts for its mode and line and its stop from the last add_info call (replacing any it already had).
+    """
+    if network_alerts is None:
+        return
+    for departure in every_departure:
+        departure["alerts"] = network_alerts.alerts_for(departure["type_of_transport"], departure["line"], departure["stop_id"])
+
+
+def split_destination(destination_full, stop_name):
+    """
+    Split a destination like "Hornsby via Strathfield" into ("Hornsby", "Strathfield").
+    
+    Returns:
+        tuple: (destination, via) - via is "" if there isn't one, or if it's the stop the departure is leaving from.
+    """
+    destination = destination_full.split(" via ")[0]
+    # exclude via if the via station is the current station
+    via = destination_full.split(" via ")[-1] if " via " in destination_full and destination_full.split(" via ")[-1] != stop_name else ""
+    return destination, via
+
+
+def parse_departures(stop_events, stop_name, stop_id, routes_to_exclude):
+    """
+    Args:
+        stop_events (list): The stopEvents from a departure_mon response.
+        stop_name (str): used to remove 'via' from the destination name if it is the same as the stop name.
+        stop_id (str): The ID of the stop the departures are from.
+        routes_to_exclude (list): List of routes to exclude from the results. Just really used for busses.
+        
+    Returns:
+        list: List of departures with relevant details.
+    
+    Transform the raw stopEvents into the departure format used by the terminal and JSON output.
+    """
+    departures = []
+    # Checked once rather than for every departure, since this loop runs for every service at every stop
+    debug = log.isEnabledFor(logging.DEBUG)
     
     ############ Now have the data, time to transform it
     
-    for i, service in enumerate(data["stopEvents"]):
+    for i, service in enumerate(stop_events):
 
         ###### Timing
 
         # Get minutes until departure
         departure_time = service.get("departureTimeEstimated", service.get("departureTimePlanned"))
-        # print(f"Departure time: {departure_time}")
         if not departure_time:
-            print(f"Error: No departure time available for service {i}")
+            log.warning(f"Error: No departure time available for service {i}")
             continue  # Skip if no departure time is available - error handling
 
-        departure_dt = datetime.fromisoformat(departure_time.replace("Z", "+00:00"))
-        now = datetime.now(timezone.utc)
-        minutes_until_departure = int((departure_dt - now).total_seconds() // 60)
-        # print(f"Minutes until departure: {minutes_until_departure}")
+        departure_dt = parse_api_time(departure_time)
+        # Keep the actual departure time (as a unix timestamp) so the minutes until departure can be worked out again later without another API call
+        departure_timestamp = int(departure_dt.timestamp())
+        planned_timestamp = int(parse_api_time(service["departureTimePlanned"]).timestamp()) if "departureTimePlanned" in service else None
+        estimated_timestamp = int(parse_api_time(service["departureTimeEstimated"]).timestamp()) if "departureTimeEstimated" in service else None
+        minutes_until_departure = minutes_until(departure_timestamp, time.time())
 
         # Check for delays by subtracting the planned departure time from the estimated departure time, then convert to minutes
         if "departureTimeEstimated" in service and "departureTimePlanned" in service:
-            # print(f"Estimated departure time: {service['departureTimeEstimated']}")
-            estimated_dt = datetime.fromisoformat(service["departureTimeEstimated"].replace("Z", "+00:00"))
-            planned_dt = datetime.fromisoformat(service["departureTimePlanned"].replace("Z", "+00:00"))
+            estimated_dt = parse_api_time(service["departureTimeEstimated"])
+            planned_dt = parse_api_time(service["departureTimePlanned"])
             delay = int((estimated_dt - planned_dt).total_seconds() // 60)
-            # print(f"Delay: {delay} minutes")
 
         ###### Destination
 
         # Extract destination and via information
         destination_full = service["transportation"]["destination"]["name"]
-        # print(f"Destination full: {destination_full}")
-        destination = destination_full.split(" via ")[0]
-        # exclude via if the via station is the current station
-        # print(f"Via (before excluding current station if applicable): {destination_full.split(' via ')[-1]}")
-        via = destination_full.split(" via ")[-1] if " via " in destination_full and destination_full.split(" via ")[-1] != stop_name else ""
-        # print(f"Via (after excluding current station if applicable): {via}")
-        # print(f"Current station: {stop_name}")
+        destination, via = split_destination(destination_full, stop_name)
 
         # Get the line information
         line = service["transportation"]["disassembledName"]
-        # print(f"Line: {line}")
         
 
         ###### Formatting
@@ -552,96 +1100,34 @@ def get_departures(stop_name, stop_id, modes_of_transport, routes_to_exclude):
         # Get the type of transport from the service data
         # stopEvents > transportation > product > class
         type_of_transport = service["transportation"]["product"]["class"]
-        # print(f"Type of transport (as a number): {type_of_transport}")
         # Map the type to a more readable format
         type_of_transport = type_lookup_table.get(type_of_transport, "unknown")
-        # print(f"Type of transport (as a string) (after lookup): {type_of_transport}")
-        # print(f"Type: {type}")
 
         # Format platform
         platform = service["location"]["properties"].get("platform", "")
-        # print(f"Platform: {platform}")
         platform_raw = service["location"]["parent"]["disassembledName"]
-        # print(f"Platform raw: {platform_raw}")
         platform_display = format_platforms(platform, type_of_transport, service, platform_return_raw, platform_raw)
-        # print(f"Platform display (after formatting): {platform_display}")
         
         # Get colour codes from line
         line_colour = colour_codes(line, type_of_transport)
-        # print(f"Line colour: {line_colour}")
         
         
         # Get the occupancy information if available
         if "occupancy" in service["location"]["properties"]:
             occupancy = service["location"]["properties"]["occupancy"]
-            # print(f"Occupancy: {occupancy}")
         
         
-        alerts = []
-        '''
-        alert = [
-            {
-                "subtitle": "Alert subtitle",
-                "content": "Alert content"
-            }
-        ]
-        '''
-        
-        # Get alert information if it exists
-        # if "infos" exists in service, then print it for now
-        if "infos" in service:
-            # TODO - Need a way to filter out alerts that apply to this specific departure - might not be possible with this API, might need to use the add_info API instead.
-            # Filter out certain alert types
-            # import pprint
-            # pprint.pprint(f"Alerts: {service['infos']}")
-            pass
-            
-            # for each alert, just print the subtitle
-            for alert in service["infos"]:
-                # if priority == "veryLow" then continue
-                if "priority" in alert and alert["priority"] == "veryLow":
-                    # print(f"Skipping very low priority alert: {alert['priority']}")
-                    continue
-                
-                # assign an alert type to either alert or info
-                # if the content contains "trains are not running" (case insensitive) then set the alert type to "alert", else the alert is just "info"
-                if "content" in alert and "trains are not running" in alert["content"].lower():
-                    alert_type = "alert"
-                    # print(f"Alert type: {alert_type}")
-                elif "content" in alert and "buses replacing trains" in alert["content"].lower():
-                    alert_type = "alert"
-                    # print(f"Alert type: {alert_type}")
-                elif "content" in alert and "allow extra travel time" in alert["content"].lower():
-                    alert_type = "alert"
-                    # print(f"Alert type: {alert_type}")
-                else:
-                    alert_type = "info"
-                    # print(f"Alert type: {alert_type}")
-                
-                # if properties > infoType != "lineInfo" then continue
-                if "infoType" in alert["properties"] and alert["properties"]["infoType"] != "lineInfo":
-                    # print(f"Skipping non-lineInfo alert: {alert['properties']['infoType']}")
-                    continue
-                
-                if "subtitle" in alert:
-                    # print(f"\nAlert Priority: {alert['priority']}.\nAlert title: {alert['subtitle']}.\nAlert full: {alert['content']}")
-                    alerts.append({
-                        "subtitle": alert["subtitle"],
-                        "content": alert["content"],
-                        "alert_type": alert_type
-                    })
-                    pass
-                # print(f"Alert: {alerts}")
+        # Get alert information if it exists (with add_info, the alerts are added later, by line and stop)
+        alerts = parse_alerts(service["infos"]) if "infos" in service and service_alerts_source != "add_info" else []
         
         # Get realtime trip ID to be used later, but not just yet
         realtime_trip_id = service["properties"]["RealtimeTripId"] if "RealtimeTripId" in service["properties"] else None
-        # print(f"Realtime trip ID: {realtime_trip_id}")
         
         ###### Filtering
 
         # Skip excluded bus routes now that I've got type_of_transport and line
         if type_of_transport == "bus" and routes_to_exclude is not None and line in routes_to_exclude:
-            print(f"Excluding bus route: {line}")
+            log.info(f"Excluding bus route: {line}")
             continue
 
         ###### Done - add this service to the list of departures
@@ -655,6 +1141,9 @@ def get_departures(stop_name, stop_id, modes_of_transport, routes_to_exclude):
             "destination": destination,
             "via": via,
             "minutes_until_departure": minutes_until_departure,
+            "departure_time": departure_timestamp,
+            "departure_time_planned": planned_timestamp,
+            "departure_time_estimated": estimated_timestamp,
             "delay": delay if "delay" in locals() else 0,
             "line": line,
             "line_colour": line_colour,
@@ -664,13 +1153,412 @@ def get_departures(stop_name, stop_id, modes_of_transport, routes_to_exclude):
             "alerts": alerts if "alerts" in locals() else None,
         })
         
-        # print(f"Appended departure number {i} - full details: {departures[-1]}")
+        if debug:
+            log.debug("Appended departure number %s (platform %r before formatting) - full details: %s", i, platform, departures[-1])
 
+    # The API sends them in planned time order, but a late service can leave after one planned later, so put them in the order
+    # they'll actually leave (everything downstream merges them by departure_time)
+    departures.sort(key=lambda departure: departure["departure_time"])
     return departures
 
 
+# Function that gets the departures for a specific transport type
 
-def generate_json_output(every_departure, output_path):
+def get_departures(stop_name, stop_id, modes_of_transport, routes_to_exclude):
+    """
+    Global args:
+        API_KEY (str): API key for the Transport for NSW API.
+    
+    Args:
+        stop_name (str): used to remove 'via' from the destination name if it is the same as the stop name.
+        stop_id (str): The ID of the stop to get departures from.
+        modes_of_transport (dict): The mode to include (e.g., {"mode_name": "train", "mode_number": 1}).
+        routes_to_exclude (list): List of routes to exclude from the results. Just really used for busses.
+        
+    Returns:
+        list: List of departures with relevant details.
+    
+    Get departures for a specific transport type.
+    """
+    return fetch_and_parse_departures(
+        stop_id,
+        [modes_of_transport["mode_name"]],
+        lambda stop_events: parse_departures(stop_events, stop_name, stop_id, routes_to_exclude),
+    )
+
+
+def get_departures_for_stop(stop_name, stop_id, modes):
+    """
+    Global args:
+        API_KEY (str): API key for the Transport for NSW API.
+    
+    Args:
+        stop_name (str): used to remove 'via' from the destination name if it is the same as the stop name.
+        stop_id (str): The ID of the stop to get departures from.
+        modes (list): The station's list of modes, each with a mode_name and (optionally) routes_to_exclude.
+        
+    Returns:
+        list: List of departures for every mode with relevant details.
+    
+    Same as get_departures, but one API call gets every mode at the stop, rather than one call per mode.
+    The stopEvents are then split back up by transportation > product > class so each mode's routes_to_exclude is still applied.
+    """
+    return fetch_and_parse_departures(
+        stop_id,
+        [mode["mode_name"] for mode in modes],
+        lambda stop_events: parse_departures_by_mode(stop_events, stop_name, stop_id, modes),
+    )
+
+
+def parse_departures_by_mode(stop_events, stop_name, stop_id, modes):
+    """
+    Split a stop's stopEvents up by mode, parse each mode with its own routes_to_exclude, then merge them back into one list.
+    """
+    # Split up the stopEvents by mode
+    stop_events_by_mode = {}
+    for service in stop_events:
+        type_of_transport = type_lookup_table.get(service["transportation"]["product"]["class"], "unknown")
+        stop_events_by_mode.setdefault(type_of_transport, []).append(service)
+    
+    departures_by_mode = []
+    for mode in modes:
+        stop_events = stop_events_by_mode.get(mode["mode_name"], [])
+        departures_by_mode.append(parse_departures(stop_events, stop_name, stop_id, mode.get("routes_to_exclude", [])))
+    
+    # Each mode's departures are already soonest first (see parse_departures), so merge them back into one list in that order
+    return list(heapq.merge(*departures_by_mode, key=lambda departure: departure["departure_time"]))
+
+
+
+# GTFS-Realtime TripUpdates (departure_source = "gtfs_realtime")
+
+trip_update_feeds = {}  # feed path -> {"fetched_at", "index", "lock"}
+trip_update_feeds_lock = threading.Lock()
+
+
+def trip_update_index(feed_path):
+    """
+    The decoded TripUpdates feed (see gtfs_realtime.py), fetched and decoded again if it's older than gtfs_realtime_refresh_seconds.
+    
+    Every stop shares the same feed, so while one job is fetching it, the others needing it wait for that rather than fetching it too.
+    
+    Returns:
+        gtfs_realtime.TripUpdateIndex: The feed's departures by stop.
+    
+    Raises:
+        APIError: If the API didn't respond with a 200.
+    """
+    with trip_update_feeds_lock:
+        feed = trip_update_feeds.setdefault(feed_path, {"fetched_at": 0, "index": None, "lock": threading.Lock()})
+    
+    with feed["lock"]:
+        if feed["index"] is None or time.time() - feed["fetched_at"] >= gtfs_realtime_refresh_seconds:
+            headers = {"Authorization": f"apikey {API_KEY}"}
+            response = api_governor.get("gtfs_realtime", f"{gtfs_realtime_base_url}/{feed_path}", headers=headers)
+            if response.status_code != 200:
+                raise APIError(f"HTTP {response.status_code}: {response.text[:200]}")
+            
+            with metrics.timed("trip_updates_decode_seconds", feed=feed_path):
+                index = gtfs_realtime.build_trip_update_index(response.content, gtfs_index.parent_station if gtfs_index is not None else None)
+            log.debug("Decoded %s: %s trips, %s departures", feed_path, index.trip_count, len(index))
+            feed.update(fetched_at=time.time(), index=index)
+        
+        return feed["index"]
+
+
+def gtfs_stop_id(station):
+    """
+    The stop's GTFS stop ID - its gtfs_stop_id if it has one, otherwise its trip planner stop ID (they're the same for most stops).
+    """
+    return station.get("gtfs_stop_id") or station["stop_id"]
+
+
+def trip_update_departure(record, stop_name, stop_id, mode_name, now):
+    """
+    Turn one departure from a TripUpdateIndex into the same format parse_departures() gives, using the GTFS index for the line,
+    destination and platform.
+    
+    Returns:
+        dict: The departure, or None if the GTFS index says its route is a different mode (some feeds cover more than one).
+    """
+    departure_time, planned_time, trip_id, route_id, platform_stop_id = record
+    
+    trip = gtfs_index.trip(trip_id) if gtfs_index is not None else None
+    if trip is not None:
+        route_id = route_id or trip[0]
+        destination_full = trip[1]
+    else:
+        destination_full = ""
+    
+    route = gtfs_index.route(route_id) if gtfs_index is not None and route_id else None
+    if route is not None:
+        line, type_of_transport = route
+        if type_of_transport != mode_name:
+            return None
+    else:
+        # Not in the timetable (e.g., an extra service added on the day), so all we know is the route ID and which feed it was in
+        line, type_of_transport = route_id or "", mode_name
+    
+    destination, via = split_destination(destination_full, stop_name)
+    platform = gtfs_index.platform_name(platform_stop_id) if gtfs_index is not None else None
+    
+    return {
+        "isRealtimeControlled": True,
+        "stop_name": stop_name,
+        "stop_id": stop_id,
+        "platform": platform or "",
+        "destination": destination,
+        "via": via,
+        "minutes_until_departure": minutes_until(departure_time, now),
+        "departure_time": departure_time,
+        "departure_time_planned": planned_time,
+        "departure_time_estimated": departure_time,
+        "delay": (departure_time - planned_time) // 60,
+        "line": line,
+        "line_colour": colour_codes(line, type_of_transport),
+        "type_of_transport": type_of_transport,
+        "realtime_trip_id": trip_id,
+        "occupancy": None,
+        "alerts": [],
+    }
+
+
+def get_departures_from_trip_updates(station, modes):
+    """
+    Same as get_departures_for_stop, but the departures come from the GTFS-Realtime TripUpdates feeds rather than departure_mon.
+    
+    With the GTFS timetable, every scheduled departure is shown, with when the feeds say it'll really leave (see
+    gtfs_realtime.TripUpdateIndex.estimated_departure) - trips the feeds don't say anything about are shown as timetabled, and
+    cancelled trips and skipped stops are left out. Without it, it's only the departures the feeds give a time for.
+    
+    Args:
+        station (dict): The station, in the stops_to_show format. The feeds are searched by its GTFS stop ID (see gtfs_stop_id), but
+            the departures keep its trip planner stop_id, same as every other source.
+        modes (list): The station's list of modes, each with a mode_name and (optionally) routes_to_exclude.
+    
+    Returns:
+        list: List of departures for every mode, soonest first.
+    """
+    now = time.time()
+    station_id = gtfs_stop_id(station)
+    departures_by_mode = []
+    for mode in modes:
+        routes_to_exclude = mode.get("routes_to_exclude") or []
+        indexes = [trip_update_index(feed_path) for feed_path in gtfs_realtime_feeds.get(mode["mode_name"], [])]
+        departures = []
+        scheduled_trips = set()
+        last_scheduled_time = None
+        
+        if timetable is not None:
+            # Trips scheduled a while ago too, in case they're running late and haven't left yet
+            running_late = timetable.departures(station_id, now - gtfs_realtime_max_delay_minutes * 60, None, {mode["mode_name"]}, until=now)
+            upcoming = timetable.departures(station_id, now, timetable_departures_per_stop, {mode["mode_name"]})
+            if len(upcoming) >= timetable_departures_per_stop:
+                last_scheduled_time = upcoming[-1][0]
+            for scheduled in running_late + upcoming:
+                planned_time, trip_id, platform_stop_id, stop_sequence = scheduled[0], scheduled[1], scheduled[5], scheduled[6]
+                scheduled_trips.add(trip_id)
+                estimated = None
+                for index in indexes:
+                    estimated = index.estimated_departure(trip_id, platform_stop_id, stop_sequence, planned_time, station_id)
+                    if estimated is not None:
+                        break
+                if estimated == gtfs_realtime.NOT_STOPPING:
+                    continue
+                departures.append(timetable_departure(station, scheduled, now, estimated))
+        
+        # Anything with a time in the feeds that isn't in the timetable (e.g., an extra service added on the day) - or everything, if
+        # there's no timetable. Not past the last scheduled departure, which would leave a gap before it
+        for index in indexes:
+            for record in index.departures(station_id, after=now - 60):
+                if record[2] in scheduled_trips or (last_scheduled_time is not None and record[0] > last_scheduled_time):
+                    continue
+                departure = trip_update_departure(record, station["station_name"], station["stop_id"], mode["mode_name"], now)
+                if departure is not None:
+                    departures.append(departure)
+        
+        # Anything that left more than a minute ago has gone, same as departure_mon
+        departures = [
+            departure for departure in departures
+            if departure["departure_time"] >= now - 60 and not (departure["type_of_transport"] == "bus" and departure["line"] in routes_to_exclude)
+        ]
+        departures.sort(key=lambda departure: departure["departure_time"])
+        departures_by_mode.append(departures)
+    
+    return list(heapq.merge(*departures_by_mode, key=lambda departure: departure["departure_time"]))
+
+
+def timetable_departure(station, scheduled, now, estimated=None):
+    """
+    Turn one departure from Timetable.departures() into the same format parse_departures() gives.
+    
+    Args:
+        station (dict): The station, in the stops_to_show format.
+        scheduled (tuple): The departure, from Timetable.departures().
+        now (float): The current time (unix timestamp).
+        estimated (tuple): (departure time, stop ID) from TripUpdateIndex.estimated_departure(), if the feeds say when it'll really
+            leave. None for a timetabled departure.
+    
+    Returns:
+        dict: The departure.
+    """
+    planned_time, trip_id, line, type_of_transport, headsign, platform_stop_id, _ = scheduled
+    departure_time = planned_time
+    if estimated is not None:
+        departure_time, platform_stop_id = estimated
+    destination, via = split_destination(headsign, station["station_name"])
+    platform = gtfs_index.platform_name(platform_stop_id) if gtfs_index is not None else None
+    return {
+        "isRealtimeControlled": estimated is not None,
+        "stop_name": station["station_name"],
+        "stop_id": station["stop_id"],
+        "platform": platform or "",
+        "destination": destination,
+        "via": via,
+        "minutes_until_departure": minutes_until(departure_time, now),
+        "departure_time": departure_time,
+        "departure_time_planned": planned_time,
+        "departure_time_estimated": departure_time if estimated is not None else None,
+        "delay": (departure_time - planned_time) // 60,
+        "line": line,
+        "line_colour": colour_codes(line, type_of_transport),
+        "type_of_transport": type_of_transport,
+        "realtime_trip_id": trip_id if estimated is not None else None,
+        "occupancy": None,
+        "alerts": [],
+    }
+
+
+def get_timetable_departures(station, modes, now):
+    """
+    Same as get_departures_for_stop, but the scheduled departures from the GTFS timetable (see gtfs_timetable.py), for when the API
+    can't be used. No API call is made.
+    
+    Args:
+        station (dict): The station, in the stops_to_show format.
+        modes (list): The modes to include, each with a mode_name and (optionally) routes_to_exclude.
+        now (float): Only departures leaving from now on (as a unix timestamp).
+    
+    Returns:
+        list: List of departures for every mode, soonest first.
+    """
+    departures_by_mode = []
+    for mode in modes:
+        routes_to_exclude = mode.get("routes_to_exclude") or []
+        departures = []
+        for scheduled in timetable.departures(gtfs_stop_id(station), now, timetable_departures_per_stop, {mode["mode_name"]}):
+            line, type_of_transport = scheduled[2], scheduled[3]
+            if type_of_transport == "bus" and line in routes_to_exclude:
+                continue
+            departures.append(timetable_departure(station, scheduled, now))
+        departures_by_mode.append(departures)
+    
+    return list(heapq.merge(*departures_by_mode, key=lambda departure: departure["departure_time"]))
+
+
+def normalise_departures(every_departure):
+    """
+    Turn the list of departures into the compact (version 2) output format.
+    
+    Args:
+        every_departure (list): List of departures with relevant details.
+    
+    Returns:
+        dict: The departures, with each stop, line and alert stored once and referred to by its position in that table:
+    
+    {
+        "format_version": 2,
+        "generated_at": 1738300000,
+        "stops": [{"stop_id": "10101100", "stop_name": "Central"}],
+        "lines": [{"line": "T1", "line_colour": "#F99D1C", "type_of_transport": "train"}],
+        "alerts": [{"subtitle": "...", "content": "...", "alert_type": "alert"}],
+        "departures": [
+            {"stop": 0, "line": 0, "alerts": [0], "platform": "Platform 18", "destination": "Emu Plains", "via": "", "departure_time": 1738300300, ...}
+        ]
+    }
+    
+    On disruption days the same long alert is attached to dozens of departures, so only storing it once makes the file a lot smaller.
+    """
+    stops, lines, alerts = [], [], []
+    stop_ids, line_ids, alert_ids = {}, {}, {}
+    departures = []
+    
+    for departure in every_departure:
+        stop_key = (departure["stop_id"], departure["stop_name"])
+        if stop_key not in stop_ids:
+            stop_ids[stop_key] = len(stops)
+            stops.append({"stop_id": departure["stop_id"], "stop_name": departure["stop_name"]})
+        
+        line_key = (departure["line"], departure["line_colour"], departure["type_of_transport"])
+        if line_key not in line_ids:
+            line_ids[line_key] = len(lines)
+            lines.append({"line": departure["line"], "line_colour": departure["line_colour"], "type_of_transport": departure["type_of_transport"]})
+        
+        departure_alerts = []
+        for alert in departure["alerts"] or []:
+            alert_key = (alert["subtitle"], alert["content"], alert["alert_type"])
+            if alert_key not in alert_ids:
+                alert_ids[alert_key] = len(alerts)
+                alerts.append(alert)
+            departure_alerts.append(alert_ids[alert_key])
+        
+        # Everything else stays as it is, apart from minutes_until_departure - the board works that out itself from departure_time,
+        # so the file doesn't go out of date (or need rewriting) every minute
+        compact_departure = {key: value for key, value in departure.items() if key not in normalised_keys and key != "minutes_until_departure"}
+        compact_departure.update({"stop": stop_ids[stop_key], "line": line_ids[line_key], "alerts": departure_alerts})
+        departures.append(compact_departure)
+    
+    return {
+        "format_version": 2,
+        "generated_at": int(time.time()),
+        "stops": stops,
+        "lines": lines,
+        "alerts": alerts,
+        "departures": departures,
+    }
+
+
+# The departure fields that are moved into the stops, lines and alerts tables by normalise_departures()
+normalised_keys = {"stop_id", "stop_name", "line", "line_colour", "type_of_transport", "alerts"}
+
+
+def denormalise_departures(output):
+    """
+    Turn output.json back into a plain list of departures, whichever format version it's in (the opposite of normalise_departures).
+    """
+    # Version 1 is just the list of departures
+    if isinstance(output, list):
+        return output
+    
+    every_departure = []
+    for compact_departure in output["departures"]:
+        departure = {key: value for key, value in compact_departure.items() if key not in ("stop", "line", "alerts")}
+        departure.update(output["stops"][compact_departure["stop"]])
+        departure.update(output["lines"][compact_departure["line"]])
+        departure["alerts"] = [output["alerts"][alert_id] for alert_id in compact_departure["alerts"]]
+        departure["minutes_until_departure"] = minutes_until(departure["departure_time"], output["generated_at"])
+        every_departure.append(departure)
+    return every_departure
+
+
+def build_output(every_departure):
+    """
+    The JSON output for the board, in the format set by output_format_version.
+    """
+    if output_format_version == 1:
+        return every_departure
+    output = normalise_departures(every_departure)
+    if delay_tracker is not None:
+        # Just the lines and stops on this board
+        output["delay_stats"] = delay_tracker.stats(
+            time.time(),
+            lines=[gtfs_static.route_key(line["line"], line["type_of_transport"]) for line in output["lines"]],
+            stop_ids=[stop["stop_id"] for stop in output["stops"]],
+        )
+    return output
+
+
+def generate_json_output(every_departure, output_path):
     """
     Generate a JSON file with the departures information, including color codes.
 
@@ -681,10 +1569,14 @@ def generate_json_output(every_departure, output_path):
     try:
         # Save the departures list as a JSON file
         with open(output_path, "w") as file:
-            json.dump(every_departure, file, indent=4)
-        print(f"JSON file generated: {output_path}")
+            if output_format_version == 1:
+                json.dump(every_departure, file, indent=4)
+            else:
+                # No indenting or spaces - nobody reads it by hand, and it's a lot smaller
+                json.dump(build_output(every_departure), file, separators=(",", ":"))
+        log.info(f"JSON file generated: {output_path}")
     except Exception as e:
-        print(f"Error generating JSON file: {e}")
+        log.error(f"Error generating JSON file: {e}")
 
 def print_in_terminal(every_departure):
     # Define color codes for terminal printing
@@ -704,74 +1596,710 @@ def print_in_terminal(every_departure):
         type_of_transport = departure["type_of_transport"]
         line_colour = colors.get(type_of_transport, colors["reset"])
         # Print the departure information in the terminal using string formatting (e.g., the :<20 padding stuff)
-        print(f"{line_colour}Departure from {departure['stop_name']:<20} {departure['platform']:<20} {departure['destination']:<20} {departure['via']:<20} {departure['minutes_until_departure']:>3} min {departure['delay']:>3} min delay Line: {departure['line']:>3} Type: {type_of_transport}{colors['reset']}")
+        # Departures from a stop whose latest request failed are shown from the last request that worked
+        stale = " (stale)" if departure.get("stale") else ""
+        print(f"{line_colour}Departure from {departure['stop_name']:<20} {departure['platform']:<20} {departure['destination']:<20} {departure['via']:<20} {departure['minutes_until_departure']:>3} min {departure['delay']:>3} min delay Line: {departure['line']:>3} Type: {type_of_transport}{stale}{colors['reset']}")
 
 
-def main():
+def build_poll_jobs(stops):
+    """
+    Split the stops up into the API calls needed to get their departures - one per stop if batch_modes_per_stop is on, otherwise one per (stop, mode).
+    
+    Args:
+        stops (list): List of stations in the stops_to_show format (station_name, stop_id, modes).
+    
+    Returns:
+        list: [{"key": ..., "station": ..., "modes": [...]}, ...]
+    
+    The key stays the same between refreshes (e.g., ("10101229", ("train", "bus"))) so it can be used to keep track of each job's schedule.
+    """
+    jobs = []
+    for station in stops:
+        # One job for the whole stop if batching is turned on
+        groups_of_modes = [station["modes"]] if batch_modes_per_stop else [[mode] for mode in station["modes"]]
+        for modes in groups_of_modes:
+            jobs.append({
+                "key": (station["stop_id"], tuple(mode["mode_name"] for mode in modes)),
+                "station": station,
+                "modes": modes,
+            })
+    return jobs
+
+
+def shared_stations(stations_per_board):
+    """
+    Every stop from every board, once each, with every mode that any board wants from it.
+    
+    Args:
+        stations_per_board (list): Each board's list of stations (in the stops_to_show format).
+    
+    Returns:
+        list: The stations to poll, in the stops_to_show format. routes_to_exclude is left off, since different boards might exclude different
+        routes from the same stop - it's applied to each board's departures afterwards by board_departure_streams().
+    """
+    stations = {}
+    for board_stations in stations_per_board:
+        for station in board_stations:
+            if station["stop_id"] is None:
+                continue  # Couldn't be found, so there's nothing to poll
+            shared = stations.setdefault(station["stop_id"], {"station_name": station["station_name"], "stop_id": station["stop_id"], "modes": []})
+            if station.get("gtfs_stop_id"):
+                shared["gtfs_stop_id"] = station["gtfs_stop_id"]
+            for mode in station["modes"]:
+                if all(shared_mode["mode_name"] != mode["mode_name"] for shared_mode in shared["modes"]):
+                    shared["modes"].append({"mode_name": mode["mode_name"], "mode_number": mode.get("mode_number")})
+    return list(stations.values())
+
+
+def board_departure_streams(board_stations, jobs, now):
+    """
+    One board's share of the polled departures - only its stops, only the modes it wants from each, without its routes_to_exclude
+    (buses only).
+    
+    Args:
+        board_stations (list): The board's stations (in the stops_to_show format).
+        jobs (list): The shared jobs, from build_poll_jobs(shared_stations(...)).
+        now (float): The current time (unix timestamp).
+    
+    Returns:
+        list: One iterator per job, each in departure order - ready for merge_departures().
+    """
+    # stop_id -> {mode_name: routes to exclude}, and the name this board uses for each stop
+    wanted_modes = {}
+    station_names = {}
+    for station in board_stations:
+        station_names.setdefault(station["stop_id"], station["station_name"])
+        for mode in station["modes"]:
+            wanted_modes.setdefault(station["stop_id"], {}).setdefault(mode["mode_name"], set()).update(mode.get("routes_to_exclude") or [])
+    
+    def board_departures(departures):
+        for departure in departures:
+            excluded_routes = wanted_modes[departure["stop_id"]].get(departure["type_of_transport"])
+            if excluded_routes is None:
+                continue
+            # routes_to_exclude is only for buses, same as parse_departures()
+            if departure["type_of_transport"] == "bus" and departure["line"] in excluded_routes:
+                continue
+            # Another board might call the same stop something different
+            if departure["stop_name"] != station_names[departure["stop_id"]]:
+                departure = {**departure, "stop_name": station_names[departure["stop_id"]]}
+            yield departure
+    
+    board_jobs = [job for job in jobs if job["key"][0] in wanted_modes]
+    return [board_departures(departures) for departures in scheduled_departures(board_jobs, now)]
+
+
+def run_poll_job(job):
+    """
+    Make the API call for a single job from build_poll_jobs() and return its departures.
+    """
+    station = job["station"]
+    if departure_source == "gtfs_realtime":
+        return get_departures_from_trip_updates(station, job["modes"])
+    if len(job["modes"]) > 1 or batch_modes_per_stop:
+        return get_departures_for_stop(station["station_name"], station["stop_id"], job["modes"])
+    
+    mode = job["modes"][0]
+    routes_to_exclude = mode.get("routes_to_exclude", [])  # Get routes_to_exclude if it exists, otherwise use an empty list
+    return get_departures(station["station_name"], station["stop_id"], mode, routes_to_exclude)
+
+
+def fetch_poll_jobs(jobs):
+    """
+    Run every job at the same time, sharing http_session, with at most max_concurrent_requests sent at once (or split them between
+    worker processes, if poll_worker_processes is set - see fetch_poll_jobs_sharded).
+    
+    Returns:
+        list: (job, departures, error) for every job, in the same order as jobs. error is None if the job worked, otherwise departures is None.
+    """
+    results = []
+    if not jobs:
+        return results
+    if poll_worker_processes:
+        return fetch_poll_jobs_sharded(jobs)
+    
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrent_requests)) as pool:
+        futures = [pool.submit(run_poll_job, job) for job in jobs]
+        
+        # Collect the results in the same order the requests were submitted
+        for job, future in zip(jobs, futures):
+            try:
+                results.append((job, future.result(), None))
+            except Exception as e:
+                results.append((job, None, e))
+    
+    return results
+
+
+# Sharded polling (poll_worker_processes) - each shard of stops always goes to the same worker process, so its parsed_response_cache
+# and GTFS feeds stay useful. One single-process pool per shard rather than one big pool, since a pool whose process crashes is
+# broken for good, and that should only cost the one shard.
+
+poll_workers = []  # shard number -> ProcessPoolExecutor, or None if it needs (re)starting
+
+
+class PollWorkerError(Exception):
+    """
+    A job failed in a worker process (or the worker itself crashed).
+    """
+
+
+# The settings each worker needs, copied across when it starts (they may have been changed by the command line options)
+worker_setting_names = [
+    "API_KEY", "api_base_url", "max_concurrent_requests", "batch_modes_per_stop", "api_requests_per_second", "api_daily_quota",
+    "max_request_retries", "api_circuit_failure_threshold", "api_circuit_reset_seconds", "reuse_unchanged_responses", "departure_source",
+    "gtfs_realtime_base_url", "gtfs_realtime_feeds", "gtfs_realtime_refresh_seconds", "gtfs_index_path", "log_level", "platform_return_raw",
+    "service_alerts_source", "replay_path", "record_path", "gtfs_timetable_path", "timetable_departures_per_stop",
+    "gtfs_realtime_max_delay_minutes",
+]
+
+
+def init_poll_worker(settings, worker_count):
+    """
+    Runs in each worker process when it starts - copy the settings across and set up the worker's own session and governor.
+    """
+    global poll_worker_processes, api_requests_per_second, api_daily_quota, gtfs_index, timetable
+    globals().update(settings)
+    poll_worker_processes = 0  # The worker does its own share itself
+    logging.basicConfig(level=log_level, format="%(message)s")
+    
+    # An equal share each, so between them the workers stay within the limits
+    if api_requests_per_second:
+        api_requests_per_second /= worker_count
+    if api_daily_quota:
+        api_daily_quota //= worker_count
+    mount_connection_pool()
+    mount_replay_and_record()
+    configure_request_governor()
+    gtfs_index = gtfs_static.load_gtfs_index(gtfs_index_path)
+    timetable = gtfs_timetable.load_timetable(gtfs_timetable_path)
+
+
+def pack_departures(departures):
+    """
+    Turn a list of departures into (keys, rows of values), so the keys aren't sent back from the worker once for every departure.
+    """
+    if not departures:
+        return (), []
+    keys = tuple(departures[0])
+    return keys, [tuple(departure[key] for key in keys) for departure in departures]
+
+
+def unpack_departures(packed):
+    keys, rows = packed
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def run_poll_shard(jobs):
+    """
+    Runs in a worker process - fetch and parse one shard of jobs.
+    
+    Returns:
+        tuple: (results, request_times) - results is (packed departures, None) or (None, error message) for each job, in the same
+        order as jobs, and request_times is when each request the worker sent was sent, for the main process's request budget.
+    """
+    results = []
+    for job, departures, error in fetch_poll_jobs(jobs):
+        if error is None:
+            results.append((pack_departures(departures), None))
+        else:
+            # Not every exception can be sent back between processes, so just send what it said
+            results.append((None, f"{type(error).__name__}: {error}"))
+    request_times = list(recent_request_times)
+    recent_request_times.clear()
+    return results, request_times
+
+
+def poll_worker(shard_number):
+    """
+    The worker process for a shard, starting it if it isn't running.
+    """
+    while len(poll_workers) <= shard_number:
+        poll_workers.append(None)
+    if poll_workers[shard_number] is None:
+        settings = {name: globals()[name] for name in worker_setting_names}
+        # "spawn" rather than fork, so it works the same on Windows and never inherits this process's open connections
+        poll_workers[shard_number] = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_poll_worker,
+            initargs=(settings, poll_worker_processes),
+        )
+    return poll_workers[shard_number]
+
+
+def stop_poll_worker(shard_number):
+    worker = poll_workers[shard_number]
+    # A worker that's hung (rather than crashed) would otherwise keep running, and keep its share of the API limits, for good
+    for process in list((worker._processes or {}).values()):
+        process.terminate()
+    worker.shutdown(wait=False, cancel_futures=True)
+    poll_workers[shard_number] = None
+
+
+def fetch_poll_jobs_sharded(jobs):
+    """
+    Same as fetch_poll_jobs, but the jobs are split between poll_worker_processes worker processes (by stop ID, so a stop always goes
+    to the same one).
+    """
+    shards = [[] for _ in range(poll_worker_processes)]
+    for job in jobs:
+        shards[zlib.crc32(str(job["key"][0]).encode("utf-8")) % poll_worker_processes].append(job)
+    
+    futures = []
+    for shard_number, shard in enumerate(shards):
+        if not shard:
+            continue
+        try:
+            future = poll_worker(shard_number).submit(run_poll_shard, shard)
+        except BrokenExecutor:
+            # The worker crashed while it was waiting for the next refresh, so start a new one
+            stop_poll_worker(shard_number)
+            future = poll_worker(shard_number).submit(run_poll_shard, shard)
+        futures.append((shard_number, shard, future))
+    
+    results_by_job = {}
+    worker_request_times = []
+    # The shards all run at the same time, so they share one deadline rather than getting a timeout each
+    timeout = poll_worker_timeout_refreshes * output_refresh_in_seconds
+    deadline = time.monotonic() + timeout
+    for shard_number, shard, future in futures:
+        try:
+            shard_results, request_times = future.result(timeout=max(0, deadline - time.monotonic()))
+        except Exception as e:
+            # The worker crashed, hung, or its results couldn't be sent back - only this shard's jobs fail, and it's restarted next time
+            if isinstance(e, FuturesTimeoutError):
+                reason = f"no results after {timeout} seconds"
+            else:
+                reason = f"{type(e).__name__}: {e}"
+            log.error(f"Poll worker {shard_number} failed, restarting it next refresh: {reason}")
+            stop_poll_worker(shard_number)
+            for job in shard:
+                results_by_job[id(job)] = (job, None, PollWorkerError(f"Poll worker {shard_number} failed: {reason}"))
+            continue
+        
+        worker_request_times.extend(request_times)
+        for job, (packed_departures, error) in zip(shard, shard_results):
+            if error is None:
+                results_by_job[id(job)] = (job, unpack_departures(packed_departures), None)
+            else:
+                results_by_job[id(job)] = (job, None, PollWorkerError(error))
+    
+    # Kept in order, since the oldest are dropped from the front
+    merged_request_times = sorted([*recent_request_times, *worker_request_times])
+    recent_request_times.clear()
+    recent_request_times.extend(merged_request_times)
+    return [results_by_job[id(job)] for job in jobs]
+
+
+def fetch_all_departures(stops):
+    """
+    Fetch the departures for every (stop, mode) pair at the same time (or every stop, if batch_modes_per_stop is on).
+    
+    Args:
+        stops (list): List of stations in the stops_to_show format (station_name, stop_id, modes).
+    
+    Returns:
+        list: Every departure from every stop and mode, in no particular order.
+    
+    If any request raises, the exception is passed up to the caller, same as when the requests were made one at a time.
+    """
     every_departure = []
+    for job, departures, error in fetch_poll_jobs(build_poll_jobs(stops)):
+        if error is not None:
+            raise error
+        every_departure.extend(departures)
+    
+    return every_departure
 
-    # Get the departures for each station in the stops_to_show stops
-    for station in stops_to_show:
-        for mode in station["modes"]:
-            routes_to_exclude = mode.get("routes_to_exclude", [])  # Get routes_to_exclude if it exists, otherwise use an empty list
-            departures = get_departures(
-                station["station_name"],
-                station["stop_id"],
-                mode,
-                routes_to_exclude
-            )
-            every_departure.extend(departures)
-          
-    # Sort the list of departures by minutes until departure
-    every_departure.sort(key=lambda x: x["minutes_until_departure"])
-    
-    # Exclude departures that are less than 0 minutes until departure
-    every_departure = [departure for departure in every_departure if departure["minutes_until_departure"] >= 0]
-    
-    # Can introduce more filtering here - such as a maximum number of departures to show, or a maximum number of minutes until departure to show.
-      
-    # Print the departures in the terminal
-    print_in_terminal(every_departure)
-
-    # JSON - generate the JSON file which will be used by the html/css/javascript frontend file
-    output_path = r"C:\Users\Matth\OneDrive\Personal\Projects\Programming\TFNSW\output.json"
-    generate_json_output(every_departure, output_path)
 
+# Adaptive refresh scheduling
+# Rather than re-polling every stop on a fixed timer, each job gets its own next-poll deadline, based on:
+#   - how soon its next departure leaves (poll roughly twice before it goes)
+#   - whether any of its services are realtime (timetable-only data hardly changes, so it can wait longer)
+#   - how often its departures have actually been changing recently
+# A quiet ferry wharf at night ends up near max_poll_interval_seconds and a busy interchange near min_poll_interval_seconds.
+# Everything is kept within max_requests_per_minute - jobs that don't fit wait for the next loop, most overdue first.
 
-stops_to_show = None
-# if preconfigured_stops is commented out, then as for the user input
-if preconfigured_stops is None:
-    # Get user input for station names and modes
-    user_input = input("Enter station names and modes (e.g., 'Parramatta (train, bus); Parramatta Square (light_rail); Parramatta Wharf (ferry)'): ")
+poll_schedule = {}  # job key -> {"next_poll", "fetched_at", "departures", "signature", "change_rate", "failures"}
+# poll_schedule is also the stale-while-revalidate cache: if a job's request fails, its departures from the last successful request
+# are kept (and re-aged) and shown with "stale": true, until the retry works or they're older than max_stale_seconds.
+# When each request in the last minute was sent, for the max_requests_per_minute budget - added to by the governor as it sends them
+# (see request_sent), or sent back by the poll workers with their results
+recent_request_times = deque()
+
+
+def departures_signature(departures):
+    """
+    Summarise the parts of the departures that actually change between polls (not minutes_until_departure, which changes every minute anyway).
+    """
+    return frozenset(
+        (departure["realtime_trip_id"], departure["line"], departure["destination"], departure["platform"], departure["delay"])
+        for departure in departures
+    )
+
+
+def next_poll_interval(departures, change_rate):
+    """
+    Work out how many seconds to wait before polling a job again.
     
-    # Use the user input to get the station IDs and modes
-    stops_to_show = get_station_ids_from_station_names_and_modes(user_input)
+    Args:
+        departures (list): The departures from the job's latest poll.
+        change_rate (float): 0 if the job's departures never change between polls, 1 if they change every time.
     
-    # Show all platform information
-    platform_return_raw = True
-else:
-    # preconfigured_stops does exist, use that
-    stops_to_show = preconfigured_stops
-    platform_return_raw = False # Show the formatted platform name for your hardcoded station
+    Returns:
+        float: Seconds until the next poll, between min_poll_interval_seconds and max_poll_interval_seconds.
+    """
+    upcoming = [departure for departure in departures if departure["minutes_until_departure"] >= 0]
+    if not upcoming:
+        # Nothing coming up - check back every now and again in case something turns up
+        interval = max_poll_interval_seconds
+    else:
+        # Poll about twice before the next service leaves
+        soonest = min(departure["minutes_until_departure"] for departure in upcoming)
+        interval = (soonest * 60 + 60) / 2
+        
+        # Timetabled-only services won't change much, so these can wait longer
+        if not any(departure["isRealtimeControlled"] for departure in upcoming):
+            interval *= 2
+    
+    # Departures that keep changing get polled more often (up to twice as often)
+    interval *= 1 - 0.5 * change_rate
+    
+    return min(max(interval, min_poll_interval_seconds), max_poll_interval_seconds)
+
+
+def reage_departures(departures, now):
+    """
+    Work out minutes_until_departure again for departures that were fetched a while ago, so they're correct as of now.
+    
+    Returns:
+        iterator: The departures in the same order, only copied as they're used (so stopping early skips the rest).
+    """
+    return ({**departure, "minutes_until_departure": minutes_until(departure["departure_time"], now)} for departure in departures)
 
 
-refresh_in_seconds = 60  # Refresh every 60 seconds
+def poll_due_jobs(jobs, now):
+    """
+    Poll every job whose next-poll deadline has passed (as many as the request budget allows) and update poll_schedule.
+    
+    Returns:
+        int: How many jobs were polled.
+    """
+    # Forget about requests from more than a minute ago
+    while recent_request_times and now - recent_request_times[0] >= 60:
+        recent_request_times.popleft()
+    
+    # Jobs that have never been polled go first, then the most overdue
+    due_jobs = [job for job in jobs if job["key"] not in poll_schedule or poll_schedule[job["key"]]["next_poll"] <= now]
+    due_jobs.sort(key=lambda job: poll_schedule[job["key"]]["next_poll"] if job["key"] in poll_schedule else float("-inf"))
+    
+    # With the TripUpdates feeds, polling a job is only a lookup in the feed already fetched (the feeds are refreshed on their own
+    # schedule), so holding jobs back wouldn't save any requests
+    if departure_source != "gtfs_realtime":
+        # Every job takes at least one request (the requests themselves are counted as they're sent), so no more jobs than that
+        requests_left = max(0, max_requests_per_minute - len(recent_request_times))
+        if len(due_jobs) > requests_left:
+            log.warning(f"Request budget reached, delaying {len(due_jobs) - requests_left} of {len(due_jobs)} due stops")
+            due_jobs = due_jobs[:requests_left]
+    
+    for job, departures, error in fetch_poll_jobs(due_jobs):
+        finished = time.time()
+        entry = poll_schedule.setdefault(job["key"], {
+            "fetched_at": finished,
+            "departures": [],
+            "signature": None,
+            "change_rate": 0.5,  # Don't know yet, so start in the middle
+            "failures": 0,
+        })
+        
+        if error is not None:
+            # Keep showing what we had before (marked as stale), and try just this job again soon (backing off if it keeps failing)
+            entry["failures"] += 1
+            retry_in = min(min_poll_interval_seconds * 2 ** (entry["failures"] - 1), max_poll_interval_seconds)
+            metrics.increment("polled_jobs_total", result="error")
+            log.error(f"Error fetching departures for stop ID {job['key'][0]} ({', '.join(job['key'][1])}): {error}. Retrying in {retry_in:.0f} seconds")
+            entry["next_poll"] = finished + retry_in
+            continue
+        
+        metrics.increment("polled_jobs_total", result="ok")
+        if departure_recorder is not None:
+            departure_recorder.record(departures)
+        if delay_tracker is not None:
+            delay_tracker.update(departures, finished)
+        
+        # Keep a running (exponentially weighted) average of how often this job's departures change
+        signature = departures_signature(departures)
+        if entry["signature"] is not None:
+            changed = 1 if signature != entry["signature"] else 0
+            entry["change_rate"] = 0.7 * entry["change_rate"] + 0.3 * changed
+        
+        entry.update({
+            "fetched_at": finished,
+            "departures": departures,
+            "signature": signature,
+            "failures": 0,
+            "next_poll": finished + next_poll_interval(departures, entry["change_rate"]),
+        })
+    
+    return len(due_jobs)
+
+
+def scheduled_departures(jobs, now):
+    """
+    The departures from the latest poll of each job, with minutes_until_departure brought up to date.
+    
+    Returns:
+        list: One iterator per job, each in departure order - ready for merge_departures().
+    
+    Jobs whose last request failed still show their last good departures, marked as stale (see mark_stale). Once those are too old
+    (or there weren't any), the timetable's scheduled departures are shown instead, if there's a timetable.
+    """
+    departure_streams = []
+    for job in jobs:
+        entry = poll_schedule.get(job["key"])
+        if entry is None:
+            continue
+        
+        departures = reage_departures(entry["departures"], now)
+        if entry["failures"]:
+            # The last request failed, so these are from the last one that worked
+            if now - entry["fetched_at"] > max_stale_seconds or not entry["departures"]:
+                # Too old to be worth showing (or nothing has worked yet), so fall back on the timetable
+                if timetable is not None:
+                    departure_streams.append(get_timetable_departures(job["station"], job["modes"], now))
+                continue
+            departures = mark_stale(departures, entry["fetched_at"])
+        departure_streams.append(departures)
+    return departure_streams
+
+
+def mark_stale(departures, fetched_at):
+    """
+    Mark departures as coming from an old request, with when that request was (as a unix timestamp) so the board can show how old they are.
+    """
+    return ({**departure, "stale": True, "last_updated": int(fetched_at)} for departure in departures)
+
+
+def merge_departures(departure_streams):
+    """
+    Merge the departures from every stop into one list, soonest first, stopping as soon as the board is full.
+    
+    Args:
+        departure_streams (list): One iterable of departures per stop (or per stop and mode), each already soonest first.
+    
+    Returns:
+        list: The departures to show, sorted by minutes until departure.
+    
+    Each stop's departures are already in departure_time order (parse_departures sorts them), so rather than putting every departure into one big list and sorting it,
+    they're merged as they go (keeping just the next departure from each stop in a heap). Departures that have already left are skipped,
+    then it stops once there are max_departures, or departures are more than max_minutes_until_departure away.
+    max_departures_per_stop and max_departures_per_mode stop one busy stop or mode from taking up the whole board.
+    """
+    every_departure = []
+    departures_per_stop = {}
+    departures_per_mode = {}
+    
+    for departure in heapq.merge(*departure_streams, key=lambda departure: departure["departure_time"]):
+        # Exclude departures that are less than 0 minutes until departure
+        if departure["minutes_until_departure"] < 0:
+            continue
+        
+        # Everything after this is even further away, so no need to look at any more
+        if max_minutes_until_departure is not None and departure["minutes_until_departure"] > max_minutes_until_departure:
+            break
+        
+        # Skip this departure if its stop or mode already has as many as it's allowed
+        stop_id = departure["stop_id"]
+        if max_departures_per_stop is not None and departures_per_stop.get(stop_id, 0) >= max_departures_per_stop:
+            continue
+        type_of_transport = departure["type_of_transport"]
+        mode_limit = max_departures_per_mode.get(type_of_transport) if max_departures_per_mode else None
+        if mode_limit is not None and departures_per_mode.get(type_of_transport, 0) >= mode_limit:
+            continue
+        
+        every_departure.append(departure)
+        departures_per_stop[stop_id] = departures_per_stop.get(stop_id, 0) + 1
+        departures_per_mode[type_of_transport] = departures_per_mode.get(type_of_transport, 0) + 1
+        
+        if max_departures is not None and len(every_departure) >= max_departures:
+            break
+    
+    return every_departure
+
+
+def seconds_until_next_poll(jobs, now):
+    """
+    How long to sleep before something needs to happen - the next job's deadline, or the next output refresh, whichever is sooner.
+    """
+    wait = output_refresh_in_seconds
+    deadlines = [poll_schedule[job["key"]]["next_poll"] for job in jobs if job["key"] in poll_schedule]
+    if deadlines:
+        wait = min(wait, min(deadlines) - now)
+    
+    # If we've run out of requests this minute, there's no point waking up until one frees up
+    if departure_source != "gtfs_realtime" and len(recent_request_times) >= max_requests_per_minute:
+        wait = max(wait, recent_request_times[0] + 60 - now)
+    
+    return max(wait, 1)
+
+
+def main():
+    """
+    Poll any stops that are due, then update the terminal and JSON output for every board.
+    
+    Each departure has its actual departure time, so the minutes until departure are all worked out against the same clock here
+    (and again by the board in the browser), however long ago each stop was polled.
+    
+    Returns:
+        float: Seconds to wait before calling main() again.
+    """
+    # Every board's stops are polled together, so a stop that's on more than one board is only fetched once
+    jobs = build_poll_jobs(shared_stations([board["stops"] for board in boards_to_show]))
+    
+    # Get the departures for each stop that is due for a refresh
+    cycle_start = time.perf_counter()
+    refresh_network_alerts(time.time())
+    polled = poll_due_jobs(jobs, time.time())
+    log.debug("Polled %s of %s stops", polled, len(jobs))
+    
+    for board in boards_to_show:
+        # Merge the board's stops' departures into one list sorted by minutes until departure, leaving out anything that has left or won't fit on the board
+        with metrics.timed("merge_seconds"):
+            every_departure = merge_departures(board_departure_streams(board["stops"], jobs, time.time()))
+            if service_alerts_source == "add_info":
+                attach_network_alerts(every_departure)
+        
+        # Print the departures in the terminal
+        if board["name"] is not None:
+            print(f"Board: {board['name']}")
+        print_in_terminal(every_departure)
+
+        # JSON - generate the JSON file which will be used by the html/css/javascript frontend file
+        with metrics.timed("serialise_seconds"):
+            if serve_board:
+                # Or just hand it to the web server, which only tells the screens about it if something actually changed
+                board_server.publish_departures(build_output(every_departure), board["name"])
+            else:
+                generate_json_output(every_departure, board["output_path"])
+    
+    metrics.observe("cycle_seconds", time.perf_counter() - cycle_start)
+    if metrics_stats_path:
+        try:
+            metrics.write_stats_file(metrics_stats_path)
+        except Exception as e:
+            log.warning(f"Error saving stats file: {e}")
+    
+    return seconds_until_next_poll(jobs, time.time())
+
+
+stops_to_show = None
+boards_to_show = None  # [{"name", "stops", "output_path"}] - set up in __main__, from boards or stops_to_show
+platform_return_raw = False
+gtfs_index = None
+timetable = None
+departure_recorder = None
+delay_tracker = None
+refresh_stop_id_cache = False
+
 refresh_coutner = 0
 if __name__ == "__main__":
-    while True:  # Run indefinitely
-        max_retries = 3
-        for attempt in range(max_retries):
+    parser = argparse.ArgumentParser(description="TfNSW departure monitor")
+    parser.add_argument("--refresh-stop-cache", action="store_true", help="Look up every station's stop ID again, instead of using the saved stop IDs")
+    parser.add_argument("--serve", action="store_true", help="Serve the board over HTTP instead of writing output.json")
+    parser.add_argument("--port", type=int, default=server_port, help=f"Port for --serve (default {server_port})")
+    parser.add_argument("--record", metavar="FOLDER", help="Save every API response to this folder (see replay.py)")
+    parser.add_argument("--replay", metavar="FOLDER", help="Answer API requests from responses saved with --record, instead of calling the API")
+    parser.add_argument("--near", metavar="LAT,LON", help="Show every stop near this location instead of asking for station names (see stop_locations_path)")
+    parser.add_argument("--radius", type=float, default=400, help="How far from --near to look, in metres (default 400)")
+    parser.add_argument("--modes", help="Only these modes for --near, e.g., train,bus (default every mode)")
+    parser.add_argument("--boards", metavar="FILE", help="Load the boards from this JSON file (same format as boards above)")
+    parser.add_argument("--log-level", default=log_level, choices=["DEBUG", "INFO", "WARNING", "ERROR"], help=f"How much to print (default {log_level})")
+    parser.add_argument("--metrics", action="store_true", help="Time each part of every refresh, served at /metrics with --serve (see metrics.py)")
+    parser.add_argument("--history", metavar="FILE", default=history_path, help="Keep every departure fetched in this SQLite database (see departure_history.py)")
+    parser.add_argument("--stats-file", metavar="FILE", default=metrics_stats_path, help="Save the timings to this JSON file after every refresh")
+    args = parser.parse_args()
+    refresh_stop_id_cache = args.refresh_stop_cache
+    
+    # Just the message, so it looks the same as it did when everything was print()ed
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+    metrics_stats_path = args.stats_file
+    metrics.metrics_enabled = collect_metrics or args.metrics or bool(metrics_stats_path)
+    if poll_worker_processes and metrics.metrics_enabled:
+        # The timings would be collected in the worker processes, where nothing reports them
+        log.warning("Metrics are turned on, so polling in this process rather than in poll_worker_processes worker processes")
+        poll_worker_processes = 0
+    if poll_worker_processes and departure_source == "gtfs_realtime":
+        # One download of each feed does for every stop, which splitting the stops up would turn into one download per worker
+        log.warning("departure_source is gtfs_realtime, so polling in this process rather than in poll_worker_processes worker processes")
+        poll_worker_processes = 0
+    
+    gtfs_index = gtfs_static.load_gtfs_index(gtfs_index_path)
+    timetable = gtfs_timetable.load_timetable(gtfs_timetable_path)
+    if args.history:
+        departure_recorder = departure_history.DepartureRecorder(args.history)
+        log.info(f"Recording departure history to {args.history}")
+    if collect_delay_stats:
+        delay_tracker = delay_stats.DelayTracker(delay_stats_half_life_minutes * 60, delay_stats_late_minutes * 60)
+    
+    replay_path = args.replay
+    record_path = args.record
+    mount_replay_and_record()
+    serve_board = serve_board or args.serve
+    
+    if args.boards:
+        with open(args.boards, "r") as file:
+            boards = json.load(file)
+    
+    if boards:
+        # Several boards - look up the stop IDs for any that were given as a string, and show formatted platform names like preconfigured_stops
+        boards_to_show = []
+        for board_name, board in boards.items():
+            board_stops = board["stops"]
+            if isinstance(board_stops, str):
+                board_stops = get_station_ids_from_station_names_and_modes(board_stops)
+            elif isinstance(board_stops, dict):
+                # Every stop near a location
+                board_stops = get_stations_near(*board_stops["near"], board_stops.get("radius_metres", 400), board_stops.get("modes"))
+            boards_to_show.append({"name": board_name, "stops": board_stops, "output_path": board.get("output_path", f"output_{board_name}.json")})
+        platform_return_raw = False
+    elif args.near:
+        latitude, longitude = (float(coordinate) for coordinate in args.near.split(","))
+        stops_to_show = get_stations_near(latitude, longitude, args.radius, args.modes.split(",") if args.modes else None)
+        platform_return_raw = False
+    # if preconfigured_stops is commented out, then as for the user input
+    elif preconfigured_stops is None:
+        # Get user input for station names and modes
+        user_input = input("Enter station names and modes (e.g., 'Parramatta (train, bus); Parramatta Square (light_rail); Parramatta Wharf (ferry)'): ")
+        
+        # Use the user input to get the station IDs and modes
+        stops_to_show = get_station_ids_from_station_names_and_modes(user_input)
+        
+        # Show all platform information
+        platform_return_raw = True
+    else:
+        # preconfigured_stops does exist, use that
+        stops_to_show = preconfigured_stops
+        platform_return_raw = False # Show the formatted platform name for your hardcoded station
+    if not boards:
+        boards_to_show = [{"name": None, "stops": stops_to_show, "output_path": output_path}]
+
+    if serve_board:
+        board_server.start_server(port=args.port)
+
+    try:
+        while True:  # Run indefinitely
             try:
-                main()
+                wait_in_seconds = main()
                 refresh_coutner += 1
-                print(f"Refresh count: {refresh_coutner}")
-                break  # Exit the retry loop if main() succeeds
+                log.info(f"Refresh count: {refresh_coutner}")
             except Exception as e:
-                print(f"Attempt {attempt + 1} failed with error: {e}")
-                if attempt == max_retries - 1:
-                    print("Maximum retries reached. Skipping this cycle.")
-                    break  # Skip to the next cycle after max retries
-            print(f"Retrying in {refresh_in_seconds} seconds...")
-            time.sleep(refresh_in_seconds)
-        print(f"Waiting {refresh_in_seconds} seconds before the next run...")
-        time.sleep(refresh_in_seconds)
+                # Failed requests are already retried per stop by the scheduler, so this is only for unexpected errors
+                log.error(f"Refresh failed with error: {e}")
+                wait_in_seconds = min_poll_interval_seconds
+            log.info(f"Waiting {wait_in_seconds:.0f} seconds before the next run...")
+            time.sleep(wait_in_seconds)
+    finally:
+        # e.g., Ctrl+C - write the last of the history before stopping
+        if departure_recorder is not None:
+            departure_recorder.close()
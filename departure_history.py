@@ -0,0 +1,269 @@
+"""
+Keeps every departure the board has seen in a local SQLite database, so punctuality can be looked at over weeks or months.
+
+    recorder = DepartureRecorder("history.sqlite")
+    recorder.record(departures)    - called every refresh, returns straight away
+    recorder.close()               - write anything still waiting
+
+Each departure is stored once per trip and stop, and updated as its estimated time changes, so the last estimate before it left is
+what's kept. Writes happen on a background thread, batched into one transaction every flush_seconds, so a slow disk never holds up
+polling. Departures that haven't changed since they were last written are skipped before they get to the database at all.
+
+To look at the history:
+
+    python departure_history.py summary history.sqlite --stop 10101229 --line T1 --days 30
+    python departure_history.py departures history.sqlite --stop 10101229 --days 1
+
+or query_departures() and punctuality_summary() from Python.
+"""
+
+import argparse
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+schema = """
+CREATE TABLE IF NOT EXISTS departures (
+    stop_id TEXT NOT NULL,
+    line TEXT NOT NULL,
+    planned_time INTEGER NOT NULL,
+    trip_id TEXT NOT NULL,  -- The realtime trip ID, or "" for a timetabled departure
+    type_of_transport TEXT,
+    stop_name TEXT,
+    destination TEXT,
+    estimated_time INTEGER,
+    delay_seconds INTEGER,
+    realtime INTEGER,
+    occupancy TEXT,
+    first_seen INTEGER,
+    last_seen INTEGER,
+    PRIMARY KEY (stop_id, planned_time, line, trip_id)
+) WITHOUT ROWID;
+-- The delay and realtime columns are in the indexes too, so punctuality_summary() never has to read the table itself
+CREATE INDEX IF NOT EXISTS departures_by_line ON departures (line, planned_time, delay_seconds, realtime);
+CREATE INDEX IF NOT EXISTS departures_by_time ON departures (planned_time, line, delay_seconds, realtime);
+"""
+
+# Keep the estimate, delay and occupancy up to date, but remember when the departure was first seen
+upsert_sql = """
+INSERT INTO departures (stop_id, line, planned_time, trip_id, type_of_transport, stop_name, destination, estimated_time,
+                        delay_seconds, realtime, occupancy, first_seen, last_seen)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (stop_id, planned_time, line, trip_id) DO UPDATE SET
+    estimated_time = excluded.estimated_time,
+    delay_seconds = excluded.delay_seconds,
+    realtime = excluded.realtime,
+    occupancy = excluded.occupancy,
+    last_seen = excluded.last_seen
+"""
+
+
+def open_database(database_path):
+    connection = sqlite3.connect(database_path, timeout=30)
+    # Write ahead logging, so reading the history (e.g., with the summary command) doesn't block the recorder, or the other way round
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(schema)
+    return connection
+
+
+def departure_row(departure, seen_at):
+    """
+    The database row for a departure from get_departures() (or any of the other departure sources).
+
+    Returns:
+        tuple: The values in the same order as upsert_sql.
+    """
+    planned_time = departure.get("departure_time_planned") or departure["departure_time"]
+    estimated_time = departure.get("departure_time_estimated")
+    delay_seconds = estimated_time - planned_time if estimated_time is not None else None
+    return (
+        departure["stop_id"],
+        departure["line"],
+        planned_time,
+        departure.get("realtime_trip_id") or "",
+        departure["type_of_transport"],
+        departure["stop_name"],
+        departure["destination"],
+        estimated_time,
+        delay_seconds,
+        1 if departure["isRealtimeControlled"] else 0,
+        departure.get("occupancy"),
+        seen_at,
+        seen_at,
+    )
+
+
+class DepartureRecorder:
+    """
+    Writes departures to the history database on a background thread.
+
+    Args:
+        database_path (str): The SQLite database (created if it doesn't exist).
+        flush_seconds (float): How often to write what's been recorded, as one transaction.
+    """
+
+    def __init__(self, database_path, flush_seconds=10):
+        self.database_path = database_path
+        self.flush_seconds = flush_seconds
+        self.queue = queue.Queue()
+        # (stop_id, line, planned_time, trip_id) -> (estimated_time, occupancy) as last written, so unchanged departures are skipped
+        self.last_written = {}
+        self.rows_written = 0
+        open_database(database_path).close()  # Create it now, so a bad path shows up straight away rather than on the thread
+        self.thread = threading.Thread(target=self.write_loop, name="departure-recorder", daemon=True)
+        self.thread.start()
+
+    def record(self, departures):
+        """
+        Queue some departures to be written. Returns straight away.
+        """
+        if departures:
+            self.queue.put((int(time.time()), departures))
+
+    def write_loop(self):
+        connection = open_database(self.database_path)
+        stopping = False
+        while not stopping:
+            # Wait for the first lot, then take everything else that's arrived in the next flush_seconds
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while True:
+                timeout = deadline - time.monotonic()
+                if batch[-1] is None or timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                stopping = True
+                batch.pop()
+
+            try:
+                self.write_batch(connection, batch)
+            except Exception as e:
+                log.error(f"Error writing departure history: {e}")
+        connection.close()
+
+    def write_batch(self, connection, batch):
+        # The same departure usually comes up in every refresh of the batch, so only its latest version is written
+        rows = {}
+        for seen_at, departures in batch:
+            for departure in departures:
+                row = departure_row(departure, seen_at)
+                key = row[:4]
+                if key in rows:
+                    row = row[:11] + (rows[key][11],) + row[12:]  # Keep the earliest first_seen
+                rows[key] = row
+
+        changed = [row for key, row in rows.items() if self.last_written.get(key) != (row[7], row[10])]
+        if changed:
+            with connection:
+                connection.executemany(upsert_sql, changed)
+            self.rows_written += len(changed)
+        for row in changed:
+            self.last_written[row[:4]] = (row[7], row[10])
+
+        # Forget about departures that left over an hour ago, so last_written doesn't keep growing
+        cutoff = time.time() - 3600
+        for key in [key for key in self.last_written if key[2] < cutoff]:
+            del self.last_written[key]
+        log.debug("Departure history: %s of %s departures changed", len(changed), len(rows))
+
+    def close(self):
+        """
+        Write anything still queued, then stop the background thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+def query_departures(database_path, stop_id=None, line=None, start=None, end=None):
+    """
+    Departures from the history, oldest first.
+
+    Args:
+        database_path (str): The history database.
+        stop_id (str): Only this stop.
+        line (str): Only this line (e.g., "T1").
+        start (float): Only departures planned for this unix timestamp or later.
+        end (float): Only departures planned before this unix timestamp.
+
+    Returns:
+        list: One dict per departure, with the same columns as the database.
+    """
+    where, params = filters(stop_id, line, start, end)
+    connection = open_database(database_path)
+    connection.row_factory = lambda cursor, row: dict(zip([column[0] for column in cursor.description], row))
+    try:
+        rows = connection.execute(f"SELECT * FROM departures {where} ORDER BY planned_time", params).fetchall()
+    finally:
+        connection.close()
+    return rows
+
+
+def punctuality_summary(database_path, stop_id=None, line=None, start=None, end=None, on_time_seconds=300):
+    """
+    How punctual the realtime departures were - takes the same filters as query_departures().
+
+    Args:
+        on_time_seconds (int): Leaving up to this much later than planned still counts as on time (TfNSW uses 5 minutes for trains).
+
+    Returns:
+        list: {"line", "departures", "on_time_percent", "average_delay_seconds", "worst_delay_seconds"} for each line, busiest first.
+    """
+    where, params = filters(stop_id, line, start, end)
+    where += (" AND " if where else "WHERE ") + "realtime = 1 AND delay_seconds IS NOT NULL"
+    connection = open_database(database_path)
+    try:
+        rows = connection.execute(f"""
+            SELECT line, COUNT(*), AVG(delay_seconds <= ?) * 100, AVG(delay_seconds), MAX(delay_seconds)
+            FROM departures {where}
+            GROUP BY line
+            ORDER BY COUNT(*) DESC
+        """, [on_time_seconds] + params).fetchall()
+    finally:
+        connection.close()
+    return [
+        {"line": line, "departures": count, "on_time_percent": on_time, "average_delay_seconds": average_delay, "worst_delay_seconds": worst_delay}
+        for line, count, on_time, average_delay, worst_delay in rows
+    ]
+
+
+def filters(stop_id, line, start, end):
+    """
+    The WHERE clause (and its parameters) for the history queries.
+    """
+    conditions, params = [], []
+    for condition, value in (("stop_id = ?", stop_id), ("line = ?", line), ("planned_time >= ?", start), ("planned_time < ?", end)):
+        if value is not None:
+            conditions.append(condition)
+            params.append(int(value) if isinstance(value, float) else value)
+    return ("WHERE " + " AND ".join(conditions)) if conditions else "", params
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Look at the departure history recorded by dep_mon12.py")
+    parser.add_argument("command", choices=["summary", "departures"])
+    parser.add_argument("database", help="The history database (history_path in dep_mon12.py)")
+    parser.add_argument("--stop", help="Only this stop ID")
+    parser.add_argument("--line", help="Only this line, e.g., T1")
+    parser.add_argument("--days", type=float, default=7, help="How many days back to look (default 7)")
+    args = parser.parse_args()
+
+    start = time.time() - args.days * 24 * 60 * 60
+    if args.command == "summary":
+        print(f"{'line':<10} {'departures':>10} {'on time':>8} {'avg delay':>10} {'worst':>8}")
+        for summary in punctuality_summary(args.database, args.stop, args.line, start):
+            print(f"{summary['line']:<10} {summary['departures']:>10} {summary['on_time_percent']:>7.1f}% "
+                  f"{summary['average_delay_seconds'] / 60:>8.1f} m {summary['worst_delay_seconds'] / 60:>6.0f} m")
+    else:
+        for departure in query_departures(args.database, args.stop, args.line, start):
+            planned = time.strftime("%Y-%m-%d %H:%M", time.localtime(departure["planned_time"]))
+            delay = f"{departure['delay_seconds'] / 60:+.0f} m" if departure["delay_seconds"] is not None else "timetabled"
+            print(f"{planned}  {departure['line']:<6} {departure['destination']:<30} {departure['stop_name']:<30} {delay}")
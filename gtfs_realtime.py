@@ -0,0 +1,408 @@
+"""
+Departures for every stop at once, from the TfNSW GTFS-Realtime TripUpdates feeds (https://opendata.transport.nsw.gov.au/ - "Public
+Transport - Realtime Trip Update"), instead of one departure_mon call per stop.
+
+Each feed covers a whole mode (e.g., every Sydney Trains trip), so it's fetched once and decoded into an index of the departures at
+each stop, and every stop on every board is then looked up from that. That's one API call per mode rather than one per stop, however
+many stops there are.
+
+    index = build_trip_update_index(feed_bytes, gtfs_index.parent_station)
+    index.departures("200060")    - every realtime departure from Central (and its platforms), soonest first
+
+The feed only has trip, route and stop IDs, so dep_mon12.py joins them against the GTFS index (see gtfs_static.py) to get each
+departure's line, destination and platform name.
+
+A feed doesn't have every stop of every trip - some stops only have a delay rather than a time, a delay applies to the stops after it
+until the next update, and trips running to time might not be in it at all. So with the GTFS timetable (see gtfs_timetable.py),
+dep_mon12.py starts from the scheduled departures instead, and asks the index when each one will really leave:
+
+    index.estimated_departure("1234.T1.1-1", "2000338", 12, planned_time)    - planned_time plus the latest delay before stop 12
+
+The feeds are protocol buffers. Rather than needing the protobuf and gtfs-realtime-bindings packages, only the few fields we need are
+read straight out of the bytes (https://protobuf.dev/programming-guides/encoding/), and everything else is skipped over.
+"""
+
+import bisect
+import time
+
+# GTFS-Realtime field numbers (https://gtfs.org/realtime/reference/) - only the ones we read
+FEED_HEADER, FEED_ENTITY = 1, 2  # FeedMessage
+HEADER_TIMESTAMP = 3  # FeedHeader
+ENTITY_TRIP_UPDATE = 3  # FeedEntity
+TRIP_UPDATE_TRIP, TRIP_UPDATE_STOP_TIME_UPDATE = 1, 2  # TripUpdate
+TRIP_ID, TRIP_ROUTE_ID, TRIP_SCHEDULE_RELATIONSHIP = 1, 5, 4  # TripDescriptor
+STOP_TIME_SEQUENCE, STOP_TIME_ARRIVAL, STOP_TIME_DEPARTURE, STOP_TIME_STOP_ID, STOP_TIME_SCHEDULE_RELATIONSHIP = 1, 2, 3, 4, 5  # StopTimeUpdate
+EVENT_DELAY, EVENT_TIME = 1, 2  # StopTimeEvent
+
+TRIP_CANCELED = 3  # TripDescriptor.ScheduleRelationship
+STOP_SKIPPED, STOP_NO_DATA = 1, 2  # StopTimeUpdate.ScheduleRelationship
+
+# What estimated_departure() gives for a trip that's been cancelled, or won't stop there any more
+NOT_STOPPING = -1
+
+# Protobuf wire types
+VARINT, FIXED64, LENGTH_DELIMITED, FIXED32 = 0, 1, 2, 5
+
+
+def read_varint(buffer, position):
+    """
+    Read a protobuf varint.
+
+    Returns:
+        tuple: (value, position just after it)
+    """
+    byte = buffer[position]
+    if byte < 0x80:
+        return byte, position + 1  # Most of them are a single byte
+    result = byte & 0x7F
+    shift = 7
+    while True:
+        position += 1
+        byte = buffer[position]
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, position + 1
+        shift += 7
+
+
+def signed(value):
+    # int32 and int64 fields store negative numbers as 64 bit two's complement
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def read_fields(buffer, start, end):
+    """
+    Read the fields of a protobuf message.
+
+    Returns:
+        list: (field number, value) for every field - the number for varints and fixed fields, or (start, end) of the bytes for
+        length delimited ones (strings and embedded messages).
+    """
+    fields = []
+    position = start
+    while position < end:
+        key, position = read_varint(buffer, position)
+        wire_type = key & 7
+        if wire_type == VARINT:
+            value, position = read_varint(buffer, position)
+        elif wire_type == LENGTH_DELIMITED:
+            length, position = read_varint(buffer, position)
+            value = (position, position + length)
+            position += length
+        elif wire_type == FIXED64:
+            value = int.from_bytes(buffer[position:position + 8], "little")
+            position += 8
+        elif wire_type == FIXED32:
+            value = int.from_bytes(buffer[position:position + 4], "little")
+            position += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type} at byte {position}")
+        fields.append((key >> 3, value))
+    return fields
+
+
+def read_stop_time_event(buffer, start, end):
+    """
+    Returns:
+        tuple: (time, delay) from a StopTimeEvent - either can be None.
+    """
+    event_time = delay = None
+    for field_number, value in read_fields(buffer, start, end):
+        if field_number == EVENT_TIME:
+            event_time = signed(value)
+        elif field_number == EVENT_DELAY:
+            delay = signed(value)
+    return event_time, delay
+
+
+def departure_event(departure, arrival):
+    """
+    The (time, delay) to use for a stop - the departure, or the arrival if there's no departure time (e.g., the first stop only has
+    a departure, and some feeds only send arrivals). Failing that, whichever has a delay, with no time.
+    """
+    for event in (departure, arrival):
+        if event is not None and event[0] is not None:
+            return event
+    for event in (departure, arrival):
+        if event is not None and event[1] is not None:
+            return event
+    return None, None
+
+
+def iter_raw_fields(buffer, start, end):
+    """
+    Same as read_fields, but also gives where each whole field (key and value) starts and ends, so it can be copied as it is.
+
+    Returns:
+        iterator: (field number, wire type, value, field start, field end) for every field.
+    """
+    position = start
+    while position < end:
+        field_start = position
+        key, position = read_varint(buffer, position)
+        wire_type = key & 7
+        if wire_type == VARINT:
+            value, position = read_varint(buffer, position)
+        elif wire_type == LENGTH_DELIMITED:
+            length, position = read_varint(buffer, position)
+            value = (position, position + length)
+            position += length
+        elif wire_type == FIXED64:
+            value = int.from_bytes(buffer[position:position + 8], "little")
+            position += 8
+        elif wire_type == FIXED32:
+            value = int.from_bytes(buffer[position:position + 4], "little")
+            position += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type} at byte {position}")
+        yield key >> 3, wire_type, value, field_start, position
+
+
+def encode_varint(value):
+    if value < 0:
+        value += 1 << 64  # Negative int32/int64 values are sent as 64 bit two's complement
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def encode_field(field_number, value):
+    """
+    Encode one protobuf field - a varint for ints, length delimited for bytes and strings.
+    """
+    if isinstance(value, int):
+        return encode_varint(field_number << 3 | VARINT) + encode_varint(value)
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return encode_varint(field_number << 3 | LENGTH_DELIMITED) + encode_varint(len(value)) + value
+
+
+# Where the timestamps are in a feed - message type -> {field number: the embedded message's type, or "time"}
+timestamp_fields = {
+    "feed": {FEED_HEADER: "header", FEED_ENTITY: "entity"},
+    "header": {HEADER_TIMESTAMP: "time"},
+    "entity": {ENTITY_TRIP_UPDATE: "trip_update"},
+    "trip_update": {TRIP_UPDATE_STOP_TIME_UPDATE: "stop_time_update", 4: "time"},  # 4 is when the vehicle was last measured
+    "stop_time_update": {STOP_TIME_ARRIVAL: "stop_time_event", STOP_TIME_DEPARTURE: "stop_time_event"},
+    "stop_time_event": {EVENT_TIME: "time"},
+}
+
+
+def shift_feed_times(feed, seconds, message_type="feed", start=0, end=None):
+    """
+    Move every timestamp in a TripUpdates feed forward by the given number of seconds. Used to make an old recording look like it
+    was just fetched (like replay.shift_timestamps() does for departure_mon), so its departures aren't all in the past.
+
+    Returns:
+        bytes: The feed with the new times - everything else is copied across unchanged.
+    """
+    end = len(feed) if end is None else end
+    fields = timestamp_fields.get(message_type, {})
+    shifted = bytearray()
+    for field_number, wire_type, value, field_start, field_end in iter_raw_fields(feed, start, end):
+        field_type = fields.get(field_number)
+        if field_type == "time" and wire_type == VARINT:
+            shifted += encode_field(field_number, signed(value) + int(seconds))
+        elif field_type is not None and wire_type == LENGTH_DELIMITED:
+            shifted += encode_field(field_number, shift_feed_times(feed, seconds, field_type, *value))
+        else:
+            shifted += feed[field_start:field_end]
+    return bytes(shifted)
+
+
+def feed_timestamp(feed):
+    """
+    When a feed was generated (the header timestamp, as a unix timestamp), or None if it doesn't say.
+    """
+    for field_number, value in read_fields(feed, 0, len(feed)):
+        if field_number == FEED_HEADER:
+            for header_field, header_value in read_fields(feed, *value):
+                if header_field == HEADER_TIMESTAMP:
+                    return header_value
+            return None
+    return None
+
+
+class TripUpdateIndex:
+    """
+    The departures in a TripUpdates feed, by stop, and every update for each trip.
+
+    Each departure is a tuple: (departure time, planned departure time, trip ID, route ID, stop ID) - times are unix timestamps, and
+    the stop ID is the platform it leaves from.
+
+    Each trip's updates are a list of (stop_sequence, stop ID, station ID, time, delay, schedule relationship), in the order the feed
+    sent them (which is the order of the trip's stops). Anything the feed didn't say is None.
+    """
+
+    def __init__(self, departures_by_stop, feed_timestamp, trip_count, trip_updates=None, cancelled_trips=None):
+        self.departures_by_stop = departures_by_stop
+        self.feed_timestamp = feed_timestamp
+        self.trip_count = trip_count
+        self.trip_updates = trip_updates or {}
+        self.cancelled_trips = cancelled_trips or set()
+
+    def departures(self, stop_id, after=None):
+        """
+        Every departure from a stop (or any of its platforms, if it's a station), soonest first.
+
+        Args:
+            stop_id (str): The GTFS stop ID.
+            after (float): Leave out anything leaving before this unix timestamp.
+        """
+        departures = self.departures_by_stop.get(stop_id, [])
+        if after is not None:
+            departures = departures[bisect.bisect_left(departures, (after,)):]
+        return departures
+
+    def estimated_departure(self, trip_id, stop_id, stop_sequence, planned_time, station_id=None):
+        """
+        When a scheduled departure (e.g., from the GTFS timetable) will really leave, going by the feed - its own update if it has
+        one, otherwise the latest delay from the stops before it (as the GTFS-Realtime spec says a delay carries on to later stops).
+
+        Args:
+            trip_id (str): The GTFS trip ID.
+            stop_id (str): The stop (platform) it's scheduled to leave from.
+            stop_sequence (int): Where that stop is in the trip (stop_times.txt's stop_sequence). None if it isn't known, in which
+                case updates are put in order by their planned times instead.
+            planned_time (int): When it's scheduled to leave (unix timestamp).
+            station_id (str): The station the stop is part of, so an update for another platform there (a platform change) counts.
+
+        Returns:
+            tuple: (departure time, stop ID it leaves from), None if the feed doesn't say anything about it (so it's running to the
+            timetable, as far as anyone knows), or NOT_STOPPING if the trip is cancelled or won't stop there any more.
+        """
+        if trip_id in self.cancelled_trips:
+            return NOT_STOPPING
+        updates = self.trip_updates.get(trip_id)
+        if not updates:
+            return None
+
+        delay = None
+        for update_sequence, update_stop, update_station, event_time, update_delay, relationship in updates:
+            if update_sequence is not None and stop_sequence is not None:
+                this_stop = update_sequence == stop_sequence
+                before = update_sequence < stop_sequence
+            else:
+                this_stop = update_stop == stop_id or (station_id is not None and update_station == station_id)
+                before = not this_stop and event_time is not None and event_time - (update_delay or 0) <= planned_time
+            if this_stop:
+                if relationship == STOP_SKIPPED:
+                    return NOT_STOPPING
+                if relationship == STOP_NO_DATA:
+                    return None
+                if event_time is not None:
+                    return event_time, update_stop or stop_id
+                if update_delay is not None:
+                    return planned_time + update_delay, update_stop or stop_id
+                break  # Nothing for this stop after all, so it's the delay from before it
+            if before:
+                if relationship == STOP_NO_DATA:
+                    delay = None  # The delay doesn't carry on past a stop with no data
+                elif update_delay is not None:
+                    delay = update_delay
+        if delay is None:
+            return None
+        return planned_time + delay, stop_id
+
+    def __len__(self):
+        return sum(len(departures) for departures in self.departures_by_stop.values())
+
+
+def build_trip_update_index(feed, parent_station=None):
+    """
+    Decode a TripUpdates feed into an index of departures by stop.
+
+    Args:
+        feed (bytes): The raw feed, exactly as the API sent it.
+        parent_station (function): Looks up the station a platform belongs to (e.g., GTFSIndex.parent_station), so departures can be
+            found by station as well as by platform. None to only index them by platform.
+
+    Returns:
+        TripUpdateIndex: The index.
+
+    Cancelled trips and skipped stops are left out of the departures by stop, and so are stops without a realtime time (only a delay,
+    or no data at all) - they're only in the trip's updates, for estimated_departure().
+    """
+    departures_by_stop = {}
+    trip_updates = {}
+    cancelled_trips = set()
+    parents = {}  # Cache of parent_station() - the same few thousand stops come up over and over again
+    feed_timestamp = None
+    trip_count = 0
+
+    def parent_of(stop_id):
+        if parent_station is None or stop_id is None:
+            return None
+        if stop_id not in parents:
+            parents[stop_id] = parent_station(stop_id)
+        return parents[stop_id]
+
+    for field_number, value in read_fields(feed, 0, len(feed)):
+        if field_number == FEED_HEADER:
+            for header_field, header_value in read_fields(feed, *value):
+                if header_field == HEADER_TIMESTAMP:
+                    feed_timestamp = header_value
+            continue
+        if field_number != FEED_ENTITY:
+            continue
+
+        for entity_field, (trip_update_start, trip_update_end) in read_fields(feed, *value):
+            if entity_field != ENTITY_TRIP_UPDATE:
+                continue
+
+            trip_id = route_id = None
+            cancelled = False
+            stop_time_updates = []
+            for trip_update_field, trip_update_value in read_fields(feed, trip_update_start, trip_update_end):
+                if trip_update_field == TRIP_UPDATE_STOP_TIME_UPDATE:
+                    stop_time_updates.append(trip_update_value)
+                elif trip_update_field == TRIP_UPDATE_TRIP:
+                    for trip_field, trip_value in read_fields(feed, *trip_update_value):
+                        if trip_field == TRIP_ID:
+                            trip_id = feed[trip_value[0]:trip_value[1]].decode("utf-8")
+                        elif trip_field == TRIP_ROUTE_ID:
+                            route_id = feed[trip_value[0]:trip_value[1]].decode("utf-8")
+                        elif trip_field == TRIP_SCHEDULE_RELATIONSHIP and trip_value == TRIP_CANCELED:
+                            cancelled = True
+            if trip_id is None:
+                continue
+            if cancelled:
+                cancelled_trips.add(trip_id)
+                continue
+            trip_count += 1
+
+            updates = trip_updates[trip_id] = []
+            for stop_time_update_start, stop_time_update_end in stop_time_updates:
+                stop_id = stop_sequence = None
+                departure = arrival = None
+                relationship = None
+                for stop_field, stop_value in read_fields(feed, stop_time_update_start, stop_time_update_end):
+                    if stop_field == STOP_TIME_STOP_ID:
+                        stop_id = feed[stop_value[0]:stop_value[1]].decode("utf-8")
+                    elif stop_field == STOP_TIME_SEQUENCE:
+                        stop_sequence = stop_value
+                    elif stop_field == STOP_TIME_DEPARTURE:
+                        departure = read_stop_time_event(feed, *stop_value)
+                    elif stop_field == STOP_TIME_ARRIVAL:
+                        arrival = read_stop_time_event(feed, *stop_value)
+                    elif stop_field == STOP_TIME_SCHEDULE_RELATIONSHIP and stop_value in (STOP_SKIPPED, STOP_NO_DATA):
+                        relationship = stop_value
+
+                event_time, delay = departure_event(departure, arrival)
+                updates.append((stop_sequence, stop_id, parent_of(stop_id), event_time, delay, relationship))
+                if relationship is not None or stop_id is None or event_time is None:
+                    continue
+                planned_time = event_time - (delay or 0)
+                record = (event_time, planned_time, trip_id, route_id, stop_id)
+
+                departures_by_stop.setdefault(stop_id, []).append(record)
+                parent = parent_of(stop_id)
+                if parent:
+                    departures_by_stop.setdefault(parent, []).append(record)
+
+    for departures in departures_by_stop.values():
+        departures.sort()
+    return TripUpdateIndex(departures_by_stop, feed_timestamp or int(time.time()), trip_count, trip_updates, cancelled_trips)
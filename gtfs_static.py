@@ -0,0 +1,345 @@
+"""
+Line colours and platform names from the TfNSW GTFS static timetable (https://opendata.transport.nsw.gov.au/ - "Timetables Complete GTFS").
+
+The GTFS files are big, so they're only read once, by:
+
+    python gtfs_static.py build path/to/full_greater_sydney_gtfs_static.zip gtfs_index.bin
+
+which saves just the bits we need into a small binary index: route colours from routes.txt and platform names from stops.txt, plus
+each trip's route and destination, each route's line name and mode, and each platform's parent station (for gtfs_realtime.py, which
+only gets trip, route and platform IDs from the realtime feed). The index is a set of hash tables that are memory mapped rather than
+read in, so loading it is practically instant and each lookup only touches the few bytes it needs.
+
+dep_mon12.py uses load_gtfs_index() at startup, then line_colour() and platform_name() for every departure, and falls back to its
+own guesses for anything that isn't in the index.
+"""
+
+import csv
+import io
+import logging
+import mmap
+import os
+import struct
+import sys
+import zipfile
+import zlib
+
+log = logging.getLogger(__name__)
+
+# GTFS route_type -> the type_of_transport names used in dep_mon12.py (TfNSW uses the extended route types for some modes)
+route_type_lookup_table = {
+    "0": "light_rail", "900": "light_rail",
+    "1": "metro", "401": "metro",
+    "2": "train", "100": "train", "106": "train",
+    "3": "bus", "700": "bus", "702": "bus", "704": "bus", "714": "bus",
+    "712": "school_bus",
+    "4": "ferry", "1000": "ferry",
+    "204": "coach",
+}
+
+index_magic = b"TFGTFS02"
+# Indexes built before the trip, route and parent station tables were added - still readable, just without those tables
+old_index_magic = b"TFGTFS01"
+empty_slot = 0xFFFFFFFF
+slot_format = struct.Struct("<III")  # key hash, key offset, value offset
+table_header_format = struct.Struct("<II")  # number of entries, number of slots
+
+
+def open_gtfs_file(gtfs_path, file_name):
+    """
+    Read one of the GTFS text files, from either an unzipped GTFS folder or the zip file itself.
+
+    Args:
+        gtfs_path (str): The GTFS folder or zip file.
+        file_name (str): e.g., "stops.txt"
+
+    Returns:
+        iterator: One dict per row, using the column names from the header.
+    """
+    if zipfile.is_zipfile(gtfs_path):
+        with zipfile.ZipFile(gtfs_path) as gtfs_zip:
+            with gtfs_zip.open(file_name) as file:
+                yield from csv.DictReader(io.TextIOWrapper(file, encoding="utf-8-sig"))
+    else:
+        with open(os.path.join(gtfs_path, file_name), "r", encoding="utf-8-sig", newline="") as file:
+            yield from csv.DictReader(file)
+
+
+def open_gtfs_columns(gtfs_path, file_name, columns):
+    """
+    Same as open_gtfs_file, but only gives the columns asked for, as a tuple per row. Much quicker for the really big files
+    (stop_times.txt has tens of millions of rows), since it doesn't build a dict for every row.
+
+    Args:
+        columns (list): The column names, e.g., ["trip_id", "stop_id"]. A column that isn't in the file comes back as "".
+
+    Returns:
+        iterator: One tuple per row, in the same order as columns.
+    """
+    def read_rows(file):
+        reader = csv.reader(file)
+        header = [name.strip() for name in next(reader, [])]
+        positions = [header.index(column) if column in header else None for column in columns]
+        for row in reader:
+            yield tuple(row[position] if position is not None and position < len(row) else "" for position in positions)
+
+    if zipfile.is_zipfile(gtfs_path):
+        with zipfile.ZipFile(gtfs_path) as gtfs_zip:
+            with gtfs_zip.open(file_name) as file:
+                yield from read_rows(io.TextIOWrapper(file, encoding="utf-8-sig", newline=""))
+    else:
+        with open(os.path.join(gtfs_path, file_name), "r", encoding="utf-8-sig", newline="") as file:
+            yield from read_rows(file)
+
+
+def route_key(line, type_of_transport):
+    """
+    Routes are looked up by mode and line, since the same line name can be used by different modes (e.g., the T1 train and a T1 bus).
+    """
+    return f"{type_of_transport}|{line}"
+
+
+def platform_name_from_stop(stop):
+    """
+    TfNSW platform stops are named like "Central Station, Platform 18" or "Circular Quay, Wharf 4 Side A", so the platform name is
+    the bit after the last comma. Uses the platform_code if the name isn't in that format.
+    """
+    stop_name = stop.get("stop_name", "")
+    if ", " in stop_name:
+        return stop_name.rsplit(", ", 1)[1]
+    return stop.get("platform_code", "")
+
+
+def read_gtfs_metadata(gtfs_path):
+    """
+    Read the route colours and platform names out of the GTFS files.
+
+    Returns:
+        tuple: (route colours, platform names) - {"train|T1": "#F99D1C", ...} and {"2000338": "Platform 18", ...}
+    """
+    route_colours = {}
+    for route in open_gtfs_file(gtfs_path, "routes.txt"):
+        colour = route.get("route_color", "").strip()
+        line = route.get("route_short_name", "").strip()
+        type_of_transport = route_type_lookup_table.get(route.get("route_type", "").strip())
+        if not colour or not line or type_of_transport is None:
+            continue
+        route_colours.setdefault(route_key(line, type_of_transport), f"#{colour.upper()}")
+
+    platform_names = {}
+    for stop in open_gtfs_file(gtfs_path, "stops.txt"):
+        # Only the platforms/stands/wharves (they have a parent station) - the stations themselves don't need a platform name
+        if not stop.get("parent_station"):
+            continue
+        platform_name = platform_name_from_stop(stop)
+        if platform_name:
+            platform_names[stop["stop_id"]] = platform_name
+
+    return route_colours, platform_names
+
+
+def read_gtfs_trip_tables(gtfs_path):
+    """
+    Read what's needed to turn a realtime trip update into a departure out of the GTFS files.
+
+    Returns:
+        tuple: (route details, trip details, parent stations) - {"2-T1-sj2-1": "T1|train", ...}, {"1234.T1.1-1": "2-T1-sj2-1|Emu Plains via Central", ...}
+        and {"2000338": "200060", ...}
+    """
+    route_details = {}
+    for route in open_gtfs_file(gtfs_path, "routes.txt"):
+        type_of_transport = route_type_lookup_table.get(route.get("route_type", "").strip(), "unknown")
+        route_details[route["route_id"]] = f"{route.get('route_short_name', '').strip()}|{type_of_transport}"
+
+    trip_details = {}
+    for trip in open_gtfs_file(gtfs_path, "trips.txt"):
+        trip_details[trip["trip_id"]] = f"{trip['route_id']}|{trip.get('trip_headsign', '').strip()}"
+
+    parent_stations = {}
+    for stop in open_gtfs_file(gtfs_path, "stops.txt"):
+        if stop.get("parent_station"):
+            parent_stations[stop["stop_id"]] = stop["parent_station"]
+
+    return route_details, trip_details, parent_stations
+
+
+def key_hash(key):
+    # crc32 rather than hash(), since hash() of a string changes every time Python starts
+    return zlib.crc32(key.encode("utf-8"))
+
+
+def pack_lookup_table(mapping, start_offset):
+    """
+    Pack a {str: str} dict into an open-addressing hash table, with the strings stored after the slots.
+
+    Args:
+        mapping (dict): The table to pack.
+        start_offset (int): Where in the index file this table will start (the slots store absolute offsets).
+
+    Returns:
+        bytes: The packed table.
+    """
+    slot_count = max(8, 1 << (len(mapping) * 2 - 1).bit_length())  # At most half full, so probing stays short
+    slots = [(0, empty_slot, empty_slot)] * slot_count
+    strings = bytearray()
+    strings_offset = start_offset + table_header_format.size + slot_count * slot_format.size
+
+    def add_string(text):
+        encoded = text.encode("utf-8")
+        offset = strings_offset + len(strings)
+        strings.extend(struct.pack("<H", len(encoded)))
+        strings.extend(encoded)
+        return offset
+
+    for key, value in mapping.items():
+        hashed = key_hash(key)
+        slot = hashed & (slot_count - 1)
+        while slots[slot][1] != empty_slot:
+            slot = (slot + 1) & (slot_count - 1)
+        slots[slot] = (hashed, add_string(key), add_string(value))
+
+    packed = bytearray(table_header_format.pack(len(mapping), slot_count))
+    for slot in slots:
+        packed.extend(slot_format.pack(*slot))
+    packed.extend(strings)
+    return bytes(packed)
+
+
+def build_gtfs_index(gtfs_path, index_path):
+    """
+    Read the GTFS files once and save the index used by load_gtfs_index().
+
+    Args:
+        gtfs_path (str): The GTFS folder or zip file.
+        index_path (str): Where to save the index.
+    """
+    route_colours, platform_names = read_gtfs_metadata(gtfs_path)
+    route_details, trip_details, parent_stations = read_gtfs_trip_tables(gtfs_path)
+    tables = [route_colours, platform_names, route_details, trip_details, parent_stations]
+
+    # File layout: magic, offset of each table, then the tables
+    header_size = len(index_magic) + 4 * len(tables)
+    offsets = []
+    packed_tables = []
+    for table in tables:
+        offsets.append(header_size + sum(len(packed_table) for packed_table in packed_tables))
+        packed_tables.append(pack_lookup_table(table, offsets[-1]))
+
+    with open(index_path + ".tmp", "wb") as file:
+        file.write(index_magic)
+        file.write(struct.pack(f"<{len(tables)}I", *offsets))
+        for packed_table in packed_tables:
+            file.write(packed_table)
+    os.replace(index_path + ".tmp", index_path)  # So a running board never sees half a file
+
+    log.info(f"GTFS index saved to {index_path}: {len(route_colours)} route colours, {len(platform_names)} platforms, {len(trip_details)} trips")
+
+
+class MappedLookupTable:
+    """
+    A {str: str} hash table packed by pack_lookup_table(), read straight out of the memory mapped index.
+    """
+
+    def __init__(self, index, offset):
+        self.index = index
+        self.count, self.slot_count = table_header_format.unpack_from(index, offset)
+        self.slots_offset = offset + table_header_format.size
+
+    def read_string(self, offset):
+        (length,) = struct.unpack_from("<H", self.index, offset)
+        return self.index[offset + 2:offset + 2 + length].decode("utf-8")
+
+    def get(self, key, default=None):
+        hashed = key_hash(key)
+        slot = hashed & (self.slot_count - 1)
+        while True:
+            slot_hash, key_offset, value_offset = slot_format.unpack_from(self.index, self.slots_offset + slot * slot_format.size)
+            if key_offset == empty_slot:
+                return default
+            if slot_hash == hashed and self.read_string(key_offset) == key:
+                return self.read_string(value_offset)
+            slot = (slot + 1) & (self.slot_count - 1)
+
+    def __len__(self):
+        return self.count
+
+
+class GTFSIndex:
+    """
+    Line colour and platform name lookups from a prebuilt GTFS index. Use load_gtfs_index() to open one.
+    """
+
+    def __init__(self, index_path):
+        with open(index_path, "rb") as file:
+            self.index = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self.index[:len(index_magic)]
+        if magic not in (index_magic, old_index_magic):
+            raise ValueError(f"{index_path} isn't a GTFS index (rebuild it with: python gtfs_static.py build ...)")
+        table_count = 5 if magic == index_magic else 2
+        offsets = struct.unpack_from(f"<{table_count}I", self.index, len(index_magic))
+        self.route_colours = MappedLookupTable(self.index, offsets[0])
+        self.platform_names = MappedLookupTable(self.index, offsets[1])
+        # Only in indexes built since gtfs_realtime.py was added
+        self.route_details = MappedLookupTable(self.index, offsets[2]) if table_count > 2 else {}
+        self.trip_details = MappedLookupTable(self.index, offsets[3]) if table_count > 2 else {}
+        self.parent_stations = MappedLookupTable(self.index, offsets[4]) if table_count > 2 else {}
+
+    def line_colour(self, line, type_of_transport):
+        """
+        The route colour (e.g., "#F99D1C") for a line, or None if it isn't in the GTFS data.
+        """
+        return self.route_colours.get(route_key(line, type_of_transport))
+
+    def platform_name(self, platform_stop_id):
+        """
+        The platform name (e.g., "Platform 18", "Stand J", "Wharf 4 Side A") for a platform's stop ID, or None if it isn't in the GTFS data.
+        """
+        if not platform_stop_id:
+            return None
+        return self.platform_names.get(platform_stop_id) or None
+
+    def route(self, route_id):
+        """
+        The line name and mode for a route, e.g., ("T1", "train"), or None if it isn't in the GTFS data.
+        """
+        details = self.route_details.get(route_id)
+        return tuple(details.split("|", 1)) if details else None
+
+    def trip(self, trip_id):
+        """
+        The route ID and destination (headsign) for a trip, e.g., ("2-T1-sj2-1", "Emu Plains via Central"), or None if it isn't in the GTFS data.
+        """
+        details = self.trip_details.get(trip_id)
+        return tuple(details.split("|", 1)) if details else None
+
+    def parent_station(self, stop_id):
+        """
+        The station a platform, stand or wharf belongs to (e.g., "2000338" -> "200060"), or None if it doesn't have one.
+        """
+        return self.parent_stations.get(stop_id)
+
+
+def load_gtfs_index(index_path):
+    """
+    Open a GTFS index saved by build_gtfs_index().
+
+    Returns:
+        GTFSIndex: The index, or None if there isn't one (or it can't be read) - in which case the built in guesses are used instead.
+    """
+    if not index_path or not os.path.exists(index_path):
+        return None
+    try:
+        gtfs_index = GTFSIndex(index_path)
+    except Exception as e:
+        log.error(f"Error loading GTFS index, using the built in colours and platforms instead: {e}")
+        return None
+    log.info(f"Loaded GTFS index: {len(gtfs_index.route_colours)} route colours, {len(gtfs_index.platform_names)} platforms, {len(gtfs_index.trip_details)} trips")
+    return gtfs_index
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format="%(message)s")
+    if len(sys.argv) != 4 or sys.argv[1] != "build":
+        print("Usage: python gtfs_static.py build <GTFS folder or zip> <index file>")
+        sys.exit(1)
+    build_gtfs_index(sys.argv[2], sys.argv[3])
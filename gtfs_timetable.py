@@ -0,0 +1,351 @@
+"""
+Scheduled departures from the TfNSW GTFS static timetable, for when the API can't be used (it's down, or the quota has run out), so
+the board shows the timetable instead of going blank.
+
+The timetable is far too big to read every time (the full Sydney GTFS has tens of millions of stop times), so it's read once, by:
+
+    python gtfs_timetable.py build path/to/full_greater_sydney_gtfs_static.zip gtfs_timetable.bin
+
+which saves every stop's departures, sorted by time, into a binary file along with the trips, routes and service calendars they
+need. The file is memory mapped rather than read in, so opening it is practically instant, and a stop's departures are only read
+(a few bytes at a time) when that stop is asked about:
+
+    timetable = load_timetable("gtfs_timetable.bin")
+    timetable.departures("200060", after=time.time(), count=10, modes={"train"})
+
+finds the next departure with a binary search through the stop's departures, then reads forwards from there. Each departure keeps
+its trip's stop_sequence, so it can be matched up with a GTFS-Realtime TripUpdate for the same trip (see gtfs_realtime.py).
+
+Times are worked out in this computer's local time zone (the same as the itdDate and itdTime sent to departure_mon), so the
+computer needs to be set to Sydney time.
+"""
+
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+from datetime import datetime, timedelta
+
+import gtfs_static
+
+log = logging.getLogger(__name__)
+
+timetable_magic = b"TFTT0002"
+header_format = struct.Struct("<6I")  # offsets of the records, trips, strings, metadata, stops table and stations table
+record_format = struct.Struct("<III")  # seconds after the start of the service day, trip number, stop_sequence
+record_size = 3  # ints in each record
+# How many days of which services run are remembered (yesterday, today and tomorrow, and one more around midnight)
+max_cached_service_days = 4
+trip_format = struct.Struct("<IIII")  # route number, service number, headsign string offset, trip ID string offset
+
+
+def parse_gtfs_time(text):
+    """
+    Seconds since the start of the service day for a GTFS time. These can be past 24:00:00 for trips that run past midnight, e.g.,
+    "25:10:00" is 1:10am the next day.
+    """
+    hours, minutes, seconds = text.strip().split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def read_services(gtfs_path):
+    """
+    Read which days each service runs on, from calendar.txt and calendar_dates.txt (either can be left out of a GTFS feed).
+
+    Returns:
+        dict: service ID -> [first date, last date, days of the week, dates added, dates removed] - dates as YYYYMMDD ints, days of
+        the week as a bit per day (Monday is 1, Sunday is 64).
+    """
+    services = {}
+    weekdays = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+    try:
+        for row in gtfs_static.open_gtfs_columns(gtfs_path, "calendar.txt", ["service_id", "start_date", "end_date"] + weekdays):
+            days_of_week = sum(1 << day for day, runs in enumerate(row[3:]) if runs.strip() == "1")
+            services[row[0]] = [int(row[1]), int(row[2]), days_of_week, [], []]
+    except (KeyError, FileNotFoundError):
+        pass  # Only calendar_dates.txt is used
+    try:
+        for service_id, service_date, exception_type in gtfs_static.open_gtfs_columns(gtfs_path, "calendar_dates.txt", ["service_id", "date", "exception_type"]):
+            service = services.setdefault(service_id, [0, 0, 0, [], []])
+            service[3 if exception_type.strip() == "1" else 4].append(int(service_date))
+    except (KeyError, FileNotFoundError):
+        pass
+    return services
+
+
+def pack_string(strings, text, start_offset):
+    # Same layout as the strings in gtfs_static's lookup tables - a 2 byte length then the UTF-8 bytes
+    encoded = text.encode("utf-8")
+    offset = start_offset + len(strings)
+    strings.extend(struct.pack("<H", len(encoded)))
+    strings.extend(encoded)
+    return offset
+
+
+def build_timetable(gtfs_path, timetable_path):
+    """
+    Read the GTFS files once and save the timetable used by load_timetable().
+
+    Args:
+        gtfs_path (str): The GTFS folder or zip file.
+        timetable_path (str): Where to save the timetable.
+    """
+    routes = []  # [line, type_of_transport]
+    route_numbers = {}
+    for route_id, line, route_type in gtfs_static.open_gtfs_columns(gtfs_path, "routes.txt", ["route_id", "route_short_name", "route_type"]):
+        route_numbers[route_id] = len(routes)
+        routes.append([line.strip(), gtfs_static.route_type_lookup_table.get(route_type.strip(), "unknown")])
+
+    services_by_id = read_services(gtfs_path)
+    service_numbers = {service_id: number for number, service_id in enumerate(services_by_id)}
+
+    trips = []  # (route number, service number, headsign, trip ID)
+    trip_numbers = {}
+    for trip_id, route_id, service_id, headsign in gtfs_static.open_gtfs_columns(gtfs_path, "trips.txt", ["trip_id", "route_id", "service_id", "trip_headsign"]):
+        if route_id not in route_numbers or service_id not in service_numbers:
+            continue
+        trip_numbers[trip_id] = len(trips)
+        trips.append((route_numbers[route_id], service_numbers[service_id], headsign.strip(), trip_id))
+
+    # Each stop's departures as a flat array of (seconds, trip number, stop_sequence) - arrays of ints take a fraction of the memory
+    # tuples would
+    records_by_stop = {}
+    row_count = 0
+    for trip_id, departure_time, stop_id, stop_sequence, pickup_type in gtfs_static.open_gtfs_columns(
+            gtfs_path, "stop_times.txt", ["trip_id", "departure_time", "stop_id", "stop_sequence", "pickup_type"]):
+        row_count += 1
+        trip_number = trip_numbers.get(trip_id)
+        # pickup_type 1 means passengers can't get on (e.g., the last stop), so it isn't a departure
+        if trip_number is None or not departure_time or pickup_type.strip() == "1":
+            continue
+        records = records_by_stop.get(stop_id)
+        if records is None:
+            records = records_by_stop[stop_id] = array("I")
+        records.append(parse_gtfs_time(departure_time))
+        records.append(trip_number)
+        records.append(int(stop_sequence))
+        if row_count % 5000000 == 0:
+            log.info(f"Read {row_count} stop times...")
+
+    # Stations don't have departures of their own, they're on the platforms (or stands or wharves), so stations just list their platforms
+    platforms_by_station = {}
+    for stop_id, parent_station in gtfs_static.open_gtfs_columns(gtfs_path, "stops.txt", ["stop_id", "parent_station"]):
+        if parent_station and stop_id in records_by_stop:
+            platforms_by_station.setdefault(parent_station, []).append(stop_id)
+
+    # File layout: magic, header, then the records, trips, strings, metadata, stops table and stations table. The records are
+    # written out a stop at a time, as there can be hundreds of megabytes of them
+    with open(timetable_path + ".tmp", "wb") as file:
+        file.write(timetable_magic)
+        file.write(header_format.pack(0, 0, 0, 0, 0, 0))  # Filled in at the end, once the offsets are known
+        records_offset = file.tell()
+        record_count = 0
+        stop_table = {}
+        for stop_id in list(records_by_stop):
+            records = records_by_stop.pop(stop_id)
+            stop_records = sorted(zip(records[0::3], records[1::3], records[2::3]))
+            stop_table[stop_id] = f"{record_count} {len(stop_records)}"
+            file.write(b"".join(record_format.pack(*record) for record in stop_records))
+            record_count += len(stop_records)
+
+        trips_offset = file.tell()
+        strings_offset = trips_offset + len(trips) * trip_format.size
+        packed_trips = bytearray()
+        strings = bytearray()
+        headsign_offsets = {}
+        for route_number, service_number, headsign, trip_id in trips:
+            if headsign not in headsign_offsets:
+                headsign_offsets[headsign] = pack_string(strings, headsign, strings_offset)
+            packed_trips.extend(trip_format.pack(route_number, service_number, headsign_offsets[headsign], pack_string(strings, trip_id, strings_offset)))
+        file.write(packed_trips)
+        file.write(strings)
+
+        metadata_offset = file.tell()
+        file.write(json.dumps({"routes": routes, "services": list(services_by_id.values())}).encode("utf-8"))
+        stops_offset = file.tell()
+        file.write(gtfs_static.pack_lookup_table(stop_table, stops_offset))
+        stations_offset = file.tell()
+        file.write(gtfs_static.pack_lookup_table({station: " ".join(platforms) for station, platforms in platforms_by_station.items()}, stations_offset))
+
+        file.seek(len(timetable_magic))
+        file.write(header_format.pack(records_offset, trips_offset, strings_offset, metadata_offset, stops_offset, stations_offset))
+    os.replace(timetable_path + ".tmp", timetable_path)  # So a running board never sees half a file
+
+    log.info(f"GTFS timetable saved to {timetable_path}: {record_count} departures from {len(stop_table)} stops, {len(trips)} trips")
+
+
+def service_day_start(service_date):
+    """
+    When a service day starts, as a unix timestamp. GTFS times count from "noon minus 12 hours", which is midnight except on the
+    days daylight saving starts or ends.
+    """
+    return datetime(service_date.year, service_date.month, service_date.day, 12).timestamp() - 12 * 3600
+
+
+class Timetable:
+    """
+    Scheduled departures by stop, from a timetable built by build_timetable(). Use load_timetable() to open one.
+    """
+
+    def __init__(self, timetable_path):
+        with open(timetable_path, "rb") as file:
+            self.timetable = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.timetable[:len(timetable_magic)] != timetable_magic:
+            raise ValueError(f"{timetable_path} isn't a GTFS timetable (rebuild it with: python gtfs_timetable.py build ...)")
+        (self.records_offset, self.trips_offset, self.strings_offset, metadata_offset, stops_offset,
+         stations_offset) = header_format.unpack_from(self.timetable, len(timetable_magic))
+        # The routes and service calendars are small (a few thousand of each), so they're read in
+        metadata = json.loads(self.timetable[metadata_offset:stops_offset])
+        self.routes = metadata["routes"]
+        self.services = metadata["services"]
+        self.stops = gtfs_static.MappedLookupTable(self.timetable, stops_offset)
+        self.stations = gtfs_static.MappedLookupTable(self.timetable, stations_offset)
+        self.trip_count = (self.strings_offset - self.trips_offset) // trip_format.size
+        # The records and trips read as arrays of ints, straight out of the memory map - much quicker than unpacking them one at a time
+        # (the file is little endian, the same as every computer this is likely to run on)
+        self.records = memoryview(self.timetable)[self.records_offset:self.trips_offset].cast("I")
+        self.trips = memoryview(self.timetable)[self.trips_offset:self.strings_offset].cast("I")
+        self.service_runs_cache = {}  # YYYYMMDD -> {service number: whether it runs that day}, for the last few days asked about
+
+    def read_string(self, offset):
+        (length,) = struct.unpack_from("<H", self.timetable, offset)
+        return self.timetable[offset + 2:offset + 2 + length].decode("utf-8")
+
+    def service_runs(self, service_number, service_date):
+        """
+        Whether a service runs on a date (a YYYYMMDD int).
+        """
+        day_cache = self.service_runs_cache.get(service_date)
+        if day_cache is None:
+            # A new day, so forget the oldest - only yesterday, today and tomorrow are normally asked about
+            if len(self.service_runs_cache) >= max_cached_service_days:
+                del self.service_runs_cache[min(self.service_runs_cache)]
+            day_cache = self.service_runs_cache[service_date] = {}
+        runs = day_cache.get(service_number)
+        if runs is None:
+            first_date, last_date, days_of_week, dates_added, dates_removed = self.services[service_number]
+            if service_date in dates_removed:
+                runs = False
+            elif service_date in dates_added:
+                runs = True
+            else:
+                day_of_week = datetime.strptime(str(service_date), "%Y%m%d").weekday()
+                runs = first_date <= service_date <= last_date and bool(days_of_week & 1 << day_of_week)
+            day_cache[service_number] = runs
+        return runs
+
+    def stop_records(self, stop_id):
+        """
+        Returns:
+            tuple: (number of the stop's first record, how many records it has), or None if the stop has no departures.
+        """
+        location = self.stops.get(stop_id)
+        if location is None:
+            return None
+        first_record, count = location.split(" ")
+        return int(first_record), int(count)
+
+    def first_record_at_or_after(self, first_record, count, seconds):
+        # Binary search through the stop's records (which are sorted by time), reading just the time from each one it looks at
+        records = self.records
+        low, high = first_record, first_record + count
+        while low < high:
+            middle = (low + high) // 2
+            if records[middle * record_size] < seconds:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def day_departures(self, stop_id, first_record, count, day_start, date_number, after, modes):
+        """
+        A stop's departures on one service day (starting at day_start, and dated date_number), leaving at or after the after
+        timestamp - only read as they're needed.
+
+        Returns:
+            iterator: (departure time, trip number, stop ID, stop_sequence) for each departure, soonest first.
+        """
+        records, trips = self.records, self.trips
+        record = self.first_record_at_or_after(first_record, count, max(0, after - day_start))
+        for record in range(record, first_record + count):
+            seconds, trip_number = records[record * record_size], records[record * record_size + 1]
+            route_number, service_number = trips[trip_number * 4], trips[trip_number * 4 + 1]
+            if modes is not None and self.routes[route_number][1] not in modes:
+                continue
+            if not self.service_runs(service_number, date_number):
+                continue
+            yield int(day_start + seconds), trip_number, stop_id, records[record * record_size + 2]
+
+    def departures(self, stop_id, after, count=10, modes=None, until=None):
+        """
+        The next scheduled departures from a stop (or from any of its platforms, if it's a station).
+
+        Args:
+            stop_id (str): The GTFS stop ID.
+            after (float): Only departures leaving at or after this unix timestamp.
+            count (int): The most departures to return. None for no limit (only with until).
+            modes (set): Only these modes (e.g., {"train", "bus"}). None for every mode.
+            until (float): Only departures leaving before this unix timestamp. None for no limit.
+
+        Returns:
+            list: (departure time, trip ID, line, type_of_transport, headsign, platform stop ID, stop_sequence) for each departure,
+            soonest first.
+        """
+        platforms = [stop_id]
+        station_platforms = self.stations.get(stop_id)
+        if station_platforms:
+            platforms.extend(station_platforms.split(" "))
+        platform_records = [(platform, self.stop_records(platform)) for platform in platforms]
+
+        # Yesterday's service day for trips that run past midnight, then today's, then tomorrow's in case today has nothing left
+        today = datetime.fromtimestamp(after).date()
+        service_days = [(service_day_start(service_date), int(service_date.strftime("%Y%m%d")))
+                        for service_date in (today + timedelta(days=days) for days in (-1, 0, 1))]
+        streams = [
+            self.day_departures(platform, *location, day_start, date_number, after, modes)
+            for day_start, date_number in service_days
+            for platform, location in platform_records
+            if location is not None
+        ]
+
+        departures = []
+        for departure_time, trip_number, platform, stop_sequence in heapq.merge(*streams):
+            if until is not None and departure_time >= until:
+                break
+            route_number, service_number, headsign_offset, trip_id_offset = self.trips[trip_number * 4:trip_number * 4 + 4]
+            line, type_of_transport = self.routes[route_number]
+            departures.append((departure_time, self.read_string(trip_id_offset), line, type_of_transport, self.read_string(headsign_offset),
+                               platform, stop_sequence))
+            if count is not None and len(departures) >= count:
+                break
+        return departures
+
+
+def load_timetable(timetable_path):
+    """
+    Open a timetable saved by build_timetable().
+
+    Returns:
+        Timetable: The timetable, or None if there isn't one (or it can't be read).
+    """
+    if not timetable_path or not os.path.exists(timetable_path):
+        return None
+    try:
+        timetable = Timetable(timetable_path)
+    except Exception as e:
+        log.error(f"Error loading GTFS timetable, there won't be any scheduled departures to fall back on: {e}")
+        return None
+    log.info(f"Loaded GTFS timetable: {len(timetable.stops)} stops, {timetable.trip_count} trips")
+    return timetable
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format="%(message)s")
+    if len(sys.argv) != 4 or sys.argv[1] != "build":
+        print("Usage: python gtfs_timetable.py build <GTFS folder or zip> <timetable file>")
+        sys.exit(1)
+    build_timetable(sys.argv[2], sys.argv[3])
@@ -0,0 +1,132 @@
+"""
+End-to-end load test of dep_mon12.py against the mock API in mock_api.py, so it can be tried with hundreds of stops without using any
+real API quota.
+
+    python load_test.py                                   - 1, 10, 100 and 1000 stops with the mock running in this process
+    python load_test.py --stops 10 500 2000 --cycles 5    - choose the stop counts and how many refreshes to time for each
+    python load_test.py --mock-url http://host:8081/v1/tp - use a mock started separately (python mock_api.py), so it isn't sharing a CPU
+    python load_test.py --workers 4                       - split the stops between 4 worker processes (poll_worker_processes)
+
+For each stop count it reports how long looking up the stop IDs took, then for the refreshes: average and slowest cycle time, requests
+per second, departures per cycle, errors, and the peak memory used by a cycle.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import dep_mon12
+import mock_api
+
+
+def make_station_input(stop_count):
+    """
+    Station input in the same format as the input() prompt, e.g., "Mock Stop 1 (train, bus); Mock Stop 2 (ferry)".
+    """
+    mode_sets = ["train, bus", "bus", "light_rail", "ferry", "train, metro, bus"]
+    return "; ".join(f"Mock Stop {i} ({mode_sets[i % len(mode_sets)]})" for i in range(stop_count))
+
+
+def run_cycle(jobs):
+    """
+    One full refresh, the same as main() does it: fetch every job, then merge and build the output.
+
+    Returns:
+        tuple: (number of departures, number of failed requests)
+    """
+    results = dep_mon12.fetch_poll_jobs(jobs)
+    departure_streams = [departures for job, departures, error in results if error is None]
+    errors = sum(1 for job, departures, error in results if error is not None)
+    every_departure = dep_mon12.merge_departures(departure_streams)
+    dep_mon12.build_output(every_departure)
+    return len(every_departure), errors
+
+
+def load_test(stop_count, cycles, track_memory):
+    """
+    Resolve stop_count made-up stations, then time cycles refreshes of all of them.
+
+    Returns:
+        dict: The results for this stop count.
+    """
+    results = {"stops": stop_count}
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Start with an empty stop ID cache, so the stop_finder lookups are part of the test
+        dep_mon12.stop_id_cache_path = os.path.join(directory, "stop_id_cache.json")
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            stops = dep_mon12.get_station_ids_from_station_names_and_modes(make_station_input(stop_count))
+        results["resolve_seconds"] = time.perf_counter() - start
+
+    jobs = dep_mon12.build_poll_jobs(stops)
+    results["requests_per_cycle"] = len(jobs)
+
+    cycle_times = []
+    departures = errors = 0
+    peak_memory = 0
+    for _ in range(cycles):
+        if track_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            departures, cycle_errors = run_cycle(jobs)
+        cycle_times.append(time.perf_counter() - start)
+        errors += cycle_errors
+        if track_memory:
+            peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+    results.update({
+        "mean_cycle_seconds": statistics.mean(cycle_times),
+        "max_cycle_seconds": max(cycle_times),
+        "requests_per_second": len(jobs) / statistics.mean(cycle_times),
+        "departures_per_cycle": departures,
+        "errors": errors,
+        "peak_memory_bytes": peak_memory,
+    })
+    return results
+
+
+def print_results(results):
+    memory = f"{results['peak_memory_bytes'] / 1024 / 1024:>9.1f}" if results["peak_memory_bytes"] else f"{'-':>9}"
+    print(f"{results['stops']:>6} {results['resolve_seconds']:>10.2f} {results['requests_per_cycle']:>9} {results['mean_cycle_seconds']:>10.2f} "
+          f"{results['max_cycle_seconds']:>10.2f} {results['requests_per_second']:>9.0f} {results['departures_per_cycle']:>11} {results['errors']:>7} {memory}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test dep_mon12.py against the mock API")
+    parser.add_argument("--stops", type=int, nargs="+", default=[1, 10, 100, 1000], help="Numbers of stops to test with")
+    parser.add_argument("--cycles", type=int, default=3, help="Refreshes to time for each number of stops")
+    parser.add_argument("--workers", type=int, default=dep_mon12.poll_worker_processes, help="poll_worker_processes to use (0 for none)")
+    parser.add_argument("--concurrency", type=int, default=dep_mon12.max_concurrent_requests, help="max_concurrent_requests to use")
+    parser.add_argument("--requests-per-second", type=float, default=None, help="Rate limit to test with (default none, the mock has no quota)")
+    parser.add_argument("--mock-url", help="Base url of an already running mock API (otherwise one is started in this process)")
+    parser.add_argument("--latency-ms", type=float, default=mock_api.mock_settings["latency_ms"], help="Mock API latency (in-process mock only)")
+    parser.add_argument("--error-rate", type=float, default=mock_api.mock_settings["error_rate"], help="Mock API error rate (in-process mock only)")
+    parser.add_argument("--events", type=int, default=mock_api.mock_settings["events_per_stop"], help="stopEvents per response (in-process mock only)")
+    parser.add_argument("--no-memory", action="store_true", help="Don't track memory (tracemalloc slows everything down a bit)")
+    args = parser.parse_args()
+
+    if args.mock_url:
+        dep_mon12.api_base_url = args.mock_url
+    else:
+        mock_api.mock_settings.update({"latency_ms": args.latency_ms, "error_rate": args.error_rate, "events_per_stop": args.events})
+        server, dep_mon12.api_base_url = mock_api.start_mock_api()
+    print(f"Using mock API at {dep_mon12.api_base_url}")
+
+    dep_mon12.max_concurrent_requests = args.concurrency
+    dep_mon12.poll_worker_processes = args.workers
+    dep_mon12.mount_connection_pool()
+    dep_mon12.api_requests_per_second = args.requests_per_second
+    dep_mon12.api_daily_quota = None
+    dep_mon12.configure_request_governor()
+
+    print(f"{'stops':>6} {'resolve s':>10} {'requests':>9} {'cycle s':>10} {'max s':>10} {'req/s':>9} {'departures':>11} {'errors':>7} {'peak MB':>9}")
+    for stop_count in args.stops:
+        print_results(load_test(stop_count, args.cycles, not args.no_memory))
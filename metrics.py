@@ -0,0 +1,208 @@
+"""
+Timings and sizes for each part of a refresh, to find out where a slow refresh is spending its time.
+
+    metrics_enabled = True                               - off by default, and then everything below does nothing
+    with timed("parse_seconds", stop_id="10101229"):     - time a block of code
+    observe("response_bytes", 48213, endpoint="departure_mon")
+    increment("api_requests_total", endpoint="departure_mon", status="200")
+
+Every timing or size is kept as a histogram (how many fell into each bucket, plus the total and the largest), and every count as a
+counter. They can be read as Prometheus text (prometheus_text(), served at /metrics by board_server.py) or as JSON
+(stats(), saved every refresh by write_stats_file()).
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+# Turn on to start collecting. While it's off, observe(), increment() and timed() return straight away
+metrics_enabled = False
+
+seconds_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+bytes_buckets = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+count_buckets = (0, 1, 5, 10, 25, 50, 100, 250, 500)
+
+# name -> (description, histogram buckets). Histograms not listed here get seconds_buckets
+metric_descriptions = {
+    "api_request_seconds": ("How long each API request took, including reading the response", seconds_buckets),
+    "api_requests_total": ("API requests sent, by endpoint and HTTP status (or the error, if there was no response)", None),
+    "api_retries_total": ("API requests retried after failing", None),
+    "api_circuit_open_total": ("API requests refused because the endpoint's circuit breaker was open", None),
+    "response_bytes": ("Size of each API response body", bytes_buckets),
+    "json_decode_seconds": ("Time spent decoding each departure_mon response", seconds_buckets),
+    "stop_events": ("stopEvents in each departure_mon response", count_buckets),
+    "parse_cache_total": ("departure_mon responses that were the same as last time (so weren't parsed again), or had changed", None),
+    "parse_seconds": ("Time spent turning a stop's stopEvents into departures", seconds_buckets),
+    "trip_updates_decode_seconds": ("Time spent decoding each GTFS-Realtime TripUpdates feed into departures by stop", seconds_buckets),
+    "merge_seconds": ("Time spent merging every stop's departures for the board", seconds_buckets),
+    "serialise_seconds": ("Time spent building and writing the output", seconds_buckets),
+    "cycle_seconds": ("How long each whole refresh took", seconds_buckets),
+    "polled_jobs_total": ("Stops (or stop and mode pairs) polled, by whether the request worked", None),
+}
+
+histograms = {}  # (name, labels) -> Histogram
+counters = {}  # (name, labels) -> count
+metrics_lock = threading.Lock()
+
+
+class Histogram:
+    """
+    How many observations fell into each bucket (each bucket counts values up to and including its bound), plus their total and the largest.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)  # The last one is for anything bigger than every bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def observe(name, value, **labels):
+    """
+    Add a timing or size to the name histogram.
+    """
+    if not metrics_enabled:
+        return
+    key = (name, label_key(labels))
+    with metrics_lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            buckets = metric_descriptions.get(name, ("", None))[1] or seconds_buckets
+            histogram = histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+
+def increment(name, amount=1, **labels):
+    """
+    Add to the name counter.
+    """
+    if not metrics_enabled:
+        return
+    key = (name, label_key(labels))
+    with metrics_lock:
+        counters[key] = counters.get(key, 0) + amount
+
+
+class Timer:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+# One do-nothing context manager shared by every timed() call while metrics are off
+disabled_timer = nullcontext()
+
+
+def timed(name, **labels):
+    """
+    Time the with block and add it to the name histogram.
+    """
+    if not metrics_enabled:
+        return disabled_timer
+    return Timer(name, labels)
+
+
+def reset_metrics():
+    with metrics_lock:
+        histograms.clear()
+        counters.clear()
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    escaped = (f'{key}="{escape_label_value(value)}"' for key, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def prometheus_text():
+    """
+    Every metric in the Prometheus text exposition format.
+    """
+    with metrics_lock:
+        histogram_items = sorted((key, (histogram.buckets, list(histogram.bucket_counts), histogram.count, histogram.sum)) for key, histogram in histograms.items())
+        counter_items = sorted(counters.items())
+
+    lines = []
+    described = set()
+
+    def describe(name, metric_type):
+        if name not in described:
+            described.add(name)
+            lines.append(f"# HELP dep_mon_{name} {metric_descriptions.get(name, (name, None))[0]}")
+            lines.append(f"# TYPE dep_mon_{name} {metric_type}")
+
+    for (name, labels), (buckets, bucket_counts, count, total) in histogram_items:
+        describe(name, "histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(list(buckets) + ["+Inf"], bucket_counts):
+            cumulative += bucket_count
+            lines.append(f"dep_mon_{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"dep_mon_{name}_sum{format_labels(labels)} {total}")
+        lines.append(f"dep_mon_{name}_count{format_labels(labels)} {count}")
+
+    for (name, labels), count in counter_items:
+        describe(name, "counter")
+        lines.append(f"dep_mon_{name}{format_labels(labels)} {count}")
+
+    return "\n".join(lines) + "\n"
+
+
+def stats():
+    """
+    Every metric as a dict, for the JSON stats file.
+
+    Returns:
+        dict: {"generated_at": ..., "histograms": {name: [{"labels", "count", "sum", "mean", "max", "buckets"}]}, "counters": {name: [{"labels", "count"}]}}
+    """
+    with metrics_lock:
+        result = {"generated_at": int(time.time()), "histograms": {}, "counters": {}}
+        for (name, labels), histogram in sorted(histograms.items()):
+            result["histograms"].setdefault(name, []).append({
+                "labels": dict(labels),
+                "count": histogram.count,
+                "sum": histogram.sum,
+                "mean": histogram.sum / histogram.count if histogram.count else None,
+                "max": histogram.max,
+                "buckets": {str(bound): count for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.bucket_counts)},
+            })
+        for (name, labels), count in sorted(counters.items()):
+            result["counters"].setdefault(name, []).append({"labels": dict(labels), "count": count})
+    return result
+
+
+def write_stats_file(path):
+    """
+    Save stats() as JSON to path (swapped into place, so anything reading it never sees half a file).
+    """
+    if not metrics_enabled:
+        return
+    with open(path + ".tmp", "w") as file:
+        json.dump(stats(), file, indent=4)
+    os.replace(path + ".tmp", path)
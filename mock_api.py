@@ -0,0 +1,255 @@
+"""
+A local stand-in for the Transport for NSW trip planner API, for load testing without using up the real API quota.
+
+    python mock_api.py --port 8081 --latency-ms 150 --error-rate 0.02 --events 40
+
+then set api_base_url = "http://localhost:8081/v1/tp" in dep_mon12.py (or use load_test.py, which starts one for you).
+
+It answers the endpoints dep_mon12.py uses:
+
+    /v1/tp/departure_mon    made-up stopEvents (from synthetic_data.py) for any stop ID, with the exclMOT_ modes left out
+    /v1/tp/stop_finder      a made-up stop for any station name, with a stop ID that's always the same for the same name
+    /v1/tp/add_info         made-up current alerts for some of the made-up lines (for service_alerts_source = "add_info")
+    /*/gtfs/realtime/*      a GTFS-Realtime TripUpdates feed - made up, or a recorded one (--trip-updates FILE) with its times moved
+                            forward to now. Set gtfs_realtime_base_url = "http://localhost:8081" to use it
+
+Each response can be slowed down (latency and jitter), fail some of the time (error rate), and be made bigger or smaller (events and
+alerts per stop). departure_mon responses are gzipped if the request asks for it, like the real API.
+"""
+
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import gtfs_realtime
+import synthetic_data
+
+# Change these (or use the command line options) to shape the responses
+mock_settings = {
+    "latency_ms": 100,  # How long each response takes on average
+    "jitter_ms": 50,  # Plus or minus up to this much
+    "error_rate": 0.0,  # Fraction of requests that get a 503 instead
+    "events_per_stop": 40,  # stopEvents per departure_mon response (before the excluded modes are taken out)
+    "alerts_per_event": 1,  # infos per stopEvent
+    "trip_updates_trips": 2000,  # Trips in each made-up TripUpdates feed
+    "trip_updates_file": None,  # A recorded TripUpdates feed to serve instead of a made-up one
+    "network_alerts": 30,  # Alerts in each add_info response
+}
+
+# Counts of what's been answered, for the load test to report on
+mock_stats = {"departure_mon": 0, "stop_finder": 0, "add_info": 0, "gtfs_realtime": 0, "errors": 0, "bytes": 0}
+mock_stats_lock = threading.Lock()
+
+# Generated responses are reused for a minute, so that making up the data doesn't slow the mock down more than the real thing would be
+response_cache = {}
+response_cache_lock = threading.Lock()
+
+all_mode_classes = [1, 2, 4, 5, 7, 9, 11]
+
+
+def stop_seed(text):
+    # The same stop always gets the same made-up departures
+    return zlib.crc32(text.encode("utf-8"))
+
+
+def departure_mon_body(stop_id, included_classes):
+    """
+    A made-up departure_mon response for a stop, only including the given product classes. Cached for up to a minute.
+
+    Returns:
+        tuple: (body, gzipped body)
+    """
+    minute = int(time.time() // 60)
+    cache_key = (stop_id, tuple(included_classes), minute)
+    with response_cache_lock:
+        body = response_cache.get(cache_key)
+    if body is not None:
+        return body
+
+    start = datetime.fromtimestamp(minute * 60, timezone.utc)
+    response = synthetic_data.make_departure_mon_response(
+        mock_settings["events_per_stop"],
+        start=start,
+        seed=stop_seed(stop_id),
+        alerts_per_event=mock_settings["alerts_per_event"],
+        classes=included_classes,
+    ) if included_classes else {"version": "10.2.1.42", "systemMessages": [], "locations": [], "stopEvents": []}
+    body = json.dumps(response).encode("utf-8")
+    body = (body, gzip.compress(body))
+
+    with response_cache_lock:
+        # Throw away everything from previous minutes so the cache doesn't keep growing
+        for key in [key for key in response_cache if key[2] != minute]:
+            del response_cache[key]
+        response_cache[cache_key] = body
+    return body
+
+
+def stop_finder_body(station_name):
+    """
+    A made-up stop_finder response with one stop, whose ID is worked out from the station name.
+    """
+    stop_id = str(10000000 + stop_seed(station_name.lower()) % 90000000)
+    response = {
+        "version": "10.2.1.42",
+        "locations": [{
+            "id": stop_id,
+            "name": station_name,
+            "disassembledName": station_name,
+            "type": "stop",
+            "isBest": True,
+            "matchQuality": 1000,
+            "modes": [1, 2, 4, 5, 7, 9],
+            "parent": {"id": "95346013|1", "name": "Mock", "type": "locality"},
+            "properties": {"stopId": stop_id},
+        }],
+    }
+    return json.dumps(response).encode("utf-8")
+
+
+def trip_updates_body(feed_path):
+    """
+    A TripUpdates feed for the feed path (each path gets different made-up trips), or the recorded feed if there is one, with its
+    times moved forward so it looks like it was just generated. Cached for up to a minute.
+    """
+    minute = int(time.time() // 60)
+    cache_key = (feed_path, "trip_updates", minute)
+    with response_cache_lock:
+        body = response_cache.get(cache_key)
+    if body is not None:
+        return body
+
+    if mock_settings["trip_updates_file"]:
+        with open(mock_settings["trip_updates_file"], "rb") as file:
+            body = file.read()
+        generated_at = gtfs_realtime.feed_timestamp(body)
+        if generated_at:
+            body = gtfs_realtime.shift_feed_times(body, minute * 60 - generated_at)
+    else:
+        start = datetime.fromtimestamp(minute * 60, timezone.utc)
+        body = synthetic_data.make_trip_updates_feed(mock_settings["trip_updates_trips"], start=start, seed=stop_seed(feed_path))
+
+    with response_cache_lock:
+        for key in [key for key in response_cache if key[2] != minute]:
+            del response_cache[key]
+        response_cache[cache_key] = body
+    return body
+
+
+class MockAPIRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real API
+
+    def do_GET(self):
+        split_url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(split_url.query).items()}
+        endpoint = split_url.path.rstrip("/").split("/")[-1]
+        if "/gtfs/realtime/" in split_url.path:
+            endpoint = "gtfs_realtime"
+
+        # Pretend to be a real API over a real network
+        delay = mock_settings["latency_ms"] + random.uniform(-1, 1) * mock_settings["jitter_ms"]
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        if endpoint not in ("departure_mon", "stop_finder", "add_info", "gtfs_realtime"):
+            self.send_body(404, b'{"error": "unknown endpoint"}')
+            return
+
+        if random.random() < mock_settings["error_rate"]:
+            with mock_stats_lock:
+                mock_stats["errors"] += 1
+            self.send_body(503, b'{"error": "mock error"}')
+            return
+
+        if endpoint == "departure_mon":
+            excluded_classes = {int(key[len("exclMOT_"):]) for key in params if key.startswith("exclMOT_")}
+            body, gzipped_body = departure_mon_body(params.get("name_dm", ""), [mode for mode in all_mode_classes if mode not in excluded_classes])
+            encoding = None
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                body, encoding = gzipped_body, "gzip"
+        elif endpoint == "gtfs_realtime":
+            body, encoding = trip_updates_body(split_url.path), None
+        elif endpoint == "add_info":
+            body = json.dumps(synthetic_data.make_add_info_response(mock_settings["network_alerts"], seed=int(time.time() // 600))).encode("utf-8")
+            encoding = None
+        else:
+            body, encoding = stop_finder_body(params.get("name_sf", "")), None
+
+        with mock_stats_lock:
+            mock_stats[endpoint] += 1
+            mock_stats["bytes"] += len(body)
+        content_type = "application/x-google-protobuf" if endpoint == "gtfs_realtime" else "application/json"
+        self.send_body(200, body, encoding, content_type)
+
+    def send_body(self, status_code, body, encoding=None, content_type="application/json"):
+        self.send_response(status_code)
+        self.send_header("Content-Type", content_type)
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # A line per request would be far too much output during a load test
+
+
+class MockAPIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # Lots of connections arrive at once during a load test
+
+
+def start_mock_api(host="127.0.0.1", port=0):
+    """
+    Start the mock API in a background thread.
+
+    Args:
+        host (str): The address to listen on.
+        port (int): The port to listen on - 0 picks any free port.
+
+    Returns:
+        tuple: (server, base url to use as api_base_url)
+    """
+    server = MockAPIServer((host, port), MockAPIRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1/tp"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Transport for NSW API for load testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=mock_settings["latency_ms"])
+    parser.add_argument("--jitter-ms", type=float, default=mock_settings["jitter_ms"])
+    parser.add_argument("--error-rate", type=float, default=mock_settings["error_rate"])
+    parser.add_argument("--events", type=int, default=mock_settings["events_per_stop"], help="stopEvents per departure_mon response")
+    parser.add_argument("--alerts", type=int, default=mock_settings["alerts_per_event"], help="infos per stopEvent")
+    parser.add_argument("--trips", type=int, default=mock_settings["trip_updates_trips"], help="Trips in each made-up TripUpdates feed")
+    parser.add_argument("--trip-updates", help="A recorded TripUpdates feed (.pb) to serve instead of made-up ones")
+    parser.add_argument("--network-alerts", type=int, default=mock_settings["network_alerts"], help="Alerts in each add_info response")
+    args = parser.parse_args()
+
+    mock_settings.update({
+        "latency_ms": args.latency_ms,
+        "jitter_ms": args.jitter_ms,
+        "error_rate": args.error_rate,
+        "events_per_stop": args.events,
+        "alerts_per_event": args.alerts,
+        "trip_updates_trips": args.trips,
+        "trip_updates_file": args.trip_updates,
+        "network_alerts": args.network_alerts,
+    })
+    server, base_url = start_mock_api(args.host, args.port)
+    print(f"Mock API running - set api_base_url = \"{base_url}\" (and gtfs_realtime_base_url = \"{base_url[:-len('/v1/tp')]}\")")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,207 @@
+"""
+Record the raw API responses to disk, and play them back later through the same code without needing the API (or an API key).
+
+Recording:
+    record_responses(http_session, "recordings")    - every departure_mon, stop_finder and GTFS-Realtime response is saved to the recordings folder
+
+Replaying:
+    http_session.mount("https://", ReplayAdapter("recordings"))    - requests are answered from the recordings folder instead of the API
+
+Each recording is saved as {endpoint}-{stop}-{hash of the query}-{time}.json. itdDate and itdTime are left out of the hash, so a
+request made at a different time still finds its recording. If there are several recordings of the same request, they're played
+back in the order they were recorded (starting again from the first once they run out). The GTFS-Realtime feeds are protocol
+buffers rather than text, so their bodies are saved base64 encoded.
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+import gtfs_realtime
+
+log = logging.getLogger(__name__)
+
+# Query parameters that change with every request, and so shouldn't be used to match a request to its recording
+volatile_params = {"itdDate", "itdTime"}
+
+# API timestamps look like "2025-01-31T09:15:00Z"
+timestamp_pattern = re.compile(r'"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})Z"')
+
+
+def recording_key(url):
+    """
+    Work out which recording a request url belongs to, e.g., "departure_mon-10101229-3f2a9c1b7d4e".
+
+    Args:
+        url (str): The full request url, including the query string.
+
+    Returns:
+        str: The endpoint, the stop being asked about, and a hash of the rest of the query.
+    """
+    split_url = urlsplit(url)
+    endpoint = split_url.path.rstrip("/").split("/")[-1]
+    params = sorted((key, value) for key, value in parse_qsl(split_url.query) if key not in volatile_params)
+    query = dict(params)
+    stop = query.get("name_dm") or query.get("name_sf") or ""
+    stop = re.sub(r"[^A-Za-z0-9]+", "_", stop).strip("_")  # Station names can have spaces etc. in them
+    query_hash = hashlib.sha1(json.dumps(params).encode("utf-8")).hexdigest()[:12]
+    return f"{endpoint}-{stop}-{query_hash}"
+
+
+def save_recording(directory, url, status_code, headers, body, recorded_at=None):
+    """
+    Save one response to the recordings folder.
+
+    Args:
+        directory (str): The recordings folder.
+        url (str): The full request url.
+        status_code (int): The HTTP status code of the response.
+        headers (dict): The response headers.
+        body (str or bytes): The response body, exactly as the API sent it - bytes for anything that isn't text (e.g., a GTFS-Realtime feed).
+        recorded_at (float): When the response was received (defaults to now).
+
+    Returns:
+        str: The path of the saved recording.
+    """
+    recorded_at = time.time() if recorded_at is None else recorded_at
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{recording_key(url)}-{int(recorded_at * 1000)}.json")
+    recording = {
+        "url": url,
+        "status_code": status_code,
+        "headers": dict(headers),
+        "recorded_at": recorded_at,
+    }
+    if isinstance(body, bytes):
+        recording["body_base64"] = base64.b64encode(body).decode("ascii")
+    else:
+        recording["body"] = body
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(recording, file)
+    return path
+
+
+def is_text_response(headers):
+    content_type = headers.get("Content-Type", "").lower()
+    return not content_type or "json" in content_type or content_type.startswith("text/")
+
+
+def record_responses(session, directory):
+    """
+    Save every response the session gets to the recordings folder, as well as returning it as normal.
+
+    Args:
+        session (requests.Session): The session to record (e.g., http_session).
+        directory (str): The recordings folder.
+    """
+    def save_response(response, *args, **kwargs):
+        try:
+            # Content-Encoding/Length describe the compressed body on the wire, not the decoded text we're saving
+            headers = {key: value for key, value in response.headers.items() if key.lower() not in ("content-encoding", "content-length", "transfer-encoding")}
+            body = response.text if is_text_response(response.headers) else response.content
+            save_recording(directory, response.url, response.status_code, headers, body)
+        except Exception as e:
+            log.warning(f"Error saving recording for {response.url}: {e}")
+        return response
+
+    session.hooks["response"].append(save_response)
+    log.info(f"Recording API responses to {directory}")
+
+
+def shift_timestamps(body, seconds):
+    """
+    Move every API timestamp in a response body forward by the given number of seconds.
+    Used to make an old recording look like it was just fetched, so departures aren't all in the past.
+    """
+    offset = timedelta(seconds=seconds)
+
+    def shift(match):
+        shifted = datetime.fromisoformat(match.group(1)).replace(tzinfo=timezone.utc) + offset
+        return f'"{shifted.strftime("%Y-%m-%dT%H:%M:%S")}Z"'
+
+    return timestamp_pattern.sub(shift, body)
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    A requests transport adapter that answers requests from a recordings folder rather than the network.
+
+    Args:
+        directory (str): The recordings folder.
+        shift_times (bool): Move the timestamps in each recording forward by how long ago it was recorded, so the departures
+            are still in the future. Turn off to get the recordings back exactly as they were saved.
+
+    Requests with no matching recording get a 404, like an unknown stop would.
+    """
+
+    def __init__(self, directory, shift_times=True):
+        super().__init__()
+        self.shift_times = shift_times
+        self.recordings = {}  # recording key -> list of recordings, oldest first
+        self.next_recording = {}  # recording key -> which recording to play next
+        self.lock = threading.Lock()
+
+        for file_name in sorted(os.listdir(directory)):
+            if not file_name.endswith(".json"):
+                continue
+            with open(os.path.join(directory, file_name), "r", encoding="utf-8") as file:
+                recording = json.load(file)
+            self.recordings.setdefault(recording_key(recording["url"]), []).append(recording)
+
+        for recordings in self.recordings.values():
+            recordings.sort(key=lambda recording: recording["recorded_at"])
+
+        log.info(f"Replaying {sum(len(recordings) for recordings in self.recordings.values())} recorded responses from {directory}")
+
+    def send(self, request, **kwargs):
+        key = recording_key(request.url)
+
+        with self.lock:
+            recordings = self.recordings.get(key)
+            if recordings:
+                index = self.next_recording.get(key, 0)
+                self.next_recording[key] = (index + 1) % len(recordings)
+                recording = recordings[index]
+            else:
+                recording = None
+
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.encoding = "utf-8"
+
+        if recording is None:
+            response.status_code = 404
+            response.headers = CaseInsensitiveDict({"Content-Type": "text/plain"})
+            response._content = f"No recording for {key}".encode("utf-8")
+            return response
+
+        response.status_code = recording["status_code"]
+        response.headers = CaseInsensitiveDict(recording["headers"])
+
+        if "body_base64" in recording:
+            body = base64.b64decode(recording["body_base64"])
+            if self.shift_times and response.status_code == 200 and "/gtfs/realtime/" in recording["url"]:
+                body = gtfs_realtime.shift_feed_times(body, time.time() - recording["recorded_at"])
+            response._content = body
+            return response
+
+        body = recording["body"]
+        if self.shift_times:
+            body = shift_timestamps(body, time.time() - recording["recorded_at"])
+        response._content = body.encode("utf-8")
+        return response
+
+    def close(self):
+        pass
@@ -0,0 +1,290 @@
+"""
+Keeps every API call within the Transport for NSW quota, and deals with failed requests one request at a time.
+
+    api_governor = RequestGovernor(http_session, requests_per_second=5, daily_quota=60000)
+    response = api_governor.get("departure_mon", url, headers=headers, params=params)
+
+Every request, from any thread, goes through the governor:
+
+    - A token bucket spaces requests out to requests_per_second (with short bursts of up to burst requests), so raising
+      max_concurrent_requests doesn't get us throttled
+    - The number of requests made today is counted, and requests are refused once daily_quota is used up
+    - Timeouts, connection errors, 429s and 5xx errors are retried with exponential backoff plus random jitter (so parallel requests
+      don't all retry at the same moment). A Retry-After header is respected, and a 429 holds back every request, not just the retry
+    - Each endpoint has a circuit breaker: after breaker_failure_threshold requests in a row fail, that endpoint isn't called at
+      all for breaker_reset_seconds, then a single request is let through to see if it's working again
+
+Only the request that failed is retried, so stops that already worked aren't fetched again.
+"""
+
+import logging
+import random
+import threading
+import time
+from datetime import date, datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Worth trying again - anything else (e.g., 404 for an unknown stop) would fail the same way every time
+retry_status_codes = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """
+    The endpoint has failed too many times in a row, so it isn't being called for now.
+    """
+
+
+class QuotaExceededError(Exception):
+    """
+    Today's API quota has been used up.
+    """
+
+
+class TokenBucket:
+    """
+    Hands out rate tokens a second, and lets up to capacity build up for short bursts.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a token is free, then take it.
+
+        Returns:
+            float: How many seconds were spent waiting.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Take the token straight away, even if that leaves the bucket in debt, so waiting threads queue up in order
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate if self.tokens < 0 else 0, self.paused_until - now)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """
+        Don't hand out any tokens for the next given number of seconds (e.g., when the API says to back off).
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class CircuitBreaker:
+    """
+    Stops calling an endpoint that keeps failing.
+
+    closed - requests go through as normal
+    open - every request is refused until reset_seconds have passed since it opened
+    half open - one trial request is let through: if it works the breaker closes again, if it fails it opens again
+    """
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+                return True  # This is the trial request
+            return False  # Still open, or another request is already trying it out
+
+    def record_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def cancel_trial(self):
+        # The trial request was never sent, so the next request gets to be the trial instead
+        with self.lock:
+            if self.state == "half_open":
+                self.state = "open"
+
+
+def retry_after_seconds(response):
+    """
+    How long the Retry-After header asks us to wait, in seconds, or None if there isn't one. It can either be a number of seconds or a date.
+    """
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestGovernor:
+    """
+    Sends requests through a requests.Session, keeping within the rate and daily quota and retrying the ones that fail.
+
+    Args:
+        session (requests.Session): The session to send the requests with.
+        requests_per_second (float): The most requests to send in a second, on average. None for no limit.
+        burst (int): How many requests can be sent at once after a quiet spell (defaults to requests_per_second).
+        daily_quota (int): The most requests to send in a day (the count starts again at midnight). None for no limit.
+        max_retries (int): How many times to retry a request that failed in a way that's worth retrying.
+        backoff_base_seconds (float): The first retry waits up to this long, then each one after that up to twice as long as the last.
+        backoff_max_seconds (float): The longest to wait before a retry. If Retry-After asks for longer than this, the request fails.
+        breaker_failure_threshold (int): How many requests to an endpoint have to fail in a row before it's left alone for a while.
+        breaker_reset_seconds (float): How long to leave an endpoint alone.
+        timeout_seconds (float): How long to wait for the API to respond to each attempt.
+        on_request (callable): Called (with no arguments) each time a request is actually sent, retries included, e.g., to keep
+            count of them for a budget of your own.
+    """
+
+    def __init__(self, session, requests_per_second=5, burst=None, daily_quota=None, max_retries=3, backoff_base_seconds=1,
+                 backoff_max_seconds=30, breaker_failure_threshold=5, breaker_reset_seconds=60, timeout_seconds=15, on_request=None):
+        self.session = session
+        self.bucket = TokenBucket(requests_per_second, burst or max(1, int(requests_per_second))) if requests_per_second else None
+        self.daily_quota = daily_quota
+        self.max_retries = max_retries
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.breaker_failure_threshold = breaker_failure_threshold
+        self.breaker_reset_seconds = breaker_reset_seconds
+        self.timeout_seconds = timeout_seconds
+        self.on_request = on_request
+        self.breakers = {}  # endpoint name -> CircuitBreaker
+        self.requests_today = 0
+        self.quota_day = date.today()
+        self.lock = threading.Lock()
+
+    def breaker(self, endpoint_name):
+        with self.lock:
+            if endpoint_name not in self.breakers:
+                self.breakers[endpoint_name] = CircuitBreaker(self.breaker_failure_threshold, self.breaker_reset_seconds)
+            return self.breakers[endpoint_name]
+
+    def use_quota(self):
+        """
+        Count one request against today's quota.
+
+        Raises:
+            QuotaExceededError: If today's quota has already been used up.
+        """
+        with self.lock:
+            today = date.today()
+            if today != self.quota_day:
+                self.quota_day = today
+                self.requests_today = 0
+            if self.daily_quota is not None and self.requests_today >= self.daily_quota:
+                raise QuotaExceededError(f"The daily quota of {self.daily_quota} requests has been used up")
+            self.requests_today += 1
+
+    def backoff_seconds(self, attempt):
+        # "Full jitter" - anywhere between nothing and the exponential backoff, so retries from different threads spread out
+        return random.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** attempt))
+
+    def get(self, endpoint_name, url, **kwargs):
+        """
+        Send a GET request, waiting for the rate limit and retrying it if it fails in a way that's worth retrying.
+
+        Args:
+            endpoint_name (str): Which endpoint this is (e.g., "departure_mon"), for its circuit breaker.
+            url (str): The request url.
+            **kwargs: Passed on to session.get() (headers, params, etc.).
+
+        Returns:
+            requests.Response: The response. If every retry failed with an HTTP error, this is the last of them, for the caller to deal
+            with the same as any other error response.
+
+        Raises:
+            CircuitOpenError: If the endpoint is being left alone after failing too many times.
+            QuotaExceededError: If today's quota has been used up.
+            requests.RequestException: If the last attempt didn't get a response at all (timeout, connection error, etc.).
+        """
+        breaker = self.breaker(endpoint_name)
+        if not breaker.allow():
+            metrics.increment("api_circuit_open_total", endpoint=endpoint_name)
+            raise CircuitOpenError(f"{endpoint_name} has failed {breaker.failures} times in a row, not calling it for now")
+
+        kwargs.setdefault("timeout", self.timeout_seconds)
+        attempt = 0
+        try:
+            while True:
+                self.use_quota()
+                if self.bucket is not None:
+                    self.bucket.acquire()
+                if self.on_request is not None:
+                    self.on_request()
+
+                response = None
+                start = time.perf_counter()
+                try:
+                    response = self.session.get(url, **kwargs)
+                    error = None
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e
+                metrics.observe("api_request_seconds", time.perf_counter() - start, endpoint=endpoint_name)
+                if response is not None:
+                    metrics.increment("api_requests_total", endpoint=endpoint_name, status=response.status_code)
+                    metrics.observe("response_bytes", len(response.content), endpoint=endpoint_name)
+                else:
+                    metrics.increment("api_requests_total", endpoint=endpoint_name, status=type(error).__name__)
+
+                if error is None and response.status_code not in retry_status_codes:
+                    # Worked, or failed in a way retrying won't fix (e.g., a 404) - either way the API itself is working
+                    breaker.record_success()
+                    return response
+
+                wait = self.backoff_seconds(attempt)
+                if response is not None:
+                    retry_after = retry_after_seconds(response)
+                    if retry_after is not None:
+                        wait = retry_after
+                    if response.status_code == 429 and self.bucket is not None:
+                        # We're being throttled, so everything else needs to slow down too, not just this request
+                        self.bucket.pause(wait)
+
+                if attempt >= self.max_retries or wait > self.backoff_max_seconds:
+                    if error is not None:
+                        raise error
+                    breaker.record_failure()
+                    return response
+
+                attempt += 1
+                metrics.increment("api_retries_total", endpoint=endpoint_name)
+                log.info(f"Retrying {endpoint_name} in {wait:.1f} seconds (attempt {attempt} of {self.max_retries}): {error or response.status_code}")
+                time.sleep(wait)
+        except QuotaExceededError:
+            # Our own limit, not the endpoint failing, so it doesn't count against the breaker
+            breaker.cancel_trial()
+            raise
+        except Exception:
+            # Including anything unexpected, so a half open breaker's trial request can't leave it stuck half open
+            breaker.record_failure()
+            raise
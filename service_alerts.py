@@ -0,0 +1,155 @@
+"""
+Service alerts, each one sorted into "alert" or "info" only once, and indexed by the lines and stops they affect - so giving every
+departure its alerts is a couple of dictionary lookups, however many departures (and however long the alerts) there are.
+
+    alert_index = AlertIndex()
+    alert_index.classify_infos(service["infos"])        - the alerts sent with a departure_mon stopEvent, classified once per alert
+
+    network_alerts = build_alert_index(add_info_response)       - every current alert, from one add_info request
+    network_alerts.alerts_for("train", "T1", "10101100")        - the alerts for a T1 train from Central
+
+Lines are matched by mode as well as name, since different modes can use the same line name (e.g., the T1 train and a T1 bus). An
+alert that lists stops as well as lines (e.g., "T1 trains won't stop at Redfern") only goes with those lines at those stops.
+
+The alert rules are the ones parse_alerts() in dep_mon12.py has always used: very low priority alerts and anything that isn't a
+lineInfo are left out, and an alert saying trains aren't running, buses are replacing trains, or to allow extra travel time is an
+"alert" - everything else is "info".
+"""
+
+import logging
+import re
+
+log = logging.getLogger(__name__)
+
+# Any of these (in any case) in an alert's content makes it an "alert" rather than an "info"
+alert_pattern = re.compile("trains are not running|buses replacing trains|allow extra travel time", re.IGNORECASE)
+# Only these kinds of alert are shown
+shown_info_types = {"lineInfo"}
+# Classified alerts are remembered by their ID, version and priority - forget them all once there are this many, as old ones never come back
+max_classified_alerts = 10000
+# The mode for each product class the API gives an affected line (the same as type_lookup_table in dep_mon12.py)
+product_class_modes = {1: "train", 2: "metro", 4: "light_rail", 5: "bus", 7: "coach", 9: "ferry", 11: "school_bus"}
+
+
+def classify_info(info):
+    """
+    Turn one alert from the API into the alert to show.
+
+    Returns:
+        dict: {"subtitle", "content", "alert_type"}, where alert_type is "alert" or "info", or None if it isn't shown.
+    """
+    if info.get("priority") == "veryLow":
+        return None
+    info_type = info.get("properties", {}).get("infoType")
+    if info_type is not None and info_type not in shown_info_types:
+        return None
+    if "subtitle" not in info:
+        return None
+    content = info.get("content", "")
+    return {
+        "subtitle": info["subtitle"],
+        "content": content,
+        "alert_type": "alert" if alert_pattern.search(content) else "info",
+    }
+
+
+class AlertIndex:
+    """
+    Alerts classified once each, and the lines and stops they affect.
+    """
+
+    def __init__(self):
+        self.classified = {}  # (alert ID, version, priority) -> alert to show, or None if it isn't shown
+        self.line_alerts = {}  # (mode, line) (e.g., ("train", "T1")) -> alerts for the whole line. mode is None if the API didn't say
+        self.line_stop_alerts = {}  # (mode, line, stop ID) -> alerts for a line at only some stops
+        self.stop_alerts = {}  # stop ID -> alerts that are for the stop rather than any particular line
+        self.alert_count = 0
+
+    def classify(self, info):
+        """
+        classify_info(), remembered by the alert's ID, version and priority so the same alert is only classified once.
+        """
+        if "id" not in info:
+            return classify_info(info)
+        key = (info["id"], info.get("version"), info.get("priority"))
+        try:
+            return self.classified[key]
+        except KeyError:
+            pass
+        if len(self.classified) >= max_classified_alerts:
+            self.classified.clear()
+        alert = self.classified[key] = classify_info(info)
+        return alert
+
+    def classify_infos(self, infos):
+        """
+        The alerts to show from a stopEvent's infos, e.g., [{"subtitle": "...", "content": "...", "alert_type": "alert" or "info"}].
+        """
+        alerts = []
+        for info in infos:
+            alert = self.classify(info)
+            if alert is not None:
+                alerts.append(alert)
+        return alerts
+
+    def add(self, info):
+        """
+        Classify an alert from add_info and index it by the lines and stops it affects.
+        """
+        alert = self.classify(info)
+        if alert is None:
+            return
+        self.alert_count += 1
+        affected = info.get("affected", {})
+        lines = set()
+        for line in affected.get("lines", []):
+            name = line.get("disassembledName") or line.get("number")
+            if name:
+                lines.add((product_class_modes.get(line.get("product", {}).get("class")), name))
+        stop_ids = set()
+        for stop in affected.get("stops", []):
+            stop_ids.update((stop.get("id"), stop.get("properties", {}).get("stopId")))
+        stop_ids -= {None, ""}
+
+        if lines and stop_ids:
+            # Only those lines at those stops
+            for mode, line in lines:
+                for stop_id in stop_ids:
+                    self.line_stop_alerts.setdefault((mode, line, stop_id), []).append(alert)
+        elif lines:
+            for key in lines:
+                self.line_alerts.setdefault(key, []).append(alert)
+        else:
+            # Not for any particular line (e.g., a lift out of service), so it goes with every departure from the stops it affects
+            for stop_id in stop_ids:
+                self.stop_alerts.setdefault(stop_id, []).append(alert)
+
+    def alerts_for(self, mode, line, stop_id):
+        """
+        The alerts for a departure of a mode (e.g., "train") on line from stop_id - the line's alerts, then the ones for the line at
+        that stop, then the stop's.
+        """
+        alerts = []
+        for found in (self.line_alerts.get((mode, line)), self.line_alerts.get((None, line)),
+                      self.line_stop_alerts.get((mode, line, stop_id)), self.line_stop_alerts.get((None, line, stop_id)),
+                      self.stop_alerts.get(stop_id)):
+            if found:
+                alerts.extend(found)
+        return alerts
+
+    def __len__(self):
+        return self.alert_count
+
+
+def build_alert_index(add_info_response):
+    """
+    Index every current alert from an add_info response.
+
+    Returns:
+        AlertIndex: The alerts.
+    """
+    alert_index = AlertIndex()
+    for info in add_info_response.get("infos", {}).get("current", []):
+        alert_index.add(info)
+    log.debug("Indexed %s alerts for %s lines and %s stops", len(alert_index), len(alert_index.line_alerts), len(alert_index.stop_alerts))
+    return alert_index
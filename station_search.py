@@ -0,0 +1,227 @@
+"""
+Find a stop by its name without asking the API, using the stops saved by stop_locations.py (every station and stop in the GTFS
+timetable, with the modes that use it).
+
+    index = load_station_index("stop_locations.json")
+    index.resolve("Parramatta", ["train", "bus"])     - the best stop called something like "Parramatta" that trains or buses use
+    index.search("paramatta wharf", ["ferry"])        - the best few, ranked, typos and all
+
+Names are compared in lower case without punctuation, and without the words every station has (e.g., "Station", "Wharf"), so
+"Parramatta" is an exact match for both "Parramatta Station" and "Parramatta Wharf" - the modes asked for decide between them.
+An exact name is a dictionary lookup, and a name that's the start of others is a binary search through the sorted names, so
+resolving a station normally takes microseconds. Anything else (e.g., a typo) is matched on the three letter sequences the
+names share (trigrams), which are only worked out the first time they're needed.
+
+The stops that serve the most of the modes asked for always come first, then the closest name, so "Central (light_rail)" finds
+Central's light rail stop rather than Central Station. If the best match doesn't serve every one of the modes (e.g., "Central (train,
+bus)", where the buses leave from stops outside the station), or nothing's close enough, there's no match, and dep_mon12.py asks the
+stop_finder API instead.
+
+The stops file is only read once - load_station_index() gives back the same index until the file changes.
+
+    python station_search.py stop_locations.json "Parramatta" train,bus
+"""
+
+import bisect
+import logging
+import os
+import re
+import sys
+
+import stop_locations
+
+log = logging.getLogger(__name__)
+
+# Left out of the names when comparing them, as so many stops have them
+filler_words = {"station", "wharf", "light", "rail", "stop", "interchange"}
+# How alike two names have to be (twice the trigrams they share over how many they both have) to count as a match
+min_similarity = 0.5
+# The most names that start with a short name (e.g., "c") to look at
+max_prefix_matches = 500
+
+# How well a name matched, best last
+match_tiers = ("similar", "prefix", "exact")
+
+# locations path -> (the file's modified time, StationIndex), so the file is only read again if it's been rebuilt
+loaded_indexes = {}
+
+
+def normalise_name(name):
+    """
+    The name in lower case with punctuation and filler words taken out, e.g., "Parramatta Station, Stand A" -> "parramatta stand a".
+    """
+    words = re.sub(r"[^a-z0-9]+", " ", name.lower()).split()
+    kept = [word for word in words if word not in filler_words]
+    return " ".join(kept or words)
+
+
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class StationIndex:
+    """
+    The stops from build_stop_locations(), indexed by name. Use load_station_index() to open one.
+    """
+
+    def __init__(self, stops):
+        self.stops = stops
+        self.keys = [normalise_name(stop["station_name"]) for stop in stops]
+        self.stops_by_key = {}  # normalised name -> positions in stops
+        for position, key in enumerate(self.keys):
+            self.stops_by_key.setdefault(key, []).append(position)
+        self.sorted_keys = sorted(self.stops_by_key)
+        # trigram -> positions in stops, and how many trigrams each name has - worked out the first time a name isn't an exact or
+        # prefix match
+        self.trigram_stops = None
+        self.trigram_counts = None
+
+    def build_trigrams(self):
+        self.trigram_stops = {}
+        self.trigram_counts = []
+        for position, key in enumerate(self.keys):
+            key_trigrams = trigrams(key)
+            self.trigram_counts.append(len(key_trigrams))
+            for trigram in key_trigrams:
+                self.trigram_stops.setdefault(trigram, []).append(position)
+
+    def prefix_matches(self, key):
+        """
+        The stops whose name starts with key (apart from key itself).
+        """
+        start = bisect.bisect_right(self.sorted_keys, key)
+        for other_key in self.sorted_keys[start:start + max_prefix_matches]:
+            if not other_key.startswith(key):
+                break
+            yield from self.stops_by_key[other_key]
+
+    def similar(self, key):
+        """
+        The stops whose name shares enough trigrams with key, as {position: similarity}.
+        """
+        if self.trigram_stops is None:
+            self.build_trigrams()
+        key_trigrams = trigrams(key)
+        shared = {}
+        for trigram in key_trigrams:
+            for position in self.trigram_stops.get(trigram, ()):
+                shared[position] = shared.get(position, 0) + 1
+        similar = {}
+        for position, count in shared.items():
+            similarity = 2 * count / (len(key_trigrams) + self.trigram_counts[position])
+            if similarity >= min_similarity:
+                similar[position] = similarity
+        return similar
+
+    def search(self, name, modes=None, limit=5):
+        """
+        The stops that best match a name, best first.
+
+        Args:
+            name (str): The station name, e.g., "Parramatta" or "parramatta wharf".
+            modes (list): The modes wanted (e.g., ["train", "bus"]) - stops that serve more of them come first, then stops that serve
+                the ones earlier in the list. None for any mode.
+            limit (int): The most stops to return.
+
+        Returns:
+            list: {"stop_id", "station_name", "modes", "match", "similarity"} for each stop, where modes is every mode that uses the
+            stop and match is "exact", "prefix" or "similar".
+        """
+        key = normalise_name(name)
+        if not key:
+            return []
+        wanted = set(modes) if modes else None
+
+        def modes_served(position):
+            stop_modes = self.stops[position]["modes"]
+            return len(stop_modes) if wanted is None else len(wanted.intersection(stop_modes))
+
+        def serves_every_mode(found):
+            return any(wanted is None or modes_served(position) == len(wanted) for position in found)
+
+        # Exact names first, then names starting with it, then similar names (e.g., a typo) - only going on to the next (slower)
+        # one if nothing so far serves every mode asked for
+        found = {position: "exact" for position in self.stops_by_key.get(key, ())}
+        if not serves_every_mode(found):
+            for position in self.prefix_matches(key):
+                found.setdefault(position, "prefix")
+            if not serves_every_mode(found):
+                for position in self.similar(key):
+                    found.setdefault(position, "similar")
+
+        key_trigrams = trigrams(key)
+        ranked = []
+        for position, tier in found.items():
+            if tier == "exact":
+                similarity = 1.0
+            else:
+                other_trigrams = trigrams(self.keys[position])
+                similarity = 2 * len(key_trigrams & other_trigrams) / (len(key_trigrams) + len(other_trigrams))
+            stop_modes = self.stops[position]["modes"]
+            first_mode = min((modes.index(mode) for mode in stop_modes if mode in modes), default=len(modes)) if modes else 0
+            rank = (modes_served(position), -first_mode, match_tiers.index(tier), similarity, -len(self.keys[position]), -position)
+            ranked.append((rank, position, tier, similarity))
+        ranked.sort(reverse=True)
+
+        return [
+            {**self.stops[position], "match": tier, "similarity": round(similarity, 3)}
+            for _, position, tier, similarity in ranked[:limit]
+        ]
+
+    def resolve(self, name, modes=None):
+        """
+        The one best stop for a name and the modes wanted.
+
+        Returns:
+            dict: {"stop_id", "station_name", "modes", "match", "similarity"} (see search()), or None if nothing matched well
+            enough or the best match doesn't serve every one of the modes.
+        """
+        matches = self.search(name, modes, limit=1)
+        if not matches:
+            return None
+        best = matches[0]
+        # Stops serving every mode come first, so if the best one doesn't, none of them do
+        if modes and not set(modes).issubset(best["modes"]):
+            return None
+        return best
+
+    def __len__(self):
+        return len(self.stops)
+
+
+def load_station_index(locations_path):
+    """
+    Open the stops saved by build_stop_locations() for searching by name. The file is only read the first time (or again once it's
+    been rebuilt) - after that it's the same index as last time.
+
+    Returns:
+        StationIndex: The index, or None if there isn't a stop locations file (or it can't be read).
+    """
+    try:
+        modified_time = os.path.getmtime(locations_path)
+    except (OSError, TypeError):
+        return None
+    loaded = loaded_indexes.get(locations_path)
+    if loaded is not None and loaded[0] == modified_time:
+        return loaded[1]
+
+    locations = stop_locations.load_stop_locations(locations_path)
+    if locations is None:
+        return None
+    station_index = StationIndex(locations.stops)
+    loaded_indexes[locations_path] = (modified_time, station_index)
+    return station_index
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format="%(message)s")
+    if len(sys.argv) not in (3, 4):
+        print("Usage: python station_search.py <stop locations file> <station name> [mode,mode,...]")
+        sys.exit(1)
+    index = load_station_index(sys.argv[1])
+    if index is None:
+        print(f"Couldn't open {sys.argv[1]} - build it with: python stop_locations.py build <GTFS zip> {sys.argv[1]}")
+        sys.exit(1)
+    for match in index.search(sys.argv[2], sys.argv[3].split(",") if len(sys.argv) == 4 else None):
+        print(f"{match['stop_id']:<12} {match['station_name']:<50} {', '.join(match['modes']):<25} {match['match']} ({match['similarity']})")
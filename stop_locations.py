@@ -0,0 +1,170 @@
+"""
+Every stop near a location, from the TfNSW GTFS static timetable, so a board can be set up from a map coordinate and a radius
+instead of typing in each station's name (and without any stop_finder calls).
+
+The stops and the modes that use each of them only need working out once, by:
+
+    python stop_locations.py build path/to/full_greater_sydney_gtfs_static.zip stop_locations.json
+
+then:
+
+    stop_locations = load_stop_locations("stop_locations.json")
+    stop_locations.stops_within(-33.8832, 151.2070, 400, modes={"train", "bus"})    - every train station and bus stop within 400m
+
+Platforms, stands and wharves are grouped into their station, so a station comes back once with every mode that uses any of its
+platforms. Searching uses a grid of roughly 500m squares, so only the stops in the few squares the circle covers are checked.
+"""
+
+import json
+import logging
+import math
+import os
+import sys
+
+import gtfs_static
+
+log = logging.getLogger(__name__)
+
+earth_radius_metres = 6371000
+grid_cell_metres = 500
+
+
+def distance_metres(latitude_1, longitude_1, latitude_2, longitude_2):
+    """
+    The distance between two points, in metres (along the ground, using the haversine formula).
+    """
+    latitude_1, longitude_1, latitude_2, longitude_2 = map(math.radians, (latitude_1, longitude_1, latitude_2, longitude_2))
+    a = math.sin((latitude_2 - latitude_1) / 2) ** 2 + math.cos(latitude_1) * math.cos(latitude_2) * math.sin((longitude_2 - longitude_1) / 2) ** 2
+    return 2 * earth_radius_metres * math.asin(math.sqrt(a))
+
+
+def build_stop_locations(gtfs_path, locations_path):
+    """
+    Read the GTFS files once and save the stops used by load_stop_locations().
+
+    Args:
+        gtfs_path (str): The GTFS folder or zip file.
+        locations_path (str): Where to save the stops.
+    """
+    route_modes = {
+        route_id: gtfs_static.route_type_lookup_table.get(route_type.strip(), "unknown")
+        for route_id, route_type in gtfs_static.open_gtfs_columns(gtfs_path, "routes.txt", ["route_id", "route_type"])
+    }
+    trip_modes = {
+        trip_id: route_modes.get(route_id, "unknown")
+        for trip_id, route_id in gtfs_static.open_gtfs_columns(gtfs_path, "trips.txt", ["trip_id", "route_id"])
+    }
+
+    # Which modes stop at each stop. stop_times.txt is huge, but most of it is the same few trips stopping at the same stops
+    stop_modes = {}
+    for trip_id, stop_id in gtfs_static.open_gtfs_columns(gtfs_path, "stop_times.txt", ["trip_id", "stop_id"]):
+        stop_modes.setdefault(stop_id, set()).add(trip_modes.get(trip_id, "unknown"))
+
+    stops = {}
+    parents = {}
+    for stop_id, stop_name, latitude, longitude, parent_station in gtfs_static.open_gtfs_columns(
+            gtfs_path, "stops.txt", ["stop_id", "stop_name", "stop_lat", "stop_lon", "parent_station"]):
+        if parent_station:
+            parents[stop_id] = parent_station
+        if latitude and longitude:
+            stops[stop_id] = {"stop_id": stop_id, "station_name": stop_name, "latitude": float(latitude), "longitude": float(longitude), "modes": set()}
+
+    # Give each station the modes from all of its platforms, and leave the platforms themselves out
+    for stop_id, modes in stop_modes.items():
+        station_id = parents.get(stop_id, stop_id)
+        if station_id in stops:
+            stops[station_id]["modes"].update(modes)
+    located_stops = [
+        {**stop, "modes": sorted(stop["modes"] - {"unknown"})}
+        for stop_id, stop in stops.items()
+        if stop_id not in parents and stop["modes"] - {"unknown"}
+    ]
+
+    with open(locations_path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(located_stops, file)
+    os.replace(locations_path + ".tmp", locations_path)
+
+    log.info(f"Stop locations saved to {locations_path}: {len(located_stops)} stops and stations")
+
+
+class StopLocations:
+    """
+    The stops from build_stop_locations(), in a grid for finding the ones near a location. Use load_stop_locations() to open one.
+    """
+
+    def __init__(self, stops):
+        self.stops = stops
+        # Longitude lines get closer together away from the equator, so the grid's columns are narrower in degrees than its rows
+        # are tall. Worked out at the average latitude, which is close enough for anywhere in NSW
+        average_latitude = sum(stop["latitude"] for stop in stops) / len(stops) if stops else 0
+        self.cell_latitude_degrees = math.degrees(grid_cell_metres / earth_radius_metres)
+        self.cell_longitude_degrees = self.cell_latitude_degrees / max(0.01, math.cos(math.radians(average_latitude)))
+        self.grid = {}  # (row, column) -> stops in that square
+        for stop in stops:
+            self.grid.setdefault(self.cell(stop["latitude"], stop["longitude"]), []).append(stop)
+
+    def cell(self, latitude, longitude):
+        return int(math.floor(latitude / self.cell_latitude_degrees)), int(math.floor(longitude / self.cell_longitude_degrees))
+
+    def stops_within(self, latitude, longitude, radius_metres, modes=None):
+        """
+        Every stop within radius_metres of a location, nearest first.
+
+        Args:
+            latitude (float): e.g., -33.8832
+            longitude (float): e.g., 151.2070
+            radius_metres (float): How far away to look.
+            modes (set): Only stops used by at least one of these modes (e.g., {"train", "bus"}). None for any mode.
+
+        Returns:
+            list: {"stop_id", "station_name", "latitude", "longitude", "modes", "distance_metres"} for each stop. modes only has the
+            wanted modes that use the stop.
+        """
+        # Every grid square the circle could reach into. The grid is a bit narrower than grid_cell_metres further south, so there's
+        # one extra square each way to be safe
+        cells = math.ceil(radius_metres / grid_cell_metres) + 1
+        row, column = self.cell(latitude, longitude)
+
+        found = []
+        for nearby_row in range(row - cells, row + cells + 1):
+            for nearby_column in range(column - cells, column + cells + 1):
+                for stop in self.grid.get((nearby_row, nearby_column), ()):
+                    stop_modes = stop["modes"] if modes is None else [mode for mode in stop["modes"] if mode in modes]
+                    if not stop_modes:
+                        continue
+                    distance = distance_metres(latitude, longitude, stop["latitude"], stop["longitude"])
+                    if distance <= radius_metres:
+                        found.append({**stop, "modes": stop_modes, "distance_metres": round(distance)})
+
+        found.sort(key=lambda stop: stop["distance_metres"])
+        return found
+
+    def __len__(self):
+        return len(self.stops)
+
+
+def load_stop_locations(locations_path):
+    """
+    Open the stops saved by build_stop_locations().
+
+    Returns:
+        StopLocations: The stops, or None if there isn't a file (or it can't be read).
+    """
+    if not locations_path or not os.path.exists(locations_path):
+        return None
+    try:
+        with open(locations_path, "r", encoding="utf-8") as file:
+            stop_locations = StopLocations(json.load(file))
+    except Exception as e:
+        log.error(f"Error loading stop locations: {e}")
+        return None
+    log.info(f"Loaded {len(stop_locations)} stop locations")
+    return stop_locations
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format="%(message)s")
+    if len(sys.argv) != 4 or sys.argv[1] != "build":
+        print("Usage: python stop_locations.py build <GTFS folder or zip> <stop locations file>")
+        sys.exit(1)
+    build_stop_locations(sys.argv[2], sys.argv[3])
@@ -0,0 +1,182 @@
+"""
+Made-up departure_mon and add_info responses, shaped like the real API's rapidJSON output, and made-up GTFS-Realtime TripUpdates
+feeds, for benchmarking and testing without the API.
+"""
+
+import random
+from datetime import datetime, timedelta, timezone
+
+import gtfs_realtime
+
+# (product class, lines, platform codes) for each mode - roughly what the API sends for each
+synthetic_modes = [
+    (1, ["T1", "T2", "T3", "T4", "T8", "T9", "CCN", "BMT"], ["CE16", "CE18", "CE21", "PTA1", "PTA3"]),
+    (2, ["M1"], ["SMP1", "SMP2"]),
+    (4, ["L1", "L2", "L3"], ["1", "2"]),
+    (5, ["308", "343", "M20", "440", "N70", "610X", "20T1"], ["J", "E", "D3"]),
+    (7, ["Coach 1", "Coach 2"], ["A"]),
+    (9, ["F1", "F2", "F3", "F4", "MFF"], ["F2A", "F5B", "F1"]),
+]
+
+synthetic_destinations = ["Central", "Parramatta", "Penrith", "Hornsby via Strathfield", "Circular Quay", "Manly",
+                          "Randwick via Central", "Liverpool via Regents Park", "Chatswood", "Bondi Junction"]
+
+synthetic_alerts = [
+    ("Trackwork", "Buses replacing trains between Strathfield and Lidcombe. Allow extra travel time. " * 4),
+    ("Lift out of service", "The lift at this station is temporarily out of service. For assistance, please speak to staff. " * 3),
+    ("Timetable changes", "Timetables have changed for some services. Check the timetable before you travel. " * 3),
+]
+
+
+def make_stop_events(count, start=None, seed=0, alerts_per_event=1, classes=None):
+    """
+    Make a list of made-up stopEvents, in departure time order like the API sends them.
+
+    Args:
+        count (int): How many stopEvents to make.
+        start (datetime): The time of the first departure (defaults to now).
+        seed (int): Random seed, so the same arguments always give the same events.
+        alerts_per_event (int): How many infos to attach to each event.
+        classes (list): Only make events for these product classes (defaults to every mode).
+
+    Returns:
+        list: The stopEvents.
+    """
+    rng = random.Random(seed)
+    start = start or datetime.now(timezone.utc)
+    modes = [mode for mode in synthetic_modes if classes is None or mode[0] in classes]
+    stop_events = []
+
+    for i in range(count):
+        product_class, lines, platforms = rng.choice(modes)
+        line = rng.choice(lines)
+        planned = start + timedelta(seconds=i * 3600 / max(count, 1) * 2 + 60)  # spread over the next two hours
+        realtime = rng.random() < 0.8
+        estimated = planned + timedelta(minutes=rng.choice([0, 0, 0, 1, 2, 3, 7]))
+
+        service = {
+            "isRealtimeControlled": realtime,
+            "location": {
+                "id": f"2000{i % 90:02d}",
+                "name": "Central Station, Platform 18",
+                "type": "platform",
+                "properties": {"platform": rng.choice(platforms), "stopId": "10101100"},
+                "parent": {"id": "10101100", "name": "Central Station", "disassembledName": f"Platform {i % 25 + 1}", "type": "stop"},
+            },
+            "departureTimePlanned": planned.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "transportation": {
+                "id": f"nsw:{line}: :H:sj2",
+                "name": f"Line {line}",
+                "disassembledName": line,
+                "number": line,
+                "product": {"class": product_class, "name": "Mode", "iconId": product_class},
+                "destination": {"id": "10101229", "name": rng.choice(synthetic_destinations), "type": "stop"},
+            },
+            "properties": {"RealtimeTripId": f"{i}-{line}-{seed}"},
+        }
+        if realtime:
+            service["departureTimeEstimated"] = estimated.strftime("%Y-%m-%dT%H:%M:%SZ")
+            service["location"]["properties"]["occupancy"] = rng.choice(["MANY_SEATS", "FEW_SEATS", "STANDING_ONLY"])
+
+        infos = []
+        for j in range(alerts_per_event):
+            subtitle, content = synthetic_alerts[(i + j) % len(synthetic_alerts)]
+            infos.append({
+                "priority": rng.choice(["normal", "high", "veryLow"]),
+                "id": f"alert-{(i + j) % len(synthetic_alerts)}",
+                "version": 1,
+                "subtitle": subtitle,
+                "content": content,
+                "properties": {"infoType": "lineInfo"},
+            })
+        if infos:
+            service["infos"] = infos
+
+        stop_events.append(service)
+
+    return stop_events
+
+
+def make_departure_mon_response(count, **kwargs):
+    """
+    Make a whole made-up departure_mon response with count stopEvents. Takes the same keyword arguments as make_stop_events.
+    """
+    return {
+        "version": "10.2.1.42",
+        "systemMessages": [],
+        "locations": [{"id": "10101100", "name": "Central Station", "type": "stop"}],
+        "stopEvents": make_stop_events(count, **kwargs),
+    }
+
+
+def make_add_info_response(alert_count=30, seed=0):
+    """
+    Make a made-up add_info response with alert_count current alerts, each for a few of the synthetic lines (or, every so often,
+    for a stop rather than any line).
+    """
+    rng = random.Random(seed)
+    lines = [(product_class, line) for product_class, mode_lines, _ in synthetic_modes for line in mode_lines]
+    infos = []
+    for i in range(alert_count):
+        subtitle, content = synthetic_alerts[i % len(synthetic_alerts)]
+        if i % 5 == 4:
+            affected = {"stops": [{"id": "10101100", "name": "Central Station", "type": "stop", "properties": {"stopId": "10101100"}}]}
+        else:
+            affected = {"lines": [
+                {"id": f"nsw:{line}: :H:sj2", "name": f"Line {line}", "disassembledName": line, "number": line, "product": {"class": product_class}}
+                for product_class, line in rng.sample(lines, 3)
+            ]}
+        infos.append({
+            "id": f"add-info-{i}",
+            "version": 1,
+            "priority": rng.choice(["normal", "high", "veryLow"]),
+            "subtitle": f"{subtitle} ({i})",
+            "content": content,
+            "properties": {"infoType": "lineInfo"},
+            "affected": affected,
+        })
+    return {"version": "10.2.1.42", "infos": {"current": infos, "historic": []}}
+
+
+def make_trip_updates_feed(trip_count, stops_per_trip=20, start=None, seed=0, stop_ids=None, route_ids=None):
+    """
+    Make a made-up GTFS-Realtime TripUpdates feed, encoded the same way as the real feeds (see gtfs_realtime.py).
+
+    Args:
+        trip_count (int): How many trips to include. The full Sydney bus feed has a few thousand at peak times.
+        stops_per_trip (int): How many stop time updates each trip has.
+        start (datetime): The time of the first departure (defaults to now).
+        seed (int): Random seed, so the same arguments always give the same feed.
+        stop_ids (list): The stop IDs to use (defaults to 5000 made-up ones).
+        route_ids (list): The route IDs to use (defaults to a few made-up ones).
+
+    Returns:
+        bytes: The encoded FeedMessage.
+    """
+    encode_field = gtfs_realtime.encode_field
+    rng = random.Random(seed)
+    start = int((start or datetime.now(timezone.utc)).timestamp())
+    stop_ids = stop_ids or [str(2000000 + i) for i in range(5000)]
+    route_ids = route_ids or ["2-T1-sj2-1", "2-T9-sj2-1", "2436_308", "2436_343", "9-F1-sj2-1"]
+
+    header = encode_field(1, "2.0") + encode_field(3, start)  # gtfs_realtime_version, timestamp
+    feed = bytearray(encode_field(1, header))
+    for i in range(trip_count):
+        route_id = rng.choice(route_ids)
+        trip = encode_field(1, f"{i}.{route_id}.{seed}") + encode_field(5, route_id)  # trip_id, route_id
+        if rng.random() < 0.01:
+            trip += encode_field(4, 3)  # CANCELED
+        trip_update = encode_field(1, trip)
+
+        first_stop = rng.randrange(len(stop_ids))
+        departure_time = start + rng.randrange(0, 7200)
+        delay = rng.choice([0, 0, 0, 60, 120, 180, 420, -60])
+        for j in range(stops_per_trip):
+            stop_time_event = encode_field(1, delay) + encode_field(2, departure_time + delay)  # delay, time
+            stop_time_update = encode_field(1, j + 1) + encode_field(4, stop_ids[(first_stop + j) % len(stop_ids)])  # stop_sequence, stop_id
+            stop_time_update += encode_field(2, stop_time_event) + encode_field(3, stop_time_event)  # arrival, departure
+            trip_update += encode_field(2, stop_time_update)
+            departure_time += rng.randrange(60, 240)
+
+        feed += encode_field(2, encode_field(1, f"entity-{i}") + encode_field(3, trip_update))  # entity: id, trip_update
+    return bytes(feed)
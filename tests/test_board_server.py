@@ -0,0 +1,13 @@
+import board_server
+
+
+def test_delay_stats_fading_is_not_a_change(monkeypatch):
+    monkeypatch.setattr(board_server, "board_snapshots", {})
+    output = {"generated_at": 1738300000, "departures": [{"line": 0}], "delay_stats": {"lines": {"T1": {"services": 49}}, "stops": {}}}
+    assert board_server.publish_departures(output, "test")
+
+    # Nothing new has been seen, but the stats have faded a little since
+    faded = {**output, "generated_at": 1738300040, "delay_stats": {"lines": {"T1": {"services": 48}}, "stops": {}}}
+    assert not board_server.publish_departures(faded, "test")
+
+    assert board_server.publish_departures({**faded, "departures": [{"line": 1}]}, "test")
@@ -0,0 +1,73 @@
+import delay_stats
+
+
+def departure(stop_id, line, planned_time, delay_seconds, trip_id=None, type_of_transport="train"):
+    return {
+        "isRealtimeControlled": True,
+        "stop_id": stop_id,
+        "line": line,
+        "type_of_transport": type_of_transport,
+        "realtime_trip_id": trip_id or f"{line}-{planned_time}",
+        "departure_time_planned": planned_time,
+        "departure_time_estimated": planned_time + delay_seconds,
+    }
+
+
+def test_stats_after_a_long_gap_with_nothing_leaving():
+    tracker = delay_stats.DelayTracker(half_life_seconds=60)
+    now = 1738300000
+    tracker.update([departure("10101100", "T1", now, 120)], now)
+    tracker.update([], now + 130)
+    assert tracker.stats(now + 130)["stops"]["10101100"]["services"] == 1
+
+    # Over 1024 half lives later - overnight for a 1 minute half life
+    assert tracker.stats(now + 1100 * 60) == {"lines": {}, "stops": {}}
+
+
+def test_lines_with_the_same_name_on_different_modes_are_kept_apart():
+    tracker = delay_stats.DelayTracker()
+    now = 1738300000
+    tracker.update([departure("10101100", "T1", now, 600), departure("10101100", "T1", now, 0, trip_id="bus-T1", type_of_transport="bus")], now)
+    lines = tracker.stats(now + 700, lines=["train|T1", "bus|T1"])["lines"]
+    assert lines["train|T1"]["mean_delay_seconds"] == 600
+    assert lines["bus|T1"]["mean_delay_seconds"] == 0
+
+
+def test_a_service_is_only_counted_once():
+    tracker = delay_stats.DelayTracker()
+    now = 1738300000
+    tracker.update([departure("10101100", "T1", now, 60)], now)
+    tracker.update([], now + 61)
+    # It was due to leave a second ago, but the next poll says it's another minute away
+    tracker.update([departure("10101100", "T1", now, 120)], now + 62)
+    tracker.update([], now + 200)
+    assert tracker.stats(now + 200)["lines"]["train|T1"]["services"] == 1
+
+
+def test_percentiles_are_within_the_relative_accuracy():
+    tracker = delay_stats.DelayTracker(half_life_seconds=10 ** 9, relative_accuracy=0.02)
+    now = 1738300000
+    delays = [61 + 17 * i for i in range(1000)]
+    tracker.update([departure("10101100", "T1", now, delay, trip_id=str(i)) for i, delay in enumerate(delays)], now)
+    stats = tracker.stats(now + 86400)["lines"]["train|T1"]
+
+    assert stats["services"] == 1000
+    for name, q in (("p50_delay_seconds", 0.5), ("p90_delay_seconds", 0.9), ("p99_delay_seconds", 0.99)):
+        exact = delays[int(q * len(delays)) - 1]
+        assert abs(stats[name] - exact) <= 0.02 * exact + 1
+
+
+def test_moving_the_landmark_keeps_the_stats_the_same():
+    now = 1738300000
+    moved = delay_stats.DelayTracker(half_life_seconds=60)
+    moved.update([departure("10101100", "T1", now, 0)], now)
+    fresh = delay_stats.DelayTracker(half_life_seconds=60)
+
+    # Over 60 half lives later, so the first service's weight moves the landmark up
+    later = now + 61 * 60
+    for tracker in (moved, fresh):
+        tracker.update([departure("10101100", "T1", later, 60), departure("10101100", "T1", later + 30, 90)], later)
+        tracker.update([], later + 130)
+    assert moved.landmark > now
+    assert moved.stats(later + 130)["lines"]["train|T1"]["mean_delay_seconds"] == 80  # The first left a half life earlier
+    assert moved.stats(later + 130) == fresh.stats(later + 130)
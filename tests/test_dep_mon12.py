@@ -0,0 +1,71 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import dep_mon12
+import gtfs_realtime
+import synthetic_data
+
+
+@pytest.fixture
+def poll_schedule(monkeypatch):
+    monkeypatch.setattr(dep_mon12, "poll_schedule", {})
+    return dep_mon12.poll_schedule
+
+
+def poll(jobs, now):
+    for job in jobs:
+        dep_mon12.poll_schedule[job["key"]] = {"fetched_at": now, "departures": dep_mon12.run_poll_job(job), "failures": 0}
+
+
+def test_trip_update_departures_keep_the_trip_planner_stop_id(monkeypatch, poll_schedule):
+    # Central's trip planner stop ID is 10101100, but the TripUpdates feeds know it as 200060
+    feed = synthetic_data.make_trip_updates_feed(20, stops_per_trip=1, stop_ids=["200060"], route_ids=["2-T1-sj2-1"])
+    index = gtfs_realtime.build_trip_update_index(feed)
+    monkeypatch.setattr(dep_mon12, "departure_source", "gtfs_realtime")
+    monkeypatch.setattr(dep_mon12, "gtfs_realtime_feeds", {"train": ["sydneytrains"]})
+    monkeypatch.setattr(dep_mon12, "trip_update_index", lambda feed_path: index)
+
+    board_stations = [{"station_name": "Central", "stop_id": "10101100", "gtfs_stop_id": "200060", "modes": [{"mode_name": "train"}]}]
+    jobs = dep_mon12.build_poll_jobs(dep_mon12.shared_stations([board_stations]))
+    now = time.time()
+    poll(jobs, now)
+
+    departures = dep_mon12.merge_departures(dep_mon12.board_departure_streams(board_stations, jobs, now))
+    assert departures
+    assert {departure["stop_id"] for departure in departures} == {"10101100"}
+    assert {departure["stop_name"] for departure in departures} == {"Central"}
+
+
+def test_a_late_service_is_shown_after_one_that_overtakes_it(monkeypatch):
+    start = datetime.now(timezone.utc).replace(microsecond=0)
+    late, on_time = synthetic_data.make_stop_events(2, start=start, classes=[1], alerts_per_event=0)
+    # The API sends them in planned order, but the first one is running 10 minutes late
+    for service, planned_minutes, estimated_minutes in ((late, 5, 15), (on_time, 10, 10)):
+        service["isRealtimeControlled"] = True
+        service["departureTimePlanned"] = (start + timedelta(minutes=planned_minutes)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        service["departureTimeEstimated"] = (start + timedelta(minutes=estimated_minutes)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    monkeypatch.setattr(dep_mon12, "max_minutes_until_departure", 12)
+
+    departures = dep_mon12.parse_departures_by_mode([late, on_time], "Central", "10101100", [{"mode_name": "train"}])
+    assert [departure["realtime_trip_id"] for departure in departures] == [on_time["properties"]["RealtimeTripId"], late["properties"]["RealtimeTripId"]]
+
+    # The on time one is within max_minutes_until_departure, even though the late one (planned first) isn't
+    shown = dep_mon12.merge_departures([departures])
+    assert [departure["realtime_trip_id"] for departure in shown] == [on_time["properties"]["RealtimeTripId"]]
+
+
+def test_the_request_budget_counts_the_requests_actually_sent(monkeypatch, poll_schedule):
+    now = time.time()
+    monkeypatch.setattr(dep_mon12, "max_requests_per_minute", 5)
+    # e.g., an add_info call and some retries, as well as the departure_mon calls
+    monkeypatch.setattr(dep_mon12, "recent_request_times", dep_mon12.deque([now - 90] + [now - 10] * 3))
+    polled = []
+    monkeypatch.setattr(dep_mon12, "fetch_poll_jobs", lambda jobs: polled.extend(jobs) or [(job, [], None) for job in jobs])
+
+    stations = [{"station_name": f"Stop {i}", "stop_id": str(10101100 + i), "modes": [{"mode_name": "train"}]} for i in range(3)]
+    dep_mon12.poll_due_jobs(dep_mon12.build_poll_jobs(stations), now)
+    assert len(polled) == 2
+    # The governor adds the requests as it sends them, rather than one for each job here
+    assert list(dep_mon12.recent_request_times) == [now - 10] * 3
@@ -0,0 +1,75 @@
+import time
+
+import pytest
+
+import departure_history
+
+
+def departure(line, planned_time, estimated_time, trip_id="trip-1", stop_id="10101100"):
+    return {
+        "stop_id": stop_id,
+        "stop_name": "Central Station",
+        "line": line,
+        "type_of_transport": "train",
+        "destination": "Hornsby",
+        "isRealtimeControlled": estimated_time is not None,
+        "realtime_trip_id": trip_id,
+        "departure_time_planned": planned_time,
+        "departure_time_estimated": estimated_time,
+    }
+
+
+@pytest.fixture
+def recorder(tmp_path):
+    recorder = departure_history.DepartureRecorder(str(tmp_path / "history.sqlite"))
+    yield recorder
+    recorder.close()
+
+
+def write(recorder, batch):
+    connection = departure_history.open_database(recorder.database_path)
+    try:
+        recorder.write_batch(connection, batch)
+    finally:
+        connection.close()
+
+
+def test_a_departure_keeps_the_time_it_was_first_seen(recorder):
+    planned_time = int(time.time()) + 600
+    write(recorder, [(1000, [departure("T1", planned_time, planned_time)]), (1010, [departure("T1", planned_time, planned_time + 60)])])
+    write(recorder, [(1020, [departure("T1", planned_time, planned_time + 120)])])
+
+    [row] = departure_history.query_departures(recorder.database_path)
+    assert (row["first_seen"], row["last_seen"]) == (1000, 1020)
+    assert (row["estimated_time"], row["delay_seconds"]) == (planned_time + 120, 120)
+
+
+def test_unchanged_departures_are_not_written_again(recorder):
+    planned_time = int(time.time()) + 600
+    write(recorder, [(1000, [departure("T1", planned_time, planned_time + 60), departure("T2", planned_time, planned_time, trip_id="trip-2")])])
+    assert recorder.rows_written == 2
+
+    write(recorder, [(1010, [departure("T1", planned_time, planned_time + 60), departure("T2", planned_time, planned_time + 30, trip_id="trip-2")])])
+    assert recorder.rows_written == 3
+    rows = {row["line"]: row for row in departure_history.query_departures(recorder.database_path)}
+    assert rows["T1"]["last_seen"] == 1000
+    assert rows["T2"]["last_seen"] == 1010
+
+
+def test_punctuality_summary(recorder):
+    planned_time = int(time.time()) + 600
+    write(recorder, [(1000, [
+        departure("T1", planned_time, planned_time, trip_id="a"),
+        departure("T1", planned_time + 60, planned_time + 60 + 600, trip_id="b"),
+        departure("T1", planned_time + 120, planned_time + 120 + 300, trip_id="c"),
+        departure("T1", planned_time + 180, None, trip_id=""),  # Timetabled, so left out
+        departure("T9", planned_time, planned_time + 60, trip_id="d"),
+    ])])
+
+    summary = departure_history.punctuality_summary(recorder.database_path)
+    assert [line["line"] for line in summary] == ["T1", "T9"]
+    assert summary[0]["departures"] == 3
+    assert summary[0]["on_time_percent"] == pytest.approx(200 / 3)
+    assert summary[0]["average_delay_seconds"] == 300
+    assert summary[0]["worst_delay_seconds"] == 600
+    assert departure_history.punctuality_summary(recorder.database_path, line="T9")[0]["on_time_percent"] == 100
@@ -0,0 +1,97 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import dep_mon12
+import gtfs_realtime
+import gtfs_timetable
+
+encode_field = gtfs_realtime.encode_field
+
+
+def gtfs_time(seconds):
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def stop_time_update(stop_sequence, stop_id, delay=None, event_time=None, relationship=None):
+    update = encode_field(1, stop_sequence) + encode_field(4, stop_id)
+    if delay is not None or event_time is not None:
+        event = (encode_field(1, delay) if delay is not None else b"") + (encode_field(2, event_time) if event_time is not None else b"")
+        update += encode_field(3, event)
+    if relationship is not None:
+        update += encode_field(5, relationship)
+    return encode_field(2, update)
+
+
+def trip_update_feed(*trips):
+    feed = encode_field(1, encode_field(1, "2.0") + encode_field(3, int(time.time())))
+    for trip_id, cancelled, updates in trips:
+        trip = encode_field(1, trip_id) + encode_field(5, "T1")
+        if cancelled:
+            trip += encode_field(4, gtfs_realtime.TRIP_CANCELED)
+        feed += encode_field(2, encode_field(1, trip_id) + encode_field(3, encode_field(1, trip) + b"".join(updates)))
+    return feed
+
+
+@pytest.fixture
+def central(tmp_path, monkeypatch):
+    """
+    A timetable with six T1 trips, each leaving Hornsby (stop 1), then Central platform 18 (stop 2) 10 minutes later.
+    """
+    now = time.time()
+    day_start = gtfs_timetable.service_day_start(datetime.fromtimestamp(now).date())
+    first_departure = int(now - day_start) + 10 * 60
+    gtfs_path = tmp_path / "gtfs"
+    gtfs_path.mkdir()
+    (gtfs_path / "routes.txt").write_text("route_id,route_short_name,route_type\nT1,T1,2\n")
+    today = datetime.fromtimestamp(now).date()
+    first_date, last_date = ((today + timedelta(days=days)).strftime("%Y%m%d") for days in (-2, 2))
+    (gtfs_path / "calendar.txt").write_text(f"service_id,start_date,end_date,monday,tuesday,wednesday,thursday,friday,saturday,sunday\n"
+                                            f"daily,{first_date},{last_date},1,1,1,1,1,1,1\n")
+    (gtfs_path / "stops.txt").write_text("stop_id,parent_station\n200060,\n2000338,200060\n207710,\n")
+    trips = ["on_time", "late", "cancelled", "late_here", "skipping", "not_in_feed"]
+    (gtfs_path / "trips.txt").write_text("trip_id,route_id,service_id,trip_headsign\n" + "".join(f"{trip},T1,daily,Emu Plains\n" for trip in trips))
+    stop_times = "trip_id,departure_time,stop_id,stop_sequence,pickup_type\n"
+    planned = {}
+    for number, trip in enumerate(trips):
+        leaves_hornsby = first_departure + number * 2 * 60
+        stop_times += f"{trip},{gtfs_time(leaves_hornsby - 10 * 60)},207710,1,0\n{trip},{gtfs_time(leaves_hornsby)},2000338,2,0\n"
+        planned[trip] = int(day_start + leaves_hornsby)
+    (gtfs_path / "stop_times.txt").write_text(stop_times)
+    gtfs_timetable.build_timetable(str(gtfs_path), str(tmp_path / "timetable.bin"))
+
+    monkeypatch.setattr(dep_mon12, "timetable", gtfs_timetable.load_timetable(str(tmp_path / "timetable.bin")))
+    monkeypatch.setattr(dep_mon12, "gtfs_realtime_feeds", {"train": ["sydneytrains"]})
+    return planned
+
+
+def departures_by_trip(monkeypatch, index, planned):
+    monkeypatch.setattr(dep_mon12, "trip_update_index", lambda feed_path: index)
+    station = {"station_name": "Central", "stop_id": "10101100", "gtfs_stop_id": "200060", "modes": [{"mode_name": "train"}]}
+    departures = dep_mon12.get_departures_from_trip_updates(station, station["modes"])
+    assert [departure["departure_time"] for departure in departures] == sorted(departure["departure_time"] for departure in departures)
+    # Just today's (the same trips run tomorrow too)
+    trip_ids = {time: trip for trip, time in planned.items()}
+    return {trip_ids[departure["departure_time_planned"]]: departure for departure in departures if departure["departure_time_planned"] in trip_ids}
+
+
+def test_trip_updates_are_joined_to_the_timetable(central, monkeypatch):
+    planned = central
+    feed = trip_update_feed(
+        ("on_time", False, [stop_time_update(1, "207710", event_time=planned["on_time"] - 10 * 60), stop_time_update(2, "2000338", event_time=planned["on_time"])]),
+        # Only a delay, and only for the stop before Central - it carries on to Central
+        ("late", False, [stop_time_update(1, "207710", delay=300)]),
+        ("cancelled", True, []),
+        ("late_here", False, [stop_time_update(2, "2000338", delay=120)]),
+        ("skipping", False, [stop_time_update(2, "2000338", relationship=gtfs_realtime.STOP_SKIPPED)]),
+    )
+    departures = departures_by_trip(monkeypatch, gtfs_realtime.build_trip_update_index(feed), planned)
+
+    assert set(departures) == {"on_time", "late", "late_here", "not_in_feed"}
+    assert departures["on_time"]["isRealtimeControlled"] and departures["on_time"]["delay"] == 0
+    assert departures["late"]["isRealtimeControlled"] and departures["late"]["departure_time"] == planned["late"] + 300
+    assert departures["late_here"]["departure_time"] == planned["late_here"] + 120
+    assert not departures["not_in_feed"]["isRealtimeControlled"]
+    assert departures["not_in_feed"]["departure_time_estimated"] is None
+    assert {departure["stop_id"] for departure in departures.values()} == {"10101100"}
@@ -0,0 +1,68 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import gtfs_timetable
+
+
+def gtfs_time(seconds):
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+@pytest.fixture
+def timetable(tmp_path):
+    """
+    A timetable for one platform at Central, with a train every day at 08:00 and 23:50 and one at 24:20 (00:20 the next morning),
+    plus a bus at 09:00 on weekdays only.
+    """
+    gtfs_path = tmp_path / "gtfs"
+    gtfs_path.mkdir()
+    (gtfs_path / "routes.txt").write_text("route_id,route_short_name,route_type\nT1,T1,2\n308,308,700\n")
+    (gtfs_path / "calendar.txt").write_text("service_id,start_date,end_date,monday,tuesday,wednesday,thursday,friday,saturday,sunday\n"
+                                            "daily,20260101,20271231,1,1,1,1,1,1,1\nweekdays,20260101,20271231,1,1,1,1,1,0,0\n")
+    (gtfs_path / "stops.txt").write_text("stop_id,parent_station\n200060,\n2000338,200060\n")
+    (gtfs_path / "trips.txt").write_text("trip_id,route_id,service_id,trip_headsign\n"
+                                         "morning,T1,daily,Emu Plains\nlate,T1,daily,Emu Plains\nafter_midnight,T1,daily,Emu Plains\n"
+                                         "bus,308,weekdays,Marrickville\n")
+    (gtfs_path / "stop_times.txt").write_text("trip_id,departure_time,stop_id,stop_sequence,pickup_type\n" + "".join(
+        f"{trip},{gtfs_time(seconds)},2000338,{sequence},0\n"
+        for trip, seconds, sequence in (("late", 23 * 3600 + 50 * 60, 4), ("morning", 8 * 3600, 4), ("after_midnight", 24 * 3600 + 20 * 60, 5),
+                                        ("bus", 9 * 3600, 1))))
+    gtfs_timetable.build_timetable(str(gtfs_path), str(tmp_path / "timetable.bin"))
+    return gtfs_timetable.load_timetable(str(tmp_path / "timetable.bin"))
+
+
+def test_only_a_few_days_of_services_are_remembered(timetable):
+    for days in range(10):
+        timetable.service_runs(0, int((date(2026, 10, 1) + timedelta(days=days)).strftime("%Y%m%d")))
+    assert sorted(timetable.service_runs_cache) == [20261007, 20261008, 20261009, 20261010]
+
+
+def local_time(text):
+    return int(datetime.strptime(text, "%Y-%m-%d %H:%M").timestamp())
+
+
+def summary(departures):
+    return [(datetime.fromtimestamp(departure[0]).strftime("%a %H:%M"), departure[1], departure[5], departure[6]) for departure in departures]
+
+
+def test_departures_run_on_past_midnight_into_the_next_day(timetable):
+    # Friday night: the last train, then the one just after midnight (still Friday's service), then Saturday morning's - no buses
+    departures = timetable.departures("200060", local_time("2026-10-16 23:45"), count=3)
+    assert summary(departures) == [
+        ("Fri 23:50", "late", "2000338", 4),
+        ("Sat 00:20", "after_midnight", "2000338", 5),
+        ("Sat 08:00", "morning", "2000338", 4),
+    ]
+
+
+def test_departures_just_after_midnight_come_from_yesterdays_service_day(timetable):
+    departures = timetable.departures("2000338", local_time("2026-10-17 00:10"), count=2)
+    assert summary(departures) == [("Sat 00:20", "after_midnight", "2000338", 5), ("Sat 08:00", "morning", "2000338", 4)]
+
+
+def test_departures_by_mode_and_until(timetable):
+    departures = timetable.departures("200060", local_time("2026-10-19 07:00"), count=None, modes={"bus"}, until=local_time("2026-10-20 00:00"))
+    assert summary(departures) == [("Mon 09:00", "bus", "2000338", 1)]
+    # Not on the weekend
+    assert timetable.departures("200060", local_time("2026-10-17 07:00"), count=5, modes={"bus"}) == []
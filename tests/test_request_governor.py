@@ -0,0 +1,61 @@
+import pytest
+
+import request_governor
+
+
+class FakeResponse:
+    status_code = 200
+    content = b"{}"
+    headers = {}
+
+
+class FakeSession:
+    def __init__(self):
+        self.calls = 0
+
+    def get(self, url, **kwargs):
+        self.calls += 1
+        return FakeResponse()
+
+
+def test_running_out_of_quota_does_not_open_the_breaker():
+    session = FakeSession()
+    governor = request_governor.RequestGovernor(session, requests_per_second=None, daily_quota=1, breaker_failure_threshold=2)
+    governor.get("departure_mon", "https://example.invalid")
+
+    for _ in range(5):
+        with pytest.raises(request_governor.QuotaExceededError):
+            governor.get("departure_mon", "https://example.invalid")
+
+    breaker = governor.breaker("departure_mon")
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+    assert session.calls == 1
+
+
+def test_running_out_of_quota_does_not_use_up_a_half_open_breakers_trial():
+    governor = request_governor.RequestGovernor(FakeSession(), requests_per_second=None, daily_quota=0, breaker_reset_seconds=0)
+    breaker = governor.breaker("departure_mon")
+    breaker.state = "open"
+
+    with pytest.raises(request_governor.QuotaExceededError):
+        governor.get("departure_mon", "https://example.invalid")
+    # Still waiting on a trial request, rather than stuck half open refusing everything
+    assert breaker.allow()
+
+
+def test_on_request_is_called_for_every_attempt():
+    class FlakySession(FakeSession):
+        def get(self, url, **kwargs):
+            response = super().get(url, **kwargs)
+            if self.calls == 1:
+                response = FakeResponse()
+                response.status_code = 503
+            return response
+
+    sent = []
+    governor = request_governor.RequestGovernor(
+        FlakySession(), requests_per_second=None, backoff_base_seconds=0, on_request=lambda: sent.append(1)
+    )
+    assert governor.get("departure_mon", "https://example.invalid").status_code == 200
+    assert len(sent) == 2
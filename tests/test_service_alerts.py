@@ -0,0 +1,35 @@
+import service_alerts
+
+
+def line(name, product_class):
+    return {"disassembledName": name, "number": name, "product": {"class": product_class}}
+
+
+def info(alert_id, affected):
+    return {"id": alert_id, "version": 1, "priority": "normal", "subtitle": alert_id, "content": "", "properties": {"infoType": "lineInfo"},
+            "affected": affected}
+
+
+def subtitles(alerts):
+    return [alert["subtitle"] for alert in alerts]
+
+
+def build(*infos):
+    return service_alerts.build_alert_index({"infos": {"current": list(infos)}})
+
+
+def test_line_alerts_only_go_with_the_same_mode():
+    alerts = build(info("T1 trains", {"lines": [line("T1", 1)]}))
+    assert subtitles(alerts.alerts_for("train", "T1", "10101100")) == ["T1 trains"]
+    assert alerts.alerts_for("bus", "T1", "10101100") == []
+
+
+def test_an_alert_for_lines_at_some_stops_only_goes_with_those_lines_at_those_stops():
+    redfern = {"id": "10101109", "properties": {"stopId": "10101109"}}
+    alerts = build(
+        info("T1 not stopping at Redfern", {"lines": [line("T1", 1)], "stops": [redfern]}),
+        info("Redfern lift", {"stops": [redfern]}),
+    )
+    assert subtitles(alerts.alerts_for("train", "T1", "10101109")) == ["T1 not stopping at Redfern", "Redfern lift"]
+    assert alerts.alerts_for("train", "T1", "10101100") == []
+    assert subtitles(alerts.alerts_for("train", "T2", "10101109")) == ["Redfern lift"]
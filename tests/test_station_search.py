@@ -0,0 +1,27 @@
+import json
+
+import station_search
+
+stops = [
+    {"stop_id": "200060", "station_name": "Central Station", "modes": ["train", "metro"]},
+    {"stop_id": "2000441", "station_name": "Central Light Rail", "modes": ["light_rail"]},
+    {"stop_id": "2150106", "station_name": "Parramatta Station", "modes": ["train", "bus"]},
+]
+
+
+def test_a_stop_serving_only_some_of_the_modes_is_not_a_match():
+    index = station_search.StationIndex(stops)
+    assert index.resolve("Central", ["train"])["stop_id"] == "200060"
+    assert index.resolve("Parramatta", ["train", "bus"])["stop_id"] == "2150106"
+    # No one stop has both, so it's left to stop_finder rather than quietly dropping the buses
+    assert index.resolve("Central", ["train", "bus"]) is None
+
+
+def test_the_stops_file_is_only_read_once(tmp_path, monkeypatch):
+    locations_path = tmp_path / "stop_locations.json"
+    locations_path.write_text(json.dumps([{**stop, "latitude": -33.88, "longitude": 151.2} for stop in stops]))
+    monkeypatch.setattr(station_search, "loaded_indexes", {})
+
+    index = station_search.load_station_index(str(locations_path))
+    assert len(index) == 3
+    assert station_search.load_station_index(str(locations_path)) is index